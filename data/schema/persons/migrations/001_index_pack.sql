@@ -0,0 +1,59 @@
+-- Index pack v1: secondary and covering indexes for the main access paths.
+-- Applied by scripts/migrate_db.py; every statement is idempotent.
+
+-- Per-contact timeline ordered by time without a sort step. (Message counts
+-- per username are a full scan of any username-led index; the primary key
+-- already covers them.)
+CREATE INDEX IF NOT EXISTS idx_wechat_messages_user_time
+    ON wechat_raw_messages(username, create_time);
+
+-- browse_wechat media listing: WHERE username = ? AND message_type = ?
+CREATE INDEX IF NOT EXISTS idx_wechat_messages_user_type
+    ON wechat_raw_messages(username, message_type);
+
+-- process_wechat_media: WHERE media_path = ? (once per media row)
+CREATE INDEX IF NOT EXISTS idx_wechat_messages_media_path
+    ON wechat_raw_messages(media_path);
+
+-- migrate_media_paths: UPDATE ... WHERE media_id = ?
+CREATE INDEX IF NOT EXISTS idx_wechat_messages_media_id
+    ON wechat_raw_messages(media_id);
+
+-- Per-contact timeline for QQ/other chats
+CREATE INDEX IF NOT EXISTS idx_other_chats_user_time
+    ON other_raw_chats(username, create_time);
+
+-- fetch_emails.get_or_create_person: SELECT person_id WHERE type = ? AND value = ?
+-- (covering: person_id is read from the index)
+CREATE INDEX IF NOT EXISTS idx_contacts_type_value
+    ON contacts(type, value, person_id);
+
+-- extract_people_from_sqlite.insert_person: WHERE person_id = ? AND type = ? AND value = ?
+-- lookup_person: WHERE person_id = ?
+CREATE INDEX IF NOT EXISTS idx_contacts_person
+    ON contacts(person_id, type, value);
+
+-- Name lookups in fetch_emails / extract_people_from_sqlite
+CREATE INDEX IF NOT EXISTS idx_persons_name ON persons(name);
+
+-- process_wechat_media: WHERE file_hash = ? AND person_id = ?; lookup_person counts
+CREATE INDEX IF NOT EXISTS idx_media_person_hash ON media(person_id, file_hash);
+
+-- rotate_encryption: WHERE encryption_status = 1
+CREATE INDEX IF NOT EXISTS idx_media_encryption ON media(encryption_status);
+
+-- Per-person email timeline
+CREATE INDEX IF NOT EXISTS idx_emails_person_date ON emails(person_id, date);
+
+-- Relationship lookups from either side
+CREATE INDEX IF NOT EXISTS idx_relationships_person1 ON relationships(person1_id);
+CREATE INDEX IF NOT EXISTS idx_relationships_person2 ON relationships(person2_id);
+
+-- Person detail tables are always read by person_id
+CREATE INDEX IF NOT EXISTS idx_education_person ON education(person_id);
+CREATE INDEX IF NOT EXISTS idx_career_person ON career(person_id);
+CREATE INDEX IF NOT EXISTS idx_financial_person ON financial_information(person_id);
+CREATE INDEX IF NOT EXISTS idx_property_person ON property(person_id);
+CREATE INDEX IF NOT EXISTS idx_person_groups_person ON person_groups(person_id, group_id);
+CREATE INDEX IF NOT EXISTS idx_person_positions_person ON person_positions(person_id, position_id);
+CREATE INDEX IF NOT EXISTS idx_groups_name_type ON groups(name, type);
@@ -0,0 +1,102 @@
+-- Full-text search over every consolidated text source: WeChat messages,
+-- other chats (QQ/WhatsApp/...), moments and emails (subject + body).
+-- Applied by scripts/migrate_db.py; queried by scripts/search_messages.py.
+--
+-- The trigram tokenizer indexes CJK text without word segmentation (any
+-- 3+ character substring matches). One FTS table holds all sources so hits
+-- rank against each other; its rowid encodes the source row:
+--   rowid = source rowid * 4 + kind   (0 message, 1 chat, 2 moment, 3 email)
+-- Triggers keep it in sync with inserts from merge_dbs.py/fetch_emails.py and
+-- deletes from message_dedup.py. `search_messages.py --rebuild` repopulates it
+-- (needed after a VACUUM, which may renumber implicit rowids).
+
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    title,
+    body,
+    contact UNINDEXED,
+    kind UNINDEXED,
+    ts_ms UNINDEXED,
+    ts_text UNINDEXED,
+    tokenize = 'trigram'
+);
+
+-- wechat_raw_messages (kind 0)
+CREATE TRIGGER IF NOT EXISTS search_fts_messages_ai AFTER INSERT ON wechat_raw_messages
+WHEN new.content IS NOT NULL AND new.content != '' BEGIN
+    INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    VALUES (new.rowid * 4, NULL, new.content, new.username, 'message', new.create_time * 1000);
+END;
+CREATE TRIGGER IF NOT EXISTS search_fts_messages_ad AFTER DELETE ON wechat_raw_messages BEGIN
+    DELETE FROM search_fts WHERE rowid = old.rowid * 4;
+END;
+CREATE TRIGGER IF NOT EXISTS search_fts_messages_au
+AFTER UPDATE OF username, create_time, content ON wechat_raw_messages BEGIN
+    DELETE FROM search_fts WHERE rowid = old.rowid * 4;
+    INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    SELECT new.rowid * 4, NULL, new.content, new.username, 'message', new.create_time * 1000
+    WHERE new.content IS NOT NULL AND new.content != '';
+END;
+
+-- other_raw_chats (kind 1)
+CREATE TRIGGER IF NOT EXISTS search_fts_chats_ai AFTER INSERT ON other_raw_chats
+WHEN new.content IS NOT NULL AND new.content != '' BEGIN
+    INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    VALUES (new.id * 4 + 1, NULL, new.content, new.username, 'chat', new.create_time * 1000);
+END;
+CREATE TRIGGER IF NOT EXISTS search_fts_chats_ad AFTER DELETE ON other_raw_chats BEGIN
+    DELETE FROM search_fts WHERE rowid = old.id * 4 + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS search_fts_chats_au
+AFTER UPDATE OF username, create_time, content ON other_raw_chats BEGIN
+    DELETE FROM search_fts WHERE rowid = old.id * 4 + 1;
+    INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    SELECT new.id * 4 + 1, NULL, new.content, new.username, 'chat', new.create_time * 1000
+    WHERE new.content IS NOT NULL AND new.content != '';
+END;
+
+-- wechat_moments (kind 2)
+CREATE TRIGGER IF NOT EXISTS search_fts_moments_ai AFTER INSERT ON wechat_moments
+WHEN new.content IS NOT NULL AND new.content != '' BEGIN
+    INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    VALUES (new.rowid * 4 + 2, NULL, new.content, new.username, 'moment', new.create_time * 1000);
+END;
+CREATE TRIGGER IF NOT EXISTS search_fts_moments_ad AFTER DELETE ON wechat_moments BEGIN
+    DELETE FROM search_fts WHERE rowid = old.rowid * 4 + 2;
+END;
+CREATE TRIGGER IF NOT EXISTS search_fts_moments_au
+AFTER UPDATE OF username, create_time, content ON wechat_moments BEGIN
+    DELETE FROM search_fts WHERE rowid = old.rowid * 4 + 2;
+    INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    SELECT new.rowid * 4 + 2, NULL, new.content, new.username, 'moment', new.create_time * 1000
+    WHERE new.content IS NOT NULL AND new.content != '';
+END;
+
+-- emails (kind 3); `date` is the raw Date header, converted to ms at query time
+CREATE TRIGGER IF NOT EXISTS search_fts_emails_ai AFTER INSERT ON emails BEGIN
+    INSERT INTO search_fts (rowid, title, body, contact, kind, ts_text)
+    VALUES (new.id * 4 + 3, new.subject, new.body, new.sender, 'email', new.date);
+END;
+CREATE TRIGGER IF NOT EXISTS search_fts_emails_ad AFTER DELETE ON emails BEGIN
+    DELETE FROM search_fts WHERE rowid = old.id * 4 + 3;
+END;
+CREATE TRIGGER IF NOT EXISTS search_fts_emails_au
+AFTER UPDATE OF subject, body, sender, date ON emails BEGIN
+    DELETE FROM search_fts WHERE rowid = old.id * 4 + 3;
+    INSERT INTO search_fts (rowid, title, body, contact, kind, ts_text)
+    VALUES (new.id * 4 + 3, new.subject, new.body, new.sender, 'email', new.date);
+END;
+
+-- Backfill rows merged before this migration
+DELETE FROM search_fts;
+INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    SELECT rowid * 4, NULL, content, username, 'message', create_time * 1000
+    FROM wechat_raw_messages WHERE content IS NOT NULL AND content != '';
+INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    SELECT id * 4 + 1, NULL, content, username, 'chat', create_time * 1000
+    FROM other_raw_chats WHERE content IS NOT NULL AND content != '';
+INSERT INTO search_fts (rowid, title, body, contact, kind, ts_ms)
+    SELECT rowid * 4 + 2, NULL, content, username, 'moment', create_time * 1000
+    FROM wechat_moments WHERE content IS NOT NULL AND content != '';
+INSERT INTO search_fts (rowid, title, body, contact, kind, ts_text)
+    SELECT id * 4 + 3, subject, body, sender, 'email', date FROM emails;
+INSERT INTO search_fts (search_fts) VALUES ('optimize');
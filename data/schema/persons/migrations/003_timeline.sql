@@ -0,0 +1,68 @@
+-- Unified per-person timeline over WeChat messages, other chats, moments and
+-- emails. Applied by scripts/migrate_db.py; populated incrementally by
+-- scripts/timeline.py (sync_timeline, run at the end of merge_dbs.py).
+--
+-- kind: 0 message (wechat_raw_messages.rowid), 1 chat (other_raw_chats.id),
+--       2 moment (wechat_moments.rowid), 3 email (emails.id)
+-- Rows exist only for sources that resolve to a person: chat usernames through
+-- contacts.value, emails through emails.person_id.
+
+-- Clustered on (person_id, create_time): a person's range is one contiguous scan
+CREATE TABLE IF NOT EXISTS timeline (
+    person_id INTEGER NOT NULL,
+    create_time INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    source_id INTEGER NOT NULL,
+    PRIMARY KEY (person_id, create_time, kind, source_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_timeline_source ON timeline(kind, source_id);
+
+-- Per-person monthly rollup (month = YYYYMM, local time), maintained by triggers
+CREATE TABLE IF NOT EXISTS timeline_counts (
+    person_id INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (person_id, month, kind)
+) WITHOUT ROWID;
+
+-- Last source id folded into the timeline, per source ('contacts' included:
+-- contacts added later pull in their existing history)
+CREATE TABLE IF NOT EXISTS timeline_watermarks (
+    source TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+
+-- Person resolution for chat usernames: contacts.value -> person_id
+CREATE INDEX IF NOT EXISTS idx_contacts_value_person ON contacts(value, person_id);
+CREATE INDEX IF NOT EXISTS idx_wechat_moments_user ON wechat_moments(username);
+
+CREATE TRIGGER IF NOT EXISTS timeline_counts_ai AFTER INSERT ON timeline BEGIN
+    INSERT INTO timeline_counts (person_id, month, kind, n)
+    VALUES (
+        new.person_id,
+        CAST(strftime('%Y%m', new.create_time, 'unixepoch', 'localtime') AS INTEGER),
+        new.kind, 1
+    )
+    ON CONFLICT (person_id, month, kind) DO UPDATE SET n = n + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS timeline_counts_ad AFTER DELETE ON timeline BEGIN
+    UPDATE timeline_counts SET n = n - 1
+    WHERE person_id = old.person_id
+      AND month = CAST(strftime('%Y%m', old.create_time, 'unixepoch', 'localtime') AS INTEGER)
+      AND kind = old.kind;
+END;
+
+-- Deleted sources (e.g. message_dedup.py) leave the timeline too
+CREATE TRIGGER IF NOT EXISTS timeline_messages_ad AFTER DELETE ON wechat_raw_messages BEGIN
+    DELETE FROM timeline WHERE kind = 0 AND source_id = old.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS timeline_chats_ad AFTER DELETE ON other_raw_chats BEGIN
+    DELETE FROM timeline WHERE kind = 1 AND source_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS timeline_moments_ad AFTER DELETE ON wechat_moments BEGIN
+    DELETE FROM timeline WHERE kind = 2 AND source_id = old.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS timeline_emails_ad AFTER DELETE ON emails BEGIN
+    DELETE FROM timeline WHERE kind = 3 AND source_id = old.id;
+END;
@@ -0,0 +1,18 @@
+-- Per-file progress of media encryption key rotations. Written by
+-- scripts/rotate_encryption.py; an interrupted rotation resumes from the rows
+-- not yet 'done'.
+--
+-- rotation_id: fingerprint of the new key (never the key itself)
+-- status: 'pending', 'done', 'missing' (file not on disk) or 'failed'
+
+CREATE TABLE IF NOT EXISTS key_rotation_log (
+    rotation_id TEXT NOT NULL,
+    media_id INTEGER NOT NULL,
+    file_path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    bytes INTEGER,
+    error TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (rotation_id, media_id)
+);
+CREATE INDEX IF NOT EXISTS idx_key_rotation_log_status ON key_rotation_log(rotation_id, status);
@@ -0,0 +1,18 @@
+-- Vision-model captions of WeChat images (wechat_raw_media, type 'image').
+-- Written by scripts/caption_images.py, read by process_wechat_media.py.
+-- One row per captioned image; images without a row are still pending.
+--
+-- phash: 64-bit difference hash (hex) of the image, NULL if it didn't decode
+-- duplicate_of: relative_path whose caption was reused (same or
+--               near-identical picture, e.g. .pic_thum vs .pic_hd)
+
+CREATE TABLE IF NOT EXISTS image_captions (
+    relative_path TEXT PRIMARY KEY,
+    phash TEXT,
+    info TEXT,
+    description TEXT,
+    model TEXT,
+    duplicate_of TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_image_captions_phash ON image_captions(phash);
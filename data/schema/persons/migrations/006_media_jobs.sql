@@ -0,0 +1,18 @@
+-- Work queue of scripts/process_wechat_media.py: one job per wechat_raw_media
+-- row. Jobs are enqueued by the script on every run; this status, not the
+-- message content, decides what still needs processing.
+--
+-- kind: 'audio', 'image', 'video' or 'file' (handler / worker pool)
+-- status: 'pending', 'running' (claimed by a run), 'done' or 'failed'
+-- attempts: runs that claimed the job; failed jobs are retried while
+--           attempts < MAX_ATTEMPTS
+
+CREATE TABLE IF NOT EXISTS media_jobs (
+    media_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_media_jobs_claim ON media_jobs(kind, status);
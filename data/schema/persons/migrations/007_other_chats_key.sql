@@ -0,0 +1,21 @@
+-- Natural key and origin for other_raw_chats, whose only key was an
+-- autoincrement id: re-merging a rebuilt raw DB duplicated every row, and rows
+-- deleted from a raw DB stayed in the main DB forever.
+-- Applied by scripts/migrate_db.py; merge_dbs.py fills raw_db and reconciles
+-- a raw DB's rows against it when they were rebuilt or deleted.
+--
+-- raw_db: file name of the raw DB the row was merged from (NULL for rows merged
+--         before this migration; merge_dbs.py claims them by source_file)
+
+ALTER TABLE other_raw_chats ADD COLUMN raw_db TEXT;
+
+-- Copies left by earlier re-merges: keep the first one
+DELETE FROM other_raw_chats WHERE id NOT IN (
+    SELECT MIN(id) FROM other_raw_chats
+    GROUP BY source_file, username, create_time, content
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_other_raw_chats_key
+    ON other_raw_chats(source_file, username, create_time, content);
+CREATE INDEX IF NOT EXISTS idx_other_raw_chats_raw_db
+    ON other_raw_chats(raw_db);
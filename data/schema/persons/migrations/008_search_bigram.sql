@@ -0,0 +1,69 @@
+-- Bigram index for 2-character search terms (the most common Chinese words),
+-- which the trigram tokenizer of search_fts (002) cannot match.
+-- Applied by scripts/migrate_db.py; filled by sync_bigrams in
+-- scripts/search_messages.py (run by merge_dbs.py and before each search).
+--
+-- search_bigram: same rowids as search_fts; `grams` lists the distinct
+--   overlapping letter/digit bigrams of the document's title and body,
+--   space-separated (computed in Python: no SQL function can split them).
+-- search_bigram_queue: search_fts rowids whose grams are missing or stale,
+--   queued by the triggers below; sync_bigrams drains it.
+
+CREATE VIRTUAL TABLE IF NOT EXISTS search_bigram USING fts5(
+    grams,
+    tokenize = 'unicode61',
+    detail = none
+);
+
+CREATE TABLE IF NOT EXISTS search_bigram_queue (
+    doc_id INTEGER PRIMARY KEY
+);
+
+-- Inserts, updates and deletes of every search_fts source queue the document
+-- (a deleted one is dropped from search_bigram when the queue is drained)
+CREATE TRIGGER IF NOT EXISTS search_bigram_messages_ai AFTER INSERT ON wechat_raw_messages BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (new.rowid * 4);
+END;
+CREATE TRIGGER IF NOT EXISTS search_bigram_messages_au
+AFTER UPDATE OF content ON wechat_raw_messages BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (new.rowid * 4);
+END;
+CREATE TRIGGER IF NOT EXISTS search_bigram_messages_ad AFTER DELETE ON wechat_raw_messages BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (old.rowid * 4);
+END;
+
+CREATE TRIGGER IF NOT EXISTS search_bigram_chats_ai AFTER INSERT ON other_raw_chats BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (new.id * 4 + 1);
+END;
+CREATE TRIGGER IF NOT EXISTS search_bigram_chats_au
+AFTER UPDATE OF content ON other_raw_chats BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (new.id * 4 + 1);
+END;
+CREATE TRIGGER IF NOT EXISTS search_bigram_chats_ad AFTER DELETE ON other_raw_chats BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (old.id * 4 + 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS search_bigram_moments_ai AFTER INSERT ON wechat_moments BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (new.rowid * 4 + 2);
+END;
+CREATE TRIGGER IF NOT EXISTS search_bigram_moments_au
+AFTER UPDATE OF content ON wechat_moments BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (new.rowid * 4 + 2);
+END;
+CREATE TRIGGER IF NOT EXISTS search_bigram_moments_ad AFTER DELETE ON wechat_moments BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (old.rowid * 4 + 2);
+END;
+
+CREATE TRIGGER IF NOT EXISTS search_bigram_emails_ai AFTER INSERT ON emails BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (new.id * 4 + 3);
+END;
+CREATE TRIGGER IF NOT EXISTS search_bigram_emails_au
+AFTER UPDATE OF subject, body ON emails BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (new.id * 4 + 3);
+END;
+CREATE TRIGGER IF NOT EXISTS search_bigram_emails_ad AFTER DELETE ON emails BEGIN
+    INSERT OR IGNORE INTO search_bigram_queue (doc_id) VALUES (old.id * 4 + 3);
+END;
+
+-- Backfill: every document already in search_fts
+INSERT OR IGNORE INTO search_bigram_queue (doc_id) SELECT rowid FROM search_fts;
@@ -12,7 +12,9 @@ CREATE TABLE IF NOT EXISTS group5_raw_messages (
     content TEXT,
     local_id INTEGER,
     source TEXT,
-    msg_hash TEXT UNIQUE
+    msg_hash TEXT,
+    -- Per source: a message in several files is kept in each (see group5_messages)
+    UNIQUE (source, msg_hash)
 );
 
 CREATE TABLE IF NOT EXISTS group5_raw_moments (
@@ -12,5 +12,7 @@ CREATE TABLE IF NOT EXISTS group8_raw_messages (
     content TEXT,
     local_id INTEGER,
     source TEXT,
-    msg_hash TEXT UNIQUE
+    msg_hash TEXT,
+    -- Per source: a message in several files is kept in each (see group8_messages)
+    UNIQUE (source, msg_hash)
 );
@@ -0,0 +1,226 @@
+"""
+Audio Transcoding
+-----------------
+Shared voice-clip conversion for the WeChat parsers (groups 4, 5, 6, 7) and
+process_wechat_media.py.
+Features:
+1. Silk (.aud/.silk, with or without the WeChat 0x02 prefix) is decoded with
+   pilk through memory-backed files (memfd on Linux): no .tmp.silk or .pcm
+   files are written next to the media.
+2. PCM is encoded to MP3 in-process with lameenc (requirements.txt), so a
+   Silk clip spawns no process; without it each clip is streamed to ffmpeg
+   on stdin.
+3. AMR clips are queued in a TranscodeBatch and converted with one ffmpeg
+   invocation per FFMPEG_BATCH_SIZE clips instead of one spawn per file.
+   `transcode_amr_batch` runs that over the blobs staged by
+   MediaStore.place_many, so the MP3 itself is stored.
+
+Usage:
+    dest = convert_silk_to_mp3(path)      # returns path unchanged on failure
+
+    batch = TranscodeBatch()
+    batch.add(amr_path)                   # queue, then
+    for src, dest in batch.flush():       # dest is None if conversion failed
+        ...
+"""
+
+import logging
+import os
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+# Optional decoders/encoders
+try:
+    import pilk
+    HAS_PILK = True
+except ImportError:
+    HAS_PILK = False
+
+try:
+    import lameenc
+    HAS_LAMEENC = True
+except ImportError:
+    HAS_LAMEENC = False
+
+SILK_HEADER = b"#!SILK_V3"
+# WeChat prepends one byte that pilk's decoder does not accept
+WECHAT_SILK_PREFIX = b"\x02"
+SILK_PCM_RATE = 24000
+MP3_BITRATE = 128
+FFMPEG_BATCH_SIZE = int(os.getenv("FFMPEG_BATCH_SIZE", "50"))
+
+
+def silk_payload(data):
+    """Returns the decodable Silk stream from a WeChat voice file, or None."""
+    if data.startswith(SILK_HEADER):
+        return data
+    if data.startswith(WECHAT_SILK_PREFIX + SILK_HEADER):
+        return data[len(WECHAT_SILK_PREFIX):]
+    return None
+
+
+@contextmanager
+def _scratch_path(data=b""):
+    """
+    A file path backed by memory where the OS allows it (memfd on Linux);
+    elsewhere a regular temporary file that is removed on exit.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("silk")
+        try:
+            os.write(fd, data)
+            yield f"/proc/self/fd/{fd}"
+        finally:
+            os.close(fd)
+    else:
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            yield path
+        finally:
+            os.remove(path)
+
+
+def _read_path(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def decode_silk(payload, rate=SILK_PCM_RATE):
+    """
+    Decodes a Silk stream to 16-bit mono PCM bytes.
+    pilk only takes file paths (and holds the GIL while decoding, so pipes fed
+    by threads would deadlock); memory-backed scratch files stand in for them.
+    """
+    with _scratch_path(payload) as silk_path, _scratch_path() as pcm_path:
+        pilk.decode(silk_path, pcm_path, pcm_rate=rate)
+        return _read_path(pcm_path)
+
+
+def encode_pcm_to_mp3(pcm, dest_path, rate=SILK_PCM_RATE):
+    """Encodes 16-bit mono PCM bytes to an MP3 file."""
+    if HAS_LAMEENC:
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(MP3_BITRATE)
+        encoder.set_in_sample_rate(rate)
+        encoder.set_channels(1)
+        encoder.set_quality(2)
+        data = encoder.encode(pcm) + encoder.flush()
+        with open(dest_path, "wb") as f:
+            f.write(data)
+        return
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(rate), "-ac", "1",
+        "-i", "pipe:0",
+        dest_path,
+    ]
+    subprocess.run(cmd, input=pcm, check=True)
+
+
+def convert_silk_to_mp3(src_path, remove_src=True):
+    """
+    Converts a WeChat Silk (.aud/.silk) file to MP3 next to it.
+    Returns the MP3 path, or src_path if the file is not Silk or conversion failed.
+    """
+    if not HAS_PILK:
+        logging.warning("pilk not installed, skipping silk conversion.")
+        return src_path
+    if not os.path.exists(src_path):
+        return src_path
+
+    with open(src_path, "rb") as f:
+        payload = silk_payload(f.read())
+    if payload is None:
+        return src_path
+
+    dest_path = os.path.splitext(src_path)[0] + ".mp3"
+    try:
+        encode_pcm_to_mp3(decode_silk(payload), dest_path)
+        if remove_src and os.path.exists(dest_path) and dest_path != src_path:
+            os.remove(src_path)
+        return dest_path
+    except Exception as e:
+        logging.error(f"Error converting silk {src_path}: {e}")
+        return src_path
+
+
+def _ffmpeg_to_mp3(pairs):
+    """One ffmpeg invocation converting every (src, dest) pair."""
+    cmd = ["ffmpeg", "-y", "-loglevel", "error"]
+    for src, _ in pairs:
+        cmd += ["-i", src]
+    for i, (_, dest) in enumerate(pairs):
+        cmd += ["-map", f"{i}:a", dest]
+    subprocess.run(cmd, check=True)
+
+
+class TranscodeBatch:
+    """
+    Queues AMR (or any ffmpeg-readable) clips and converts them to MP3 in
+    batches. A failed batch is retried clip by clip so one corrupt file does
+    not fail its neighbours.
+    """
+
+    def __init__(self, batch_size=None, remove_src=True):
+        self.batch_size = batch_size or FFMPEG_BATCH_SIZE
+        self.remove_src = remove_src
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, src_path, dest_path=None):
+        """Queue one clip; dest defaults to the same name with a .mp3 extension."""
+        dest_path = dest_path or os.path.splitext(src_path)[0] + ".mp3"
+        self.pending.append((src_path, dest_path))
+
+    def flush(self):
+        """Converts everything queued; returns [(src, dest or None)] in queue order."""
+        results = []
+        pending, self.pending = self.pending, []
+        for i in range(0, len(pending), self.batch_size):
+            results.extend(self._convert(pending[i:i + self.batch_size]))
+        return results
+
+    def _convert(self, pairs):
+        try:
+            _ffmpeg_to_mp3(pairs)
+            done = {src for src, dest in pairs if os.path.exists(dest)}
+        except Exception as e:
+            if len(pairs) == 1:
+                logging.error(f"Error converting audio {pairs[0][0]}: {e}")
+                return [(pairs[0][0], None)]
+            results = []
+            for pair in pairs:
+                results.extend(self._convert([pair]))
+            return results
+        results = []
+        for src, dest in pairs:
+            if src in done:
+                if self.remove_src and dest != src:
+                    os.remove(src)
+                results.append((src, dest))
+            else:
+                results.append((src, None))
+        return results
+
+
+def transcode_amr_batch(paths):
+    """MediaStore.place_many convert_batch: the AMR clips among `paths` to MP3 ({amr: mp3 or None})."""
+    batch = TranscodeBatch()
+    for path in paths:
+        if path.lower().endswith(".amr"):
+            batch.add(path)
+    return dict(batch.flush())
+
+
+def convert_amr_to_mp3(src_path, dest_path=None, remove_src=True):
+    """Single-clip convenience wrapper; returns the MP3 path, or None on failure."""
+    if not os.path.exists(src_path):
+        return None
+    batch = TranscodeBatch(batch_size=1, remove_src=remove_src)
+    batch.add(src_path, dest_path)
+    return batch.flush()[0][1]
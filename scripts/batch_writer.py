@@ -0,0 +1,85 @@
+"""
+Batched Row Writer
+------------------
+Shared insert path for the group parsers. Rows are buffered per target table
+and flushed with `executemany` in batches, each batch in its own transaction.
+Features:
+1. One buffer per (table, statement) so INSERT and upsert statements can mix.
+2. Batch size defaults to BATCH_SIZE (env var, default 5000).
+3. Per-table rows/sec report at the end of a run.
+
+Usage:
+    writer = BatchWriter(conn)
+    writer.add("group8_raw_messages", "INSERT OR IGNORE INTO ... VALUES (?, ?)", row)
+    writer.close()  # flushes and logs the report
+
+Rows for different statements are flushed independently. Callers that depend
+on ordering between two statements (e.g. an upsert after an insert into the
+same table) must call `flush()` between the two phases.
+"""
+
+import logging
+import os
+import time
+
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "5000"))
+
+
+class BatchWriter:
+    def __init__(self, conn, batch_size=None):
+        self.conn = conn
+        self.batch_size = batch_size or BATCH_SIZE
+        # (table, sql) -> list of row tuples, in first-use order
+        self.buffers = {}
+        # table -> [rows, seconds]
+        self.stats = {}
+        self.started = time.perf_counter()
+
+    def add(self, table, sql, row):
+        """Queue one row; flushes that statement's buffer once it is full."""
+        key = (table, sql)
+        buf = self.buffers.setdefault(key, [])
+        buf.append(row)
+        if len(buf) >= self.batch_size:
+            self._flush_key(key)
+
+    def add_many(self, table, sql, rows):
+        """Queue an iterable of rows for the same statement."""
+        for row in rows:
+            self.add(table, sql, row)
+
+    def _flush_key(self, key):
+        rows = self.buffers.get(key)
+        if not rows:
+            return
+        table, sql = key
+        start = time.perf_counter()
+        with self.conn:
+            self.conn.executemany(sql, rows)
+        elapsed = time.perf_counter() - start
+        stat = self.stats.setdefault(table, [0, 0.0])
+        stat[0] += len(rows)
+        stat[1] += elapsed
+        self.buffers[key] = []
+
+    def flush(self, table=None):
+        """Flush pending rows (for one table, or all) in first-use order."""
+        for key in list(self.buffers):
+            if table is None or key[0] == table:
+                self._flush_key(key)
+
+    def report(self):
+        """Log rows written and rows/sec per table."""
+        wall = time.perf_counter() - self.started
+        for table, (rows, seconds) in sorted(self.stats.items()):
+            rate = rows / seconds if seconds else float(rows)
+            logging.info(
+                f"Writer: {table}: {rows} rows in {seconds:.2f}s "
+                f"({rate:,.0f} rows/sec)"
+            )
+        logging.info(f"Writer: total wall time {wall:.2f}s")
+
+    def close(self):
+        """Flush everything and log the per-table report."""
+        self.flush()
+        self.report()
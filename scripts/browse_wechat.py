@@ -1,10 +1,11 @@
 import os
-import sqlite3
 import subprocess
 from rich.console import Console
 from rich.table import Table
 from rich.prompt import Prompt, IntPrompt
 
+from db import get_connection
+
 # Configuration
 DB_PATH = "data/db/database.sqlite"
 MEDIA_DIR = "data/media"
@@ -13,24 +14,26 @@ console = Console()
 
 
 def get_db_connection():
-    return sqlite3.connect(DB_PATH)
+    # Pooled: reused by every menu action instead of reopened
+    return get_connection(DB_PATH)
 
 
 def list_contacts():
     conn = get_db_connection()
     cursor = conn.cursor()
-    # Join with some message counts to find active contacts
+    # Count messages per username in one index scan, then attach the contacts
+    # (only contacts with messages are listed)
     query = """
-        SELECT c.username, c.nickname, COUNT(m.username) as msg_count
-        FROM wechat_raw_contacts c
-        LEFT JOIN wechat_raw_messages m ON c.username = m.username
-        GROUP BY c.username
-        HAVING msg_count > 0
-        ORDER BY msg_count DESC
+        SELECT c.username, c.nickname, m.msg_count
+        FROM (
+            SELECT username, COUNT(*) AS msg_count
+            FROM wechat_raw_messages GROUP BY username
+        ) m
+        JOIN wechat_raw_contacts c ON c.username = m.username
+        ORDER BY m.msg_count DESC
     """
     cursor.execute(query)
     contacts = cursor.fetchall()
-    conn.close()
 
     table = Table(title="WeChat Contacts")
     table.add_column("ID", justify="right", style="cyan", no_wrap=True)
@@ -53,7 +56,6 @@ def show_contact_info(username, nickname):
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM wechat_raw_contacts WHERE username = ?", (username,))
     row = cursor.fetchone()
-    conn.close()
 
     console.print(f"\n[bold cyan]--- Contact Info: {nickname} ---[/bold cyan]")
     if row:
@@ -76,7 +78,6 @@ def list_and_open_media(username, mtype):
         (username, mtype),
     )
     rows = cursor.fetchall()
-    conn.close()
 
     if not rows:
         console.print(f"[yellow]No {mtype} files found for this contact.[/yellow]")
@@ -0,0 +1,261 @@
+"""
+Image Captioning
+----------------
+Vision-model captions for WeChat images (wechat_raw_media, type 'image'),
+stored in `image_captions` (migration 005_image_captions.sql) and picked up by
+process_wechat_media.py.
+Features:
+1. Images are downscaled (longest side CAPTION_MAX_SIDE, JPEG) before being
+   base64-encoded for Ollama; JPEGs are decoded at reduced size directly.
+2. A bounded pool of concurrent requests (VISION_CONCURRENCY) over reused
+   keep-alive HTTP sessions.
+3. Incremental: images with a caption row are skipped and rows are committed
+   every CHECKPOINT_EVERY images, so an interrupted run loses little work.
+   Failed requests leave no row and are retried on the next run.
+4. Near-duplicates are captioned once: variants of one picture (.pic_thum,
+   .pic_hd, ...) are grouped and the largest is captioned first; the others
+   reuse its caption when their perceptual hash (dHash) is within
+   NEAR_DUP_BITS. Any image whose hash exactly matches an already captioned
+   one reuses that caption too.
+
+Usage:
+    python scripts/caption_images.py
+    python scripts/caption_images.py --concurrency 4 --limit 1000
+"""
+
+import argparse
+import base64
+import io
+import logging
+import os
+import re
+import threading
+
+import requests
+from dotenv import load_dotenv
+
+from db import close_all, get_connection
+from llm_client import http_session, run_ordered
+from migrate_db import migrate
+
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+load_dotenv()
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+DB_PATH = "data/db/database.sqlite"
+WECHAT_MEDIA_DIR = "data/media"
+
+OLLAMA_API = os.getenv("OLLAMA_API", "http://localhost:11434/api/generate")
+VISION_MODEL = os.getenv("VISION_MODEL", "llava:7b")
+VISION_PROMPT = "Describe this image in one short sentence in English."
+VISION_CONCURRENCY = int(os.getenv("VISION_CONCURRENCY", "2"))
+VISION_TIMEOUT = 120
+CAPTION_MAX_SIDE = 512
+JPEG_QUALITY = 85
+# dHash bits that may differ between variants of the same picture
+NEAR_DUP_BITS = 6
+CHECKPOINT_EVERY = 50
+
+# WeChat iOS keeps several renditions of one picture side by side
+VARIANT_RE = re.compile(r"\.(pic|pic_hd|pic_thum|pic_mid|pic_cmid)$", re.IGNORECASE)
+
+PENDING_SQL = """
+SELECT m.relative_path, m.original_path, m.username, m.file_size
+FROM wechat_raw_media m
+LEFT JOIN image_captions c ON c.relative_path = m.relative_path
+WHERE m.type = 'image' AND m.relative_path IS NOT NULL AND c.relative_path IS NULL
+"""
+INSERT_SQL = """
+INSERT OR REPLACE INTO image_captions
+    (relative_path, phash, info, description, model, duplicate_of)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def dhash(img):
+    """64-bit difference hash as 16 hex digits: adjacent-pixel gradients of a 9x8 grayscale."""
+    small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def hamming(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def prepare_image(abs_path, max_side=CAPTION_MAX_SIDE):
+    """
+    Decodes and downscales one image.
+    Returns (info, phash, base64 JPEG), or (info, None, None) if it can't be decoded.
+    """
+    try:
+        filesize = os.path.getsize(abs_path)
+        with Image.open(abs_path) as img:
+            width, height = img.size
+            info = f"{filesize/1024:.1f}KB, {width}x{height}"
+            # JPEG: let the decoder scale down (much cheaper than a full decode)
+            img.draft("RGB", (max_side, max_side))
+            img = img.convert("RGB")
+            img.thumbnail((max_side, max_side))
+            buffer = io.BytesIO()
+            img.save(buffer, "JPEG", quality=JPEG_QUALITY)
+            return info, dhash(img), base64.b64encode(buffer.getvalue()).decode("ascii")
+    except Exception:
+        return "unknown size", None, None
+
+
+def describe(image_b64):
+    """One caption from the vision model; raises on failure."""
+    payload = {
+        "model": VISION_MODEL,
+        "prompt": VISION_PROMPT,
+        "stream": False,
+        "images": [image_b64],
+    }
+    response = http_session().post(OLLAMA_API, json=payload, timeout=VISION_TIMEOUT)
+    response.raise_for_status()
+    return response.json().get("response", "").strip()
+
+
+def variant_groups(rows):
+    """Pending images grouped by picture (variant suffix stripped), largest file first."""
+    groups = {}
+    for rel_path, original_path, username, file_size in rows:
+        stem = VARIANT_RE.sub("", original_path or rel_path)
+        groups.setdefault((username, stem), []).append((rel_path, file_size or 0))
+    return [
+        sorted(members, key=lambda m: -m[1])
+        for _, members in sorted(groups.items(), key=lambda g: (g[0][0] or "", g[0][1]))
+    ]
+
+
+class Captioner:
+    """Captions variant groups; shared across the worker threads of one run."""
+
+    def __init__(self, known, media_dir=WECHAT_MEDIA_DIR, max_side=CAPTION_MAX_SIDE):
+        # phash -> (relative_path, description) of captioned images
+        self.known = known
+        self.media_dir = media_dir
+        self.max_side = max_side
+        self.lock = threading.Lock()
+
+    def caption_group(self, members):
+        """Returns INSERT_SQL rows for the members captioned (or matched) successfully."""
+        rows, captioned = [], []
+        for rel_path, _ in members:
+            abs_path = os.path.join(self.media_dir, rel_path)
+            if not os.path.exists(abs_path):
+                continue
+            info, phash, image_b64 = prepare_image(abs_path, self.max_side)
+            if phash is None:
+                # Undecodable: recorded without caption so it isn't retried
+                rows.append((rel_path, None, info, "", None, None))
+                continue
+            match = self._match(phash, captioned)
+            if match:
+                source, description = match
+                captioned.append((phash, source, description))
+                rows.append((rel_path, phash, info, description, VISION_MODEL, source))
+                continue
+            try:
+                description = describe(image_b64)
+            except (requests.RequestException, ValueError) as e:
+                logging.error(f"Error getting image description for {rel_path}: {e}")
+                continue
+            captioned.append((phash, rel_path, description))
+            with self.lock:
+                self.known.setdefault(phash, (rel_path, description))
+            rows.append((rel_path, phash, info, description, VISION_MODEL, None))
+        return rows
+
+    def _match(self, phash, captioned):
+        """(source path, description) of an equivalent captioned image, or None."""
+        for other_hash, rel_path, description in captioned:
+            if hamming(phash, other_hash) <= NEAR_DUP_BITS:
+                return rel_path, description
+        with self.lock:
+            return self.known.get(phash)
+
+
+def known_captions(conn):
+    """phash -> (relative_path, description) of the images captioned so far."""
+    known = {}
+    for phash, rel_path, description in conn.execute(
+        "SELECT phash, relative_path, description FROM image_captions "
+        "WHERE phash IS NOT NULL AND duplicate_of IS NULL"
+    ):
+        known.setdefault(phash, (rel_path, description))
+    return known
+
+
+def caption_images(conn, concurrency=VISION_CONCURRENCY, limit=None, max_side=CAPTION_MAX_SIDE):
+    """Captions every image without a caption row. Returns (captioned, reused) counts."""
+    if not HAS_PIL:
+        logging.warning("Pillow not installed, skipping image captioning.")
+        return 0, 0
+    migrate(conn)
+    rows = conn.execute(PENDING_SQL).fetchall()
+    groups = variant_groups(rows)
+    if limit:
+        groups = groups[:limit]
+    if not groups:
+        return 0, 0
+
+    captioner = Captioner(known_captions(conn), max_side=max_side)
+
+    logging.info(
+        f"Captioning {sum(len(g) for g in groups)} images in {len(groups)} groups "
+        f"({concurrency} requests in flight)..."
+    )
+    captioned = reused = 0
+    # Worker threads caption; this thread is the single DB writer
+    for i, _, result in run_ordered(captioner.caption_group, groups, concurrency):
+        conn.executemany(INSERT_SQL, result)
+        captioned += sum(1 for r in result if r[1] and not r[5])
+        reused += sum(1 for r in result if r[5])
+        if (i + 1) % CHECKPOINT_EVERY == 0:
+            conn.commit()
+            logging.info(f"Progress: {i + 1}/{len(groups)} groups, {captioned} captioned, {reused} reused")
+    conn.commit()
+    logging.info(f"Captioning done: {captioned} captioned, {reused} reused.")
+    return captioned, reused
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caption WeChat images with a vision model.")
+    parser.add_argument(
+        "--concurrency", type=int, default=VISION_CONCURRENCY,
+        help="Maximum vision requests in flight.",
+    )
+    parser.add_argument("--limit", type=int, help="Only this many pictures (variant groups).")
+    parser.add_argument(
+        "--max-side", type=int, default=CAPTION_MAX_SIDE,
+        help="Longest side in pixels of the image sent to the model.",
+    )
+    parser.add_argument("--db", default=DB_PATH, help="Main database.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        logging.info(f"Database not found: {args.db}")
+        return
+    try:
+        caption_images(get_connection(args.db), args.concurrency, args.limit, args.max_side)
+    finally:
+        close_all()
+
+
+if __name__ == "__main__":
+    main()
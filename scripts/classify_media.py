@@ -0,0 +1,353 @@
+"""
+Media Classification Pass
+-------------------------
+Identifies media files by content (magic numbers) across a whole directory
+tree and fixes their extensions in one batch, instead of sniffing and
+renaming one file at a time inside the parsers' copy loops.
+Features:
+1. The tree is walked with `os.scandir` (no per-file stat); headers are read
+   on a thread pool in batches of HEADER_BATCH files, so slow storage is read
+   in parallel while the main thread only walks and plans.
+2. Formats come from one table of magic numbers (MAGIC): JPEG, PNG, GIF,
+   WebP, HEIC, MP4/QuickTime, AMR and Silk v3 (with or without WeChat's 0x02
+   prefix).
+3. A rename plan is built first: a file whose extension doesn't match its
+   content gets the right one (WeChat's .pic*/.dftemp/.video_thum/.dat and
+   wrong media extensions are replaced, anything else is kept and the new
+   extension appended). Names already taken are reported, never overwritten.
+   The blob store folders (media_store) are skipped.
+4. The plan can be written to a TSV file, reviewed, and applied later; it is
+   applied in one batch, together with one transaction per database updating
+   the stored paths: the main DB (`--db`, `--column TABLE.COLUMN`; media,
+   message and caption paths by default) and the per-group raw DBs
+   (`--raw-db-dir`, the paths of every *_raw_media table). Re-applying a
+   plan is harmless: renames already done are recognised.
+   Without --raw-db-dir, run the pass before merge_dbs.py: a later merge or
+   rebuild from the raw DBs would bring the old paths back.
+
+Usage:
+    python scripts/classify_media.py data/media/wechat_media
+    python scripts/classify_media.py data/media/wechat_media --plan renames.tsv
+    python scripts/classify_media.py data/media/wechat_media --apply \
+        --db data/db/database.sqlite --raw-db-dir data/db/raw
+    python scripts/classify_media.py data/media/wechat_media --from-plan renames.tsv --apply
+"""
+
+import argparse
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from db import get_connection, transaction
+from media_store import BLOB_DIR, STAGING_DIR
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+HEADER_SIZE = 16
+HEADER_BATCH = 256
+WORKERS = 16
+
+# (format, extension, ((offset, bytes), ...)); first match wins, so the
+# specific ftyp brands come before the generic MP4 entry
+HEIC_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1")
+MAGIC = (
+    ("jpeg", ".jpg", ((0, b"\xff\xd8\xff"),)),
+    ("png", ".png", ((0, b"\x89PNG\r\n\x1a\n"),)),
+    ("gif", ".gif", ((0, b"GIF87a"),)),
+    ("gif", ".gif", ((0, b"GIF89a"),)),
+    ("webp", ".webp", ((0, b"RIFF"), (8, b"WEBP"))),
+    *(("heic", ".heic", ((4, b"ftyp" + brand),)) for brand in HEIC_BRANDS),
+    ("mp4", ".mp4", ((4, b"ftyp"),)),
+    ("amr", ".amr", ((0, b"#!AMR"),)),
+    ("silk", ".silk", ((0, b"#!SILK_V3"),)),
+    ("silk", ".silk", ((0, b"\x02#!SILK_V3"),)),
+)
+
+# Extensions that already name the format correctly
+FORMAT_EXTS = {
+    "jpeg": {".jpg", ".jpeg"},
+    "png": {".png"},
+    "gif": {".gif"},
+    "webp": {".webp"},
+    "heic": {".heic", ".heif"},
+    "mp4": {".mp4", ".m4v", ".m4a", ".mov", ".3gp"},
+    "amr": {".amr"},
+    # WeChat stores Silk voice clips as .aud; audio_transcode reads both
+    "silk": {".silk", ".slk", ".aud"},
+}
+# Extensions replaced (rather than appended to) when they don't match
+REPLACEABLE_EXTS = {
+    ".pic", ".pic_hd", ".pic_thum", ".pic_mid", ".pic_cmid", ".dftemp", ".video_thum", ".dat",
+    *(ext for exts in FORMAT_EXTS.values() for ext in exts),
+}
+
+# Columns holding media paths (relative to --base) in the main database;
+# image_captions is keyed by path, so stale rows would be captioned again
+PATH_COLUMNS = (
+    "wechat_raw_media.relative_path",
+    "wechat_raw_messages.media_path",
+    "image_captions.relative_path",
+    "image_captions.duplicate_of",
+)
+# The same columns in the per-group raw DBs (group4_raw_media, ...)
+RAW_PATH_COLUMNS = (("_raw_media", "relative_path"), ("_raw_messages", "media_path"))
+RAW_DB_DIR = "data/db/raw"
+
+
+def sniff(header):
+    """(format, extension) of a file header, or None if no magic number matches."""
+    for fmt, ext, signature in MAGIC:
+        if all(header[offset:offset + len(magic)] == magic for offset, magic in signature):
+            return fmt, ext
+    return None
+
+
+def read_headers(paths):
+    """[(path, header bytes or None)] for a batch; runs on the pool."""
+    results = []
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                results.append((path, f.read(HEADER_SIZE)))
+        except OSError as e:
+            logging.warning(f"Cannot read {path}: {e}")
+            results.append((path, None))
+    return results
+
+
+def iter_files(root, skip=(BLOB_DIR, STAGING_DIR)):
+    """Paths of the regular files under root (symlinks not followed), top-level `skip` folders excluded."""
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not (folder == root and entry.name in skip):
+                            stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.path
+        except OSError as e:
+            logging.warning(f"Cannot scan {folder}: {e}")
+
+
+def iter_classified(paths, workers=WORKERS):
+    """Yields (path, (format, ext) or None), reading headers on `workers` threads."""
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        exhausted = False
+        while True:
+            # Keep a bounded window of batches queued ahead of the consumer
+            while not exhausted and len(in_flight) < workers * 2:
+                batch = [p for _, p in zip(range(HEADER_BATCH), paths)]
+                if not batch:
+                    exhausted = True
+                    break
+                in_flight.add(pool.submit(read_headers, batch))
+            if not in_flight:
+                return
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                for path, header in future.result():
+                    yield path, sniff(header) if header else None
+
+
+def target_name(path, ext):
+    """`path` renamed for extension `ext`, or None if its extension already fits."""
+    stem, current = os.path.splitext(path)
+    fmt_exts = next(exts for exts in FORMAT_EXTS.values() if ext in exts)
+    if current.lower() in fmt_exts:
+        return None
+    if current.lower() in REPLACEABLE_EXTS or not current:
+        return stem + ext
+    return path + ext
+
+
+def build_plan(root, workers=WORKERS):
+    """
+    Classifies every file under root.
+    Returns (plan, counts): plan is [(format, src, dest)] with paths relative
+    to root; counts tallies formats plus 'ok', 'rename' and 'conflict'.
+    """
+    counts = Counter()
+    plan, claimed = [], set()
+    # Scanned paths all start with this (cheaper than os.path.relpath per file)
+    prefix = len(os.path.join(root, ""))
+    start = time.perf_counter()
+    for i, (path, match) in enumerate(iter_classified(iter_files(root), workers), 1):
+        if i % 100000 == 0:
+            logging.info(f"Classified {i} files ({i / (time.perf_counter() - start):.0f}/s)...")
+        if match is None:
+            counts["unknown"] += 1
+            continue
+        fmt, ext = match
+        counts[fmt] += 1
+        dest = target_name(path, ext)
+        if dest is None:
+            counts["ok"] += 1
+        elif dest in claimed or os.path.lexists(dest):
+            counts["conflict"] += 1
+            logging.warning(f"Not renaming {path}: {dest} already exists")
+        else:
+            claimed.add(dest)
+            counts["rename"] += 1
+            plan.append((fmt, path[prefix:], dest[prefix:]))
+    elapsed = time.perf_counter() - start
+    total = sum(counts[fmt] for fmt in FORMAT_EXTS) + counts["unknown"]
+    logging.info(f"Classified {total} files in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s).")
+    return plan, counts
+
+
+def write_plan(plan, plan_path):
+    with open(plan_path, "w", encoding="utf-8") as f:
+        for fmt, src, dest in plan:
+            f.write(f"{fmt}\t{src}\t{dest}\n")
+
+
+def read_plan(plan_path):
+    with open(plan_path, encoding="utf-8") as f:
+        return [tuple(line.rstrip("\n").split("\t")) for line in f if line.strip()]
+
+
+def update_paths(db_path, pairs, columns):
+    """Rewrites (new, old) path pairs in `columns` (TABLE.COLUMN) of one DB, in one transaction."""
+    tables = {
+        r[0] for r in get_connection(db_path).execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+    with transaction(db_path) as conn:
+        for column in columns:
+            table, name = column.split(".")
+            if table not in tables:
+                logging.info(f"Skipping {column}: no such table in {db_path}")
+                continue
+            before = conn.total_changes
+            # OR REPLACE: a stale row already at the new path (e.g. a caption
+            # keyed by it) gives way instead of aborting the batch
+            conn.executemany(f"UPDATE OR REPLACE {table} SET {name} = ? WHERE {name} = ?", pairs)
+            logging.info(f"{db_path}: updated {conn.total_changes - before} rows of {column}.")
+
+
+def raw_path_columns(db_path):
+    """TABLE.COLUMN media path columns present in a per-group raw DB."""
+    tables = [
+        r[0] for r in get_connection(db_path).execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    ]
+    conn = get_connection(db_path)
+    return [
+        f"{table}.{column}"
+        for suffix, column in RAW_PATH_COLUMNS
+        for table in tables
+        if table.endswith(suffix)
+        and column in {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+    ]
+
+
+def apply_plan(root, plan, db_path=None, base=None, columns=PATH_COLUMNS, raw_db_dir=None):
+    """
+    Renames every planned file, then updates the stored paths (relative to
+    `base`, default root) in the main DB and in every raw DB of `raw_db_dir`,
+    one transaction per DB. Returns (renamed, skipped).
+    """
+    done, skipped = [], 0
+    for _, src, dest in plan:
+        src_abs, dest_abs = os.path.join(root, src), os.path.join(root, dest)
+        if not os.path.lexists(src_abs) and os.path.lexists(dest_abs):
+            # Renamed by an earlier (interrupted) apply
+            done.append((src_abs, dest_abs))
+            continue
+        if os.path.lexists(dest_abs):
+            logging.warning(f"Not renaming {src}: {dest} already exists")
+            skipped += 1
+            continue
+        try:
+            os.rename(src_abs, dest_abs)
+            done.append((src_abs, dest_abs))
+        except OSError as e:
+            logging.error(f"Error renaming {src}: {e}")
+            skipped += 1
+
+    if not done:
+        return 0, skipped
+    base = base or root
+    pairs = [
+        (os.path.relpath(dest_abs, base), os.path.relpath(src_abs, base))
+        for src_abs, dest_abs in done
+    ]
+    if db_path:
+        update_paths(db_path, pairs, columns)
+    if raw_db_dir:
+        for name in sorted(os.listdir(raw_db_dir)):
+            if name.endswith(".sqlite"):
+                raw_path = os.path.join(raw_db_dir, name)
+                update_paths(raw_path, pairs, raw_path_columns(raw_path))
+    return len(done), skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fix media file extensions from their content.")
+    parser.add_argument("root", help="Media directory to scan (e.g. data/media/wechat_media).")
+    parser.add_argument("--plan", help="Write the rename plan to this TSV file.")
+    parser.add_argument("--from-plan", help="Use a saved plan instead of scanning.")
+    parser.add_argument("--apply", action="store_true", help="Rename the files (default: report only).")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Threads reading headers.")
+    parser.add_argument("--db", help="Database whose stored paths are updated with the renames.")
+    parser.add_argument(
+        "--column", action="append", dest="columns",
+        help=f"TABLE.COLUMN holding media paths (repeatable; default: {', '.join(PATH_COLUMNS)}).",
+    )
+    parser.add_argument(
+        "--raw-db-dir", nargs="?", const=RAW_DB_DIR,
+        help=f"Also update the per-group raw DBs in this folder (default: {RAW_DB_DIR}).",
+    )
+    parser.add_argument("--base", help="Directory the stored paths are relative to (default: root).")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        logging.error(f"Directory not found: {args.root}")
+        return
+
+    if args.from_plan:
+        plan = read_plan(args.from_plan)
+        logging.info(f"Loaded {len(plan)} planned renames from {args.from_plan}.")
+    else:
+        plan, counts = build_plan(args.root, max(args.workers, 1))
+        formats = ", ".join(f"{fmt}: {counts[fmt]}" for fmt in (*FORMAT_EXTS, "unknown") if counts[fmt])
+        logging.info(f"Formats: {formats or 'none'}")
+        logging.info(
+            f"{counts['ok']} named correctly, {counts['rename']} to rename, "
+            f"{counts['conflict']} conflicts."
+        )
+    if args.plan:
+        write_plan(plan, args.plan)
+        logging.info(f"Plan written to {args.plan}.")
+    if not args.apply:
+        for fmt, src, dest in plan[:20]:
+            logging.info(f"  {src} -> {dest} ({fmt})")
+        if len(plan) > 20:
+            logging.info(f"  ... {len(plan) - 20} more (use --plan to save them all)")
+        return
+
+    renamed, skipped = apply_plan(
+        args.root, plan, args.db, args.base, args.columns or PATH_COLUMNS, args.raw_db_dir
+    )
+    logging.info(f"Renamed {renamed} files, skipped {skipped}.")
+    if renamed and not args.raw_db_dir:
+        logging.warning(
+            "Raw DBs were not updated (--raw-db-dir): a merge or rebuild from them "
+            "brings the old paths back."
+        )
+
+
+if __name__ == "__main__":
+    main()
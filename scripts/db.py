@@ -0,0 +1,124 @@
+"""
+Database Connections
+--------------------
+Shared access to the SQLite databases for the scripts: connections are opened
+once per thread and tuned, instead of every helper opening its own.
+Features:
+1. `get_connection(path)` returns the calling thread's connection to `path`,
+   opened on first use and reused afterwards (one pool per thread, keyed by
+   path). `close_all()` closes every pooled connection; it also runs at exit.
+2. Every connection is configured for this workload: WAL journal (readers
+   don't block the writer), synchronous=NORMAL (no fsync per commit, only at
+   checkpoints), a CACHE_SIZE_MB page cache, MMAP_SIZE_MB of memory-mapped
+   I/O, temp_store=MEMORY for sorts and temp indexes, and a busy timeout.
+3. Prepared statements: connections keep STATEMENT_CACHE compiled statements
+   keyed by SQL text, so `query`, `query_one`, `execute` and `executemany`
+   compile a constant SQL string once per connection and re-bind it.
+4. `transaction(path)` runs a block in one write transaction (BEGIN
+   IMMEDIATE): committed on success, rolled back on error.
+
+Usage:
+    from db import get_connection, query, transaction
+
+    rows = query("SELECT id, name FROM persons WHERE name LIKE ?", ("%Li%",))
+    with transaction() as conn:
+        conn.executemany("UPDATE persons SET notes = ? WHERE id = ?", updates)
+"""
+
+import atexit
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = "data/db/database.sqlite"
+
+CACHE_SIZE_MB = 64
+MMAP_SIZE_MB = 256
+BUSY_TIMEOUT = 30  # seconds to wait for another writer's lock
+STATEMENT_CACHE = 256
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{CACHE_SIZE_MB * 1024}",  # negative: KiB, not pages
+    f"PRAGMA mmap_size={MMAP_SIZE_MB * 1024 * 1024}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+_local = threading.local()
+_open = []
+_open_lock = threading.Lock()
+
+
+def connect(path=DB_PATH):
+    """A new tuned connection (not pooled); the caller closes it."""
+    conn = sqlite3.connect(
+        path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE,
+        # Pooled connections are only used by their thread; close_all may run on another
+        check_same_thread=False,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection(path=DB_PATH):
+    """The calling thread's connection to `path` (opened on first use)."""
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = {}
+    conn = pool.get(path)
+    if conn is None:
+        conn = pool[path] = connect(path)
+        with _open_lock:
+            _open.append((pool, path, conn))
+    return conn
+
+
+def close_all():
+    """Closes the pooled connections of every thread (uncommitted changes are lost)."""
+    with _open_lock:
+        for pool, path, conn in _open:
+            pool.pop(path, None)
+            conn.close()
+        _open.clear()
+
+
+atexit.register(close_all)
+
+
+def query(sql, params=(), path=DB_PATH):
+    """All rows of a read."""
+    return get_connection(path).execute(sql, params).fetchall()
+
+
+def query_one(sql, params=(), path=DB_PATH):
+    """The first row of a read, or None."""
+    return get_connection(path).execute(sql, params).fetchone()
+
+
+def execute(sql, params=(), path=DB_PATH):
+    """Runs one statement in its own transaction; returns the cursor (rowcount, lastrowid)."""
+    conn = get_connection(path)
+    with conn:
+        return conn.execute(sql, params)
+
+
+def executemany(sql, rows, path=DB_PATH):
+    """Runs one statement for every parameter row in a single transaction."""
+    conn = get_connection(path)
+    with conn:
+        return conn.executemany(sql, rows)
+
+
+@contextmanager
+def transaction(path=DB_PATH):
+    """The thread's connection inside BEGIN IMMEDIATE ... COMMIT (ROLLBACK on error)."""
+    conn = get_connection(path)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
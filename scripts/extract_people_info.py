@@ -1,21 +1,28 @@
 import os
-import json
-import sqlite3
+import re
 import argparse
-import requests
 from dotenv import load_dotenv
 
-load_dotenv()
+from db import close_all, get_connection
+# LLM server configuration (LLM_API_BASE, LLM_MODEL, ...) lives in llm_client
+from llm_client import LLM_CONCURRENCY, LLMError, chat_json, disable_cache, run_ordered
+from people_writer import PeopleWriter
 
-# Configuration for Local LLM (OpenAI-compatible API)
-LLM_API_BASE = os.getenv(
-    "LLM_API_BASE", "http://localhost:11434/v1"
-)  # Default to Ollama
-LLM_API_KEY = os.getenv("LLM_API_KEY", "ollama")
-MODEL_NAME = os.getenv("LLM_MODEL", "llama3")
+load_dotenv()
 
 DB_PATH = "data/db/database.sqlite"
 
+# Part of the LLM response cache key: bump when PROMPT_TEMPLATE changes meaning
+PROMPT_VERSION = "1"
+
+# Chunk budget in estimated tokens (text only, the prompt template comes on top)
+CHUNK_TOKENS = 1500
+OVERLAP_TOKENS = 150
+CJK_RE = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+SENTENCE_END_RE = r"(?<=[。！？!?.;；])\s*"
+
 PROMPT_TEMPLATE = """
 Extract information about people from the following text and return it as a JSON object with "people" and "relationships" keys.
 
@@ -94,250 +101,94 @@ Text to extract from:
 
 
 def query_llm(text):
-    payload = {
-        "model": MODEL_NAME,
-        "messages": [
-            {
-                "role": "system",
-                "content": "You are a helpful assistant that extracts structured data from text into JSON format.",
-            },
-            {"role": "user", "content": PROMPT_TEMPLATE.format(text=text)},
-        ],
-        "temperature": 0.1,
-        "response_format": {"type": "json_object"},
-    }
-
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a helpful assistant that extracts structured data from text into JSON format.",
+        },
+        {"role": "user", "content": PROMPT_TEMPLATE.format(text=text)},
+    ]
     try:
-        response = requests.post(
-            f"{LLM_API_BASE}/chat/completions",
-            headers={"Authorization": f"Bearer {LLM_API_KEY}"},
-            json=payload,
-        )
-        response.raise_for_status()
-        content = response.json()["choices"][0]["message"]["content"]
-        # Some LLMs might wrap JSON in markdown blocks
-        if content.startswith("```json"):
-            content = content.split("```json")[1].split("```")[0].strip()
-        elif content.startswith("```"):
-            content = content.split("```")[1].split("```")[0].strip()
-
-        data = json.loads(content)
-        return data
-    except Exception as e:
+        return chat_json(messages, temperature=0.1, template_version=PROMPT_VERSION)
+    except LLMError as e:
         print(f"Error querying LLM: {e}")
         return {}
 
 
-def insert_into_db(data):
-    people_data = data.get("people", [])
-    relationships_data = data.get("relationships", [])
-
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    name_to_id = {}
-
-    for person in people_data:
-        try:
-            name = person.get("name") or person.get("display_name")
-            if not name:
-                print(f"Skipping entry with no name: {person}")
-                continue
-
-            def to_str(val):
-                if val is None:
-                    return None
-                if isinstance(val, (list, dict)):
-                    return json.dumps(val)
-                s = str(val).strip()
-                return s if s else None
-
-            # Insert into persons
-            cursor.execute(
-                """
-                INSERT INTO persons (name, title, display_name, nick_name, other_names, gender, birthdate, brief, origins, ethnicity, notes)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-                (
-                    name,
-                    to_str(person.get("title")),
-                    to_str(person.get("display_name")),
-                    to_str(person.get("nick_name")),
-                    to_str(person.get("other_names")),
-                    to_str(person.get("gender")),
-                    to_str(person.get("birthdate")),
-                    to_str(person.get("brief")),
-                    to_str(person.get("origins")),
-                    to_str(person.get("ethnicity")),
-                    to_str(person.get("notes")),
-                ),
-            )
-            person_id = cursor.lastrowid
-            name_to_id[name] = person_id
-
-            # Insert contacts
-            for contact in person.get("contacts", []):
-                val = to_str(contact.get("value"))
-                if val:
-                    cursor.execute(
-                        "INSERT INTO contacts (person_id, type, value) VALUES (?, ?, ?)",
-                        (person_id, contact.get("type"), val),
-                    )
-
-            # Insert positions
-            for pos in person.get("positions", []):
-                pos_name = pos.get("name")
-                if not pos_name:
-                    continue
-
-                cursor.execute(
-                    "INSERT OR IGNORE INTO positions (name) VALUES (?)", (pos_name,)
-                )
-                cursor.execute("SELECT id FROM positions WHERE name = ?", (pos_name,))
-                pos_id = cursor.fetchone()[0]
-
-                cursor.execute(
-                    """
-                    INSERT INTO person_positions (person_id, position_id, organization, notes)
-                    VALUES (?, ?, ?, ?)
-                """,
-                    (person_id, pos_id, pos.get("organization"), pos.get("notes")),
-                )
-
-            # Insert education
-            for edu in person.get("education", []):
-                cursor.execute(
-                    """
-                    INSERT INTO education (person_id, school, degree, major, start_date, end_date, notes)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
-                    (
-                        person_id,
-                        edu.get("school"),
-                        edu.get("degree"),
-                        edu.get("major"),
-                        edu.get("start_date"),
-                        edu.get("end_date"),
-                        edu.get("notes"),
-                    ),
-                )
-
-            # Insert financial info
-            for fin in person.get("financial_information", []):
-                cursor.execute(
-                    """
-                    INSERT INTO financial_information (person_id, type, country, details)
-                    VALUES (?, ?, ?, ?)
-                """,
-                    (
-                        person_id,
-                        fin.get("type"),
-                        fin.get("country"),
-                        fin.get("details"),
-                    ),
-                )
-
-            # Insert career
-            for job in person.get("career", []):
-                cursor.execute(
-                    """
-                    INSERT INTO career (person_id, company, role, start_date, end_date, notes)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                    (
-                        person_id,
-                        job.get("company"),
-                        job.get("role"),
-                        job.get("start_date"),
-                        job.get("end_date"),
-                        job.get("notes"),
-                    ),
-                )
-
-            # Insert groups
-            for grp in person.get("groups", []):
-                group_name = grp.get("name")
-                if not group_name:
-                    continue
-
-                # Check if group exists or create it
-                cursor.execute(
-                    "SELECT id FROM groups WHERE name = ? AND type = ?",
-                    (group_name, grp.get("type")),
-                )
-                row = cursor.fetchone()
-                if row:
-                    group_id = row[0]
+def estimate_tokens(text):
+    """
+    Approximate LLM token count: CJK characters are about one token each,
+    other text about four characters per token.
+    """
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _split_oversized(block, max_tokens):
+    """Splits one block that exceeds the budget: by lines, then sentences, then characters."""
+    for pattern in (r"(?<=\n)", SENTENCE_END_RE):
+        parts = [p for p in re.split(pattern, block) if p.strip()]
+        if len(parts) > 1:
+            pieces = []
+            for part in parts:
+                if estimate_tokens(part) > max_tokens:
+                    pieces.extend(_split_oversized(part, max_tokens))
                 else:
-                    cursor.execute(
-                        "INSERT INTO groups (name, type) VALUES (?, ?)",
-                        (grp.get("name"), grp.get("type")),
-                    )
-                    group_id = cursor.lastrowid
-
-                cursor.execute(
-                    "INSERT INTO person_groups (person_id, group_id, role) VALUES (?, ?, ?)",
-                    (person_id, group_id, grp.get("role")),
-                )
-
-            # Insert property
-            for prop in person.get("property", []):
-                cursor.execute(
-                    "INSERT INTO property (person_id, type, details) VALUES (?, ?, ?)",
-                    (person_id, prop.get("type"), prop.get("details")),
-                )
-
-            conn.commit()
-            print(f"Successfully inserted: {name}")
-        except Exception as e:
-            conn.rollback()
-            print(f"Error inserting {name}: {e}")
-
-    # Insert relationships
-    for rel in relationships_data:
-        try:
-            p1_name = rel.get("person1_name")
-            p2_name = rel.get("person2_name")
-            p1_id = name_to_id.get(p1_name)
-            p2_id = name_to_id.get(p2_name)
-
-            if p1_id and p2_id:
-                cursor.execute(
-                    """
-                    INSERT INTO relationships (person1_id, person2_id, type, notes)
-                    VALUES (?, ?, ?, ?)
-                """,
-                    (p1_id, p2_id, rel.get("type"), rel.get("notes")),
-                )
-                conn.commit()
-                print(
-                    f"Successfully inserted relationship: {p1_name} -> {p2_name} ({rel.get('type')})"
-                )
-        except Exception as e:
-            conn.rollback()
-            print(f"Error inserting relationship: {e}")
-
-    conn.close()
-
+                    pieces.append(part.strip())
+            return pieces
+    pieces = []
+    while block:
+        # Largest prefix within budget (binary search on the estimate)
+        lo, hi = 1, len(block)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if estimate_tokens(block[:mid]) <= max_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        pieces.append(block[:lo])
+        block = block[lo:]
+    return pieces
+
+
+def chunk_text(text, max_tokens=CHUNK_TOKENS, overlap_tokens=OVERLAP_TOKENS):
+    """
+    Packs paragraphs (blank-line separated) into chunks of at most max_tokens
+    estimated tokens. Each chunk after the first starts with the trailing
+    paragraphs of the previous one, up to overlap_tokens, so a person described
+    across a chunk boundary is seen whole at least once.
+    """
+    blocks = []
+    for block in re.split(r"\n\s*\n", text):
+        block = block.strip()
+        if not block:
+            continue
+        if estimate_tokens(block) >= max_tokens:
+            blocks.extend(_split_oversized(block, max_tokens - 1))
+        else:
+            blocks.append(block)
 
-def chunk_text(text, max_chars=4000):
-    """Simple chunking by character count, attempting to split on double newlines."""
     chunks = []
-    while text:
-        if len(text) <= max_chars:
-            chunks.append(text)
-            break
-
-        # Find the last double newline before max_chars
-        split_at = text.rfind("\n\n", 0, max_chars)
-        if split_at == -1:
-            split_at = text.rfind("\n", 0, max_chars)
-
-        if split_at == -1:
-            split_at = max_chars
-
-        chunks.append(text[:split_at].strip())
-        text = text[split_at:].strip()
+    current, current_tokens = [], 0
+    for block in blocks:
+        # +1 for the blank line joining it to the previous paragraph
+        tokens = estimate_tokens(block) + 1
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n\n".join(b for b, _ in current))
+            # Carry the tail of this chunk over, within the overlap budget
+            overlap, overlap_total = [], 0
+            for b, t in reversed(current):
+                if overlap_total + t > overlap_tokens:
+                    break
+                overlap.insert(0, (b, t))
+                overlap_total += t
+            while overlap and overlap_total + tokens > max_tokens:
+                overlap_total -= overlap.pop(0)[1]
+            current, current_tokens = overlap, overlap_total
+        current.append((block, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(b for b, _ in current))
     return chunks
 
 
@@ -347,13 +198,32 @@ def main():
     )
     parser.add_argument("file", help="Path to the text file containing people notes.")
     parser.add_argument(
-        "--chunk-size",
+        "--chunk-tokens",
+        type=int,
+        default=CHUNK_TOKENS,
+        help="Maximum estimated tokens of text per LLM request.",
+    )
+    parser.add_argument(
+        "--overlap-tokens",
+        type=int,
+        default=OVERLAP_TOKENS,
+        help="Estimated tokens repeated from the end of the previous chunk.",
+    )
+    parser.add_argument(
+        "--concurrency",
         type=int,
-        default=4000,
-        help="Maximum characters per LLM request.",
+        default=LLM_CONCURRENCY,
+        help="Maximum LLM requests in flight.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignore cached LLM responses and query the server for every chunk.",
     )
 
     args = parser.parse_args()
+    if args.no_cache:
+        disable_cache()
 
     if not os.path.exists(args.file):
         print(f"File not found: {args.file}")
@@ -362,16 +232,26 @@ def main():
     with open(args.file, "r", encoding="utf-8") as f:
         content = f.read()
 
-    chunks = chunk_text(content, args.chunk_size)
-    print(f"Processing {len(chunks)} chunks...")
+    chunks = chunk_text(content, args.chunk_tokens, args.overlap_tokens)
+    print(f"Processing {len(chunks)} chunks ({args.concurrency} in flight)...")
 
-    for i, chunk in enumerate(chunks):
-        print(f"Processing chunk {i + 1}/{len(chunks)}...")
-        extracted_data = query_llm(chunk)
-        if extracted_data:
-            insert_into_db(extracted_data)
-        else:
-            print(f"No data extracted from chunk {i + 1}")
+    # LLM calls run concurrently; this thread is the single DB writer and
+    # handles results in chunk order as they complete
+    conn = get_connection(DB_PATH)
+    writer = PeopleWriter(conn)
+    try:
+        for i, _, extracted_data in run_ordered(query_llm, chunks, args.concurrency):
+            print(f"Processing chunk {i + 1}/{len(chunks)}...")
+            if extracted_data:
+                counts = writer.write(extracted_data)
+                print(
+                    f"Chunk {i + 1}: {counts['inserted']} inserted, {counts['merged']} merged, "
+                    f"{counts['relationships']} relationships"
+                )
+            else:
+                print(f"No data extracted from chunk {i + 1}")
+    finally:
+        close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+"""
+Ingest Manifest
+---------------
+Source-file fingerprints for incremental re-ingestion of the raw group DBs.
+Each raw DB keeps an `ingest_manifest` table with one row per source file
+(path, size, mtime, content hash, parser version). A parser run skips sources
+whose fingerprint is unchanged and only deletes/re-inserts rows for sources
+that changed. Running a parser with `--full` restores delete-and-rebuild.
+Features:
+1. Cheap check first: size + mtime + parser version.
+2. Content hash (streaming md5) only when size/mtime moved, so a `touch`
+   does not trigger a re-parse.
+3. Bumping a parser's PARSER_VERSION re-ingests all of its sources.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+
+MANIFEST_SQL = """
+CREATE TABLE IF NOT EXISTS ingest_manifest (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    content_hash TEXT,
+    parser_version TEXT,
+    ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    """Streaming md5 of a file's content."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def open_output_db(output_db, schema_file=None, full=False):
+    """
+    Opens a raw group DB for writing.
+    A missing DB, or `full=True`, is (re)created from the schema file as before;
+    otherwise the existing DB and its rows are kept for incremental runs.
+    """
+    if full and os.path.exists(output_db):
+        os.remove(output_db)
+        logging.info(f"Full rebuild: deleted {output_db}")
+    os.makedirs(os.path.dirname(output_db), exist_ok=True)
+    is_new = not os.path.exists(output_db)
+    conn = sqlite3.connect(output_db)
+    if is_new and schema_file:
+        with open(schema_file, 'r') as f:
+            conn.executescript(f.read())
+    conn.executescript(MANIFEST_SQL)
+    conn.commit()
+    return conn
+
+
+class IngestManifest:
+    def __init__(self, conn, parser_version):
+        self.conn = conn
+        self.parser_version = str(parser_version)
+        self._hashes = {}
+
+    def paths(self):
+        """All source paths recorded in this DB."""
+        return {r[0] for r in self.conn.execute("SELECT path FROM ingest_manifest")}
+
+    def plan(self, paths, prune=True):
+        """
+        Splits sources into (changed, removed): `changed` need (re)parsing,
+        `removed` were recorded before but are no longer in `paths`.
+        Pass prune=False when `paths` is only a subset (e.g. a single file).
+        """
+        changed = [p for p in paths if not self.is_current(p)]
+        removed = sorted(self.paths() - set(paths)) if prune else []
+        logging.info(
+            f"Manifest: {len(paths) - len(changed)} unchanged sources skipped, "
+            f"{len(changed)} to parse, {len(removed)} removed."
+        )
+        return changed, removed
+
+    def is_current(self, path):
+        """True if `path` was already ingested with identical content and parser."""
+        row = self.conn.execute(
+            "SELECT size, mtime, content_hash, parser_version FROM ingest_manifest WHERE path = ?",
+            (path,),
+        ).fetchone()
+        if not row:
+            return False
+        size, mtime, content_hash, version = row
+        if version != self.parser_version:
+            return False
+        st = os.stat(path)
+        if st.st_size != size:
+            return False
+        if st.st_mtime == mtime:
+            return True
+        # Same size but touched: compare content before re-parsing
+        current = self._hash(path)
+        if current != content_hash:
+            return False
+        with self.conn:
+            self.conn.execute(
+                "UPDATE ingest_manifest SET mtime = ? WHERE path = ?", (st.st_mtime, path)
+            )
+        return True
+
+    def record(self, path):
+        """Marks `path` as ingested; call after its rows are flushed."""
+        st = os.stat(path)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO ingest_manifest "
+                "(path, size, mtime, content_hash, parser_version) VALUES (?, ?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime, self._hash(path), self.parser_version),
+            )
+        self._hashes.pop(path, None)
+
+    def purge(self, table, column, values):
+        """Deletes rows that were ingested from the given sources."""
+        if not values:
+            return
+        with self.conn:
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table}({column})"
+            )
+            self.conn.executemany(
+                f"DELETE FROM {table} WHERE {column} = ?", [(v,) for v in values]
+            )
+
+    def forget(self, path):
+        """Drops the manifest entry for a source that no longer exists."""
+        with self.conn:
+            self.conn.execute("DELETE FROM ingest_manifest WHERE path = ?", (path,))
+
+    def _hash(self, path):
+        if path not in self._hashes:
+            self._hashes[path] = file_hash(path)
+        return self._hashes[path]
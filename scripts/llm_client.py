@@ -0,0 +1,232 @@
+"""
+LLM Client
+----------
+Shared client for the local OpenAI-compatible LLM server (Ollama by default)
+used by the people-extraction scripts.
+Features:
+1. One pooled HTTP session per worker thread (keep-alive connections are
+   reused across requests).
+2. Per-request timeout and retry with exponential backoff on connection
+   errors, timeouts, 429/5xx responses and unparsable JSON.
+3. `run_ordered` fans requests out over a bounded thread pool and yields the
+   results in input order as soon as each prefix is complete, so a single
+   consumer (the DB writer) can stream them.
+4. Persistent response cache (SQLite): parsed JSON replies are stored under
+   (model, prompt template version, temperature, hash of the messages), so
+   reruns skip unchanged inputs. Least recently used entries are evicted once
+   the cache exceeds LLM_CACHE_MAX_MB; `disable_cache()` bypasses it.
+
+Configuration (.env): LLM_API_BASE, LLM_API_KEY, LLM_MODEL, LLM_CONCURRENCY,
+LLM_TIMEOUT (seconds), LLM_MAX_RETRIES, LLM_CACHE_PATH, LLM_CACHE_MAX_MB.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LLM_API_BASE = os.getenv("LLM_API_BASE", "http://localhost:11434/v1")  # Default to Ollama
+LLM_API_KEY = os.getenv("LLM_API_KEY", "ollama")
+MODEL_NAME = os.getenv("LLM_MODEL", "llama3")
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF = 2.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "data/db/llm_cache.sqlite")
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "256"))
+# Eviction trims the cache to this fraction of the limit
+CACHE_LOW_WATER = 0.9
+
+CACHE_SQL = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    template_version TEXT,
+    temperature REAL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache(last_used);
+"""
+
+_local = threading.local()
+
+
+class LLMError(Exception):
+    pass
+
+
+def http_session():
+    """The calling thread's HTTP session (created on first use)."""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {LLM_API_KEY}"
+        _local.session = session
+    return session
+
+
+def parse_json_content(content):
+    """JSON from a model reply; some models wrap it in markdown fences."""
+    content = content.strip()
+    if content.startswith("```json"):
+        content = content.split("```json")[1].split("```")[0].strip()
+    elif content.startswith("```"):
+        content = content.split("```")[1].split("```")[0].strip()
+    return json.loads(content)
+
+
+class ResponseCache:
+    """Parsed LLM replies on disk; shared by the worker threads of one process."""
+
+    def __init__(self, path=LLM_CACHE_PATH, max_mb=LLM_CACHE_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.enabled = True
+        self._conn = None
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(CACHE_SQL)
+            self._total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM llm_cache"
+            ).fetchone()[0]
+        return self._conn
+
+    @staticmethod
+    def make_key(model, template_version, temperature, messages):
+        digest = hashlib.sha256(
+            json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return f"{model}|{template_version}|{temperature}|{digest}"
+
+    def get(self, key):
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with db:
+                db.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, model, template_version, temperature, data):
+        response = json.dumps(data, ensure_ascii=False)
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO llm_cache "
+                    "(key, model, template_version, temperature, response, size, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, model, template_version, temperature, response, size, time.time()),
+                )
+                self._total += size
+                if self._total > self.max_bytes:
+                    self._evict(db)
+
+    def _evict(self, db):
+        """Drops least recently used entries until the cache is under its low-water mark."""
+        excess = self._total - int(self.max_bytes * CACHE_LOW_WATER)
+        doomed, freed = [], 0
+        for key, size in db.execute("SELECT key, size FROM llm_cache ORDER BY last_used"):
+            if freed >= excess:
+                break
+            doomed.append((key,))
+            freed += size
+        db.executemany("DELETE FROM llm_cache WHERE key = ?", doomed)
+        self._total -= freed
+        logging.info(f"LLM cache: evicted {len(doomed)} entries ({freed} bytes).")
+
+
+CACHE = ResponseCache()
+
+
+def disable_cache():
+    """Makes chat_json always query the server (--no-cache)."""
+    CACHE.enabled = False
+
+
+def chat_json(messages, temperature=0.1, model=MODEL_NAME, template_version=None):
+    """
+    One chat completion in JSON mode, parsed. Retries transient failures with
+    exponential backoff; raises LLMError once retries are exhausted.
+    With a `template_version`, replies are served from / stored in the cache;
+    bump the version when the prompt template or its parsing changes.
+    """
+    use_cache = template_version is not None and CACHE.enabled
+    if use_cache:
+        key = ResponseCache.make_key(model, template_version, temperature, messages)
+        cached = CACHE.get(key)
+        if cached is not None:
+            return cached
+        data = _chat_json(messages, temperature, model)
+        CACHE.put(key, model, template_version, temperature, data)
+        return data
+    return _chat_json(messages, temperature, model)
+
+
+def _chat_json(messages, temperature, model):
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "response_format": {"type": "json_object"},
+    }
+    last_error = None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(LLM_BACKOFF ** (attempt - 1))
+        try:
+            response = http_session().post(
+                f"{LLM_API_BASE}/chat/completions", json=payload, timeout=LLM_TIMEOUT
+            )
+            if response.status_code in RETRY_STATUS:
+                last_error = LLMError(f"HTTP {response.status_code}")
+            else:
+                response.raise_for_status()
+                content = response.json()["choices"][0]["message"]["content"]
+                return parse_json_content(content)
+        except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+            # ValueError covers JSONDecodeError: a resample usually parses
+            last_error = e
+        except (requests.RequestException, KeyError, IndexError) as e:
+            raise LLMError(str(e)) from e
+        logging.warning(f"LLM request failed (attempt {attempt + 1}): {last_error}")
+    raise LLMError(f"giving up after {LLM_MAX_RETRIES + 1} attempts: {last_error}")
+
+
+def run_ordered(func, items, concurrency=LLM_CONCURRENCY):
+    """
+    Applies `func` to every item on `concurrency` threads and yields
+    (index, item, result) in input order. At most 2 x concurrency calls are
+    queued ahead of the consumer.
+    """
+    items = list(items)
+    window = max(concurrency, 1) * 2
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        futures = {}
+        submitted = 0
+        for index in range(len(items)):
+            while submitted < len(items) and submitted < index + window:
+                futures[submitted] = executor.submit(func, items[submitted])
+                submitted += 1
+            yield index, items[index], futures.pop(index).result()
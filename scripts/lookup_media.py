@@ -4,13 +4,16 @@ import sqlite3
 import subprocess
 import random
 from pathlib import Path
-from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 
+from media_crypto import decrypt_file
+
 # Load environment variables
 load_dotenv()
 
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
+# Set while a key rotation is unfinished; some files may already use it
+ENCRYPTION_KEY_NEXT = os.getenv("ENCRYPTION_KEY_NEXT")
 DB_PATH = "data/db/database.sqlite"
 
 
@@ -87,8 +90,7 @@ def decrypt_and_open(target_str):
             print(f"Error: Physical file missing at {target_path}")
             sys.exit(1)
 
-        # Setup decryption
-        cipher_suite = Fernet(ENCRYPTION_KEY.encode())
+        keys = [k for k in (ENCRYPTION_KEY, ENCRYPTION_KEY_NEXT) if k]
 
         # Define temp path
         temp_dir = Path("/tmp")
@@ -99,12 +101,8 @@ def decrypt_and_open(target_str):
 
         decrypted_path = temp_dir / f"decrypted_{target_path.name}{extension}"
 
-        # Read, decrypt, and write
-        with open(target_path, "rb") as f:
-            decrypted_data = cipher_suite.decrypt(f.read())
-
-        with open(decrypted_path, "wb") as f:
-            f.write(decrypted_data)
+        # Decrypt (streamed for chunked files, whole for legacy Fernet ones)
+        decrypt_file(target_path, decrypted_path, keys)
 
         print(f"Successfully decrypted to: {decrypted_path}")
 
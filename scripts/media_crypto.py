@@ -0,0 +1,227 @@
+"""
+Media Encryption
+----------------
+Chunked authenticated encryption for media files, replacing whole-file Fernet
+tokens (which need the full file in memory and base64-inflate it by ~33%).
+Features:
+1. Constant-memory streaming encrypt/decrypt: AES-256-GCM over fixed-size
+   chunks (CHUNK_SIZE), 16 bytes of overhead per chunk.
+2. Random access: any byte range decrypts only the chunks it covers.
+3. Each file gets its own key, derived (HKDF-SHA256) from ENCRYPTION_KEY and a
+   random salt in the header; chunk nonces carry the chunk index and a
+   final-chunk flag, and the header is authenticated with every chunk, so
+   reordered, truncated or extended files fail to decrypt.
+4. Versioned header; files without it are legacy Fernet tokens and still
+   decrypt (in memory), so existing media stays readable.
+
+File layout (version 1):
+    b"PMC" | version u8 | chunk_size u32 BE | salt (16) | chunk 0 | chunk 1 | ...
+    chunk = AES-GCM(plaintext[i * chunk_size:(i + 1) * chunk_size]) + tag (16)
+    nonce = chunk index (11 bytes BE) | 1 if last chunk else 0
+
+Keys are the Fernet-style ENCRYPTION_KEY strings (urlsafe base64, 32 bytes).
+Functions that decrypt take a list of keys and use whichever one fits.
+"""
+
+import base64
+import os
+import struct
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = b"PMC"
+VERSION = 1
+HEADER = struct.Struct(">3sBI16s")
+SALT_SIZE = 16
+TAG_SIZE = 16
+CHUNK_SIZE = 1024 * 1024
+HKDF_INFO = b"persons-media chunked v1"
+
+
+class MediaCryptoError(Exception):
+    pass
+
+
+def _as_keys(keys):
+    return [keys] if isinstance(keys, str) else list(keys)
+
+
+def _file_cipher(key, salt):
+    master = base64.urlsafe_b64decode(key.encode())
+    file_key = HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=salt, info=HKDF_INFO
+    ).derive(master)
+    return AESGCM(file_key)
+
+
+def _nonce(index, last):
+    return index.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+
+def _read_full(f, n):
+    """Up to n bytes; short only at end of stream (some streams return partial reads)."""
+    parts, remaining = [], n
+    while remaining:
+        data = f.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b"".join(parts)
+
+
+def is_chunked(head):
+    """Whether the first bytes of a file are a chunked-format header."""
+    return head[:len(MAGIC)] == MAGIC
+
+
+def encrypt_stream(src, dst, key, chunk_size=CHUNK_SIZE):
+    """Encrypts file object `src` into `dst` chunk by chunk. Returns plaintext bytes read."""
+    salt = os.urandom(SALT_SIZE)
+    header = HEADER.pack(MAGIC, VERSION, chunk_size, salt)
+    cipher = _file_cipher(key, salt)
+    dst.write(header)
+    total = 0
+    index = 0
+    chunk = _read_full(src, chunk_size)
+    while True:
+        # One chunk of lookahead: the last chunk is encrypted with its own flag
+        following = _read_full(src, chunk_size) if len(chunk) == chunk_size else b""
+        last = not following
+        dst.write(cipher.encrypt(_nonce(index, last), chunk, header))
+        total += len(chunk)
+        if last:
+            return total
+        chunk = following
+        index += 1
+
+
+def encrypt_file(src_path, dst_path, key, chunk_size=CHUNK_SIZE):
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        return encrypt_stream(src, dst, key, chunk_size)
+
+
+class ChunkedReader:
+    """Random-access reader over an open (seekable) chunked-format file."""
+
+    def __init__(self, f, keys):
+        self.f = f
+        f.seek(0)
+        self.header = f.read(HEADER.size)
+        if len(self.header) < HEADER.size or not is_chunked(self.header):
+            raise MediaCryptoError("not a chunked media file")
+        _, version, self.chunk_size, salt = HEADER.unpack(self.header)
+        if version != VERSION:
+            raise MediaCryptoError(f"unsupported media format version {version}")
+        f.seek(0, os.SEEK_END)
+        body = f.tell() - HEADER.size
+        stored = self.chunk_size + TAG_SIZE
+        self.chunks = max(-(-body // stored), 1)
+        self.size = body - self.chunks * TAG_SIZE
+        if self.size < 0 or (body - (self.chunks - 1) * stored) < TAG_SIZE:
+            raise MediaCryptoError("truncated media file")
+        # The key that authenticates the first chunk is the file's key
+        for key in _as_keys(keys):
+            self.cipher = _file_cipher(key, salt)
+            try:
+                self._decrypt(0)
+                break
+            except InvalidTag:
+                continue
+        else:
+            raise MediaCryptoError("no key decrypts this file")
+
+    def _decrypt(self, index):
+        stored = self.chunk_size + TAG_SIZE
+        self.f.seek(HEADER.size + index * stored)
+        data = self.f.read(stored)
+        return self.cipher.decrypt(_nonce(index, index == self.chunks - 1), data, self.header)
+
+    def iter_chunks(self):
+        """Plaintext chunks in order."""
+        for index in range(self.chunks):
+            try:
+                yield self._decrypt(index)
+            except InvalidTag:
+                raise MediaCryptoError(f"chunk {index} failed authentication") from None
+
+    def read_range(self, offset, length):
+        """Plaintext bytes [offset, offset + length), decrypting only the chunks covered."""
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b""
+        first, last = offset // self.chunk_size, (end - 1) // self.chunk_size
+        parts = []
+        for index in range(first, last + 1):
+            try:
+                parts.append(self._decrypt(index))
+            except InvalidTag:
+                raise MediaCryptoError(f"chunk {index} failed authentication") from None
+        start = offset - first * self.chunk_size
+        return b"".join(parts)[start:start + end - offset]
+
+
+def iter_plaintext(f, keys):
+    """Plaintext of an open encrypted file in pieces, for either format."""
+    f.seek(0)
+    if is_chunked(f.read(len(MAGIC))):
+        yield from ChunkedReader(f, keys).iter_chunks()
+        return
+    # Legacy Fernet token: decrypted whole
+    f.seek(0)
+    try:
+        yield MultiFernet([Fernet(k.encode()) for k in _as_keys(keys)]).decrypt(f.read())
+    except InvalidToken:
+        raise MediaCryptoError("no key decrypts this file") from None
+
+
+def decrypt_stream(src, dst, keys):
+    """Decrypts open file `src` (either format) into `dst`. Returns plaintext bytes written."""
+    total = 0
+    for piece in iter_plaintext(src, keys):
+        dst.write(piece)
+        total += len(piece)
+    return total
+
+
+def decrypt_file(src_path, dst_path, keys):
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        return decrypt_stream(src, dst, keys)
+
+
+def read_range(path, keys, offset, length):
+    """Plaintext byte range of a chunked file (legacy files are decrypted whole)."""
+    with open(path, "rb") as f:
+        if is_chunked(f.read(len(MAGIC))):
+            return ChunkedReader(f, keys).read_range(offset, length)
+        data = b"".join(iter_plaintext(f, keys))
+        return data[offset:offset + length]
+
+
+class _ChunkSource:
+    """File-like view over a plaintext iterator, for encrypt_stream."""
+
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+        self.buffer = b""
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            piece = next(self.pieces, None)
+            if piece is None:
+                break
+            self.buffer += piece
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+
+def reencrypt_stream(src, dst, keys, new_key, chunk_size=CHUNK_SIZE):
+    """
+    Decrypts `src` (either format, any of `keys`) and writes it to `dst` in the
+    chunked format under `new_key`. Returns plaintext bytes.
+    """
+    return encrypt_stream(_ChunkSource(iter_plaintext(src, keys)), dst, new_key, chunk_size)
@@ -0,0 +1,186 @@
+"""
+Content-Addressed Media Store
+-----------------------------
+Shared blob store for the WeChat media parsers (groups 4, 5, 6, 7).
+Every source file is stored once under
+`<media root>/blobs/<hash[:2]>/<hash><ext>`, keyed by the sha256 of the source
+bytes. The usual per-contact path (`<contact>/<fileID>.<ext>`) stays valid: it
+is a hard link to the blob, so `relative_path` in the raw media tables and
+every downstream reader is unchanged while duplicate bytes take no extra space.
+Features:
+1. Streaming sha256 of the source; a hash already in the store skips the copy
+   and the format conversion entirely.
+2. New blobs are staged and converted in a per-process folder, then moved into
+   place with `os.replace`, so parallel workers never see half-written blobs.
+3. An existing plain copy at the destination is swapped for a link to the blob.
+4. `media_blob_refs` (one per raw DB) maps each raw media row to its blob.
+5. `place_many` stages a batch of files first and converts all new blobs
+   with one `convert_batch` call (e.g. one ffmpeg run for many AMR clips);
+   the converted file itself becomes the blob.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+
+BLOB_DIR = "blobs"
+STAGING_DIR = ".staging"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+BLOB_REFS_SQL = """
+CREATE TABLE IF NOT EXISTS media_blob_refs (
+    media_id TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    blob_path TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_media_blob_refs_hash ON media_blob_refs(content_hash);
+"""
+INSERT_BLOB_REF_SQL = (
+    "INSERT OR REPLACE INTO media_blob_refs (media_id, content_hash, blob_path) "
+    "VALUES (?, ?, ?)"
+)
+
+
+def content_hash(path):
+    """Streaming sha256 of a file's content."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _link_or_copy(src, dest):
+    """Atomically points `dest` at `src`: hard link where possible, else a copy."""
+    tmp = f"{dest}.{os.getpid()}.link"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+class MediaStore:
+    def __init__(self, media_root):
+        self.media_root = media_root
+        self.blob_root = os.path.join(media_root, BLOB_DIR)
+
+    def find(self, digest):
+        """Absolute path of the blob for `digest` (any extension), or None."""
+        shard = os.path.join(self.blob_root, digest[:2])
+        try:
+            names = os.listdir(shard)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if os.path.splitext(name)[0] == digest:
+                return os.path.join(shard, name)
+        return None
+
+    def place(self, src_path, dest_path, convert=None):
+        """
+        Makes `dest_path` (extension may change) hold the content of `src_path`.
+        `convert(path) -> path` runs only when the blob is new, e.g. silk -> mp3.
+        Returns (content_hash, final destination path, blob path).
+        """
+        digest = content_hash(src_path)
+        blob = self.find(digest)
+        if not blob:
+            staged = self._stage(src_path, digest, os.path.splitext(dest_path)[1])
+            try:
+                if convert:
+                    staged = convert(staged)
+                blob = self._store(staged, digest)
+            finally:
+                self._clear_staging(digest)
+            logging.debug(f"Stored blob {digest} for {src_path}")
+        return digest, self._link_dest(dest_path, blob), blob
+
+    def place_many(self, items, convert=None, convert_batch=None):
+        """
+        `place` for a batch of (src_path, dest_path). `convert` runs per new
+        blob as in `place`; then `convert_batch(staged paths)` runs once over
+        all new blobs and returns {staged path: converted path or None}
+        (None, or a missing entry, keeps the staged file as the blob).
+        Returns [(content_hash, final destination path, blob path) or None]
+        in item order; None marks an item that failed (logged).
+        """
+        digests, staged, touched, failed = [], {}, set(), set()
+        try:
+            for src_path, dest_path in items:
+                try:
+                    digest = content_hash(src_path)
+                    if digest not in staged and not self.find(digest):
+                        touched.add(digest)
+                        path = self._stage(src_path, digest, os.path.splitext(dest_path)[1])
+                        staged[digest] = convert(path) if convert else path
+                    digests.append(digest)
+                except Exception as e:
+                    logging.error(f"Error staging media {src_path}: {e}")
+                    digests.append(None)
+
+            converted = {}
+            if convert_batch and staged:
+                try:
+                    converted = convert_batch(list(staged.values()))
+                except Exception as e:
+                    logging.error(f"Batch conversion failed, storing files unconverted: {e}")
+            for digest, path in staged.items():
+                try:
+                    self._store(converted.get(path) or path, digest)
+                except Exception as e:
+                    logging.error(f"Error storing blob {digest}: {e}")
+                    failed.add(digest)
+        finally:
+            for digest in touched:
+                self._clear_staging(digest)
+
+        results = []
+        for (src_path, dest_path), digest in zip(items, digests):
+            blob = self.find(digest) if digest and digest not in failed else None
+            if not blob:
+                results.append(None)
+                continue
+            try:
+                results.append((digest, self._link_dest(dest_path, blob), blob))
+            except OSError as e:
+                logging.error(f"Error linking media {src_path}: {e}")
+                results.append(None)
+        return results
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.media_root)
+
+    def _staging_dir(self):
+        staging = os.path.join(self.blob_root, STAGING_DIR, str(os.getpid()))
+        os.makedirs(staging, exist_ok=True)
+        return staging
+
+    def _stage(self, src_path, digest, ext):
+        staged = os.path.join(self._staging_dir(), digest + ext)
+        shutil.copy2(src_path, staged)
+        return staged
+
+    def _store(self, staged, digest):
+        """Moves a staged (possibly converted) file into place as the blob of `digest`."""
+        shard = os.path.join(self.blob_root, digest[:2])
+        os.makedirs(shard, exist_ok=True)
+        blob = os.path.join(shard, digest + os.path.splitext(staged)[1])
+        os.replace(staged, blob)
+        return blob
+
+    def _clear_staging(self, digest):
+        """Removes leftovers of a failed conversion (the staged copy, partial output)."""
+        staging = self._staging_dir()
+        for name in os.listdir(staging):
+            if name.startswith(digest):
+                os.remove(os.path.join(staging, name))
+
+    def _link_dest(self, dest_path, blob):
+        """Points dest_path (with the blob's extension, which reflects any conversion) at the blob."""
+        final_dest = os.path.splitext(dest_path)[0] + os.path.splitext(blob)[1]
+        os.makedirs(os.path.dirname(final_dest), exist_ok=True)
+        if not (os.path.exists(final_dest) and os.path.samefile(final_dest, blob)):
+            _link_or_copy(blob, final_dest)
+        return final_dest
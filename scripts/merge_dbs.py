@@ -1,16 +1,195 @@
+import argparse
+import hashlib
 import sqlite3
 import os
 import logging
-from setup_db import setup_db, DB_PATH
+from message_dedup import dedup_messages
+from migrate_db import migrate
+from parse_group2_mhtml import OWNER_ID as QQ_OWNER_ID
+from search_messages import sync_bigrams
+from timeline import sync_timeline
 
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+DB_PATH = "data/db/database.sqlite"
+SCHEMA_FILE = "data/schema/persons/schema.sql"
 RAW_DB_DIR = "data/db/raw"
 
-def merge_dbs():
+# Last merged rowid per (raw DB, table). db_size/db_mtime let an untouched raw
+# DB be skipped without attaching it; anchor_hash is the content of the row at
+# last_rowid, so a rebuilt raw DB (rowids restart) is detected and re-merged.
+WATERMARKS_SQL = """
+CREATE TABLE IF NOT EXISTS merge_watermarks (
+    raw_db TEXT,
+    table_name TEXT,
+    last_rowid INTEGER,
+    anchor_hash TEXT,
+    db_size INTEGER,
+    db_mtime REAL,
+    merged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (raw_db, table_name)
+);
+"""
+
+# Append-only tables, merged from the watermark on
+TABLES = [
+    "wechat_raw_messages",
+    "other_raw_chats",
+    "wechat_moments",
+    "wechat_raw_media"
+]
+# Rows are updated in place in the raw DBs, so always reconciled in full
+CONTACTS_TABLE = "wechat_raw_contacts"
+# Keyed on (source_file, username, create_time, content) and tagged with the
+# raw DB it came from (migration 007), so its rows can be reconciled
+CHATS_TABLE = "other_raw_chats"
+CHAT_KEY = "source_file, username, create_time, content"
+# Key equality with IS: feed rows often have a NULL username or content
+CHAT_KEY_MATCH = " AND ".join(f"m.{c} IS s.{c}" for c in CHAT_KEY.split(", "))
+
+# Raw chat tables of other shapes, folded into other_raw_chats (and so into
+# search, dedup and the timeline). Their raw rows are purged per source file,
+# so a changed raw DB is always reconciled in full. One chat table per raw DB.
+# QQ rows are filed under the other party: the receiver when the owner wrote.
+QQ_PEER_SQL = f"""
+    CASE WHEN sender_id = {QQ_OWNER_ID} THEN COALESCE(receiver_id, receiver_name)
+         ELSE COALESCE(sender_id, sender_name) END
+"""
+FEED_COLUMNS = "source_file, username, create_time, content, platform"
+CHAT_FEEDS = {
+    # View: copies of a message in several exports counted once
+    "group2_messages": f"""
+        SELECT source_file, {QQ_PEER_SQL} AS username, create_time, content,
+               'qq_mhtml' AS platform
+        FROM raw_db.group2_messages
+    """,
+    "group3_raw_qq_mht_archive": f"""
+        SELECT source_file, {QQ_PEER_SQL} AS username, create_time, content,
+               'qq_mht_archive' AS platform
+        FROM raw_db.group3_raw_qq_mht_archive
+    """,
+    "group12_raw_whatsapp": """
+        SELECT source_file, COALESCE(sender_id, sender_name) AS username, create_time,
+               content, 'whatsapp' AS platform
+        FROM raw_db.group12_raw_whatsapp
+    """,
+}
+
+
+def setup_db(db_path):
+    """Creates/updates the main database: persons schema (all IF NOT EXISTS) + migrations."""
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    with open(SCHEMA_FILE, 'r') as f:
+        conn.executescript(f.read())
+    conn.executescript(WATERMARKS_SQL)
+    conn.commit()
+    # Index pack and later schema changes
+    migrate(conn)
+    conn.close()
+
+
+def row_hash(cursor, table, rowid):
+    """Content hash of one raw row, or None if the row is gone."""
+    cursor.execute(f"SELECT * FROM raw_db.{table} WHERE rowid = ?", (rowid,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return hashlib.md5(repr(row).encode('utf-8', errors='replace')).hexdigest()
+
+
+def get_watermarks(cursor, db_file):
+    cursor.execute(
+        "SELECT table_name, last_rowid, anchor_hash, db_size, db_mtime "
+        "FROM merge_watermarks WHERE raw_db = ?", (db_file,)
+    )
+    return {r[0]: r[1:] for r in cursor.fetchall()}
+
+
+def chat_columns(cursor):
+    """Columns copied for other_raw_chats: the ones both sides have, minus id/raw_db."""
+    # Skip the 'id' column to let the main DB autoincrement it; raw
+    # producers differ in extra columns
+    cursor.execute(f"PRAGMA main.table_info({CHATS_TABLE})")
+    main_cols = [r[1] for r in cursor.fetchall() if r[1] not in ("id", "raw_db")]
+    cursor.execute(f"PRAGMA raw_db.table_info({CHATS_TABLE})")
+    raw_cols = {r[1] for r in cursor.fetchall()}
+    return ", ".join(c for c in main_cols if c in raw_cols)
+
+
+def chats_out_of_sync(cursor, db_file, last_rowid):
+    """True if raw rows up to the watermark were deleted (or never tagged as merged)."""
+    cursor.execute(f"SELECT COUNT(*) FROM main.{CHATS_TABLE} WHERE raw_db = ?", (db_file,))
+    merged = cursor.fetchone()[0]
+    cursor.execute(f"SELECT COUNT(*) FROM raw_db.{CHATS_TABLE} WHERE rowid <= ?", (last_rowid,))
+    return merged != cursor.fetchone()[0]
+
+
+def reconcile_chats(cursor, db_file, cols, source):
+    """
+    Makes the main DB's other_raw_chats rows from `db_file` match `source` (a
+    raw table or subquery yielding `cols`): rows gone from it are deleted,
+    missing ones inserted, the rest kept (ids unchanged). Returns (inserted, deleted).
+    """
+    # Indexed snapshot of the source, so both probes below are index lookups
+    cursor.execute("DROP TABLE IF EXISTS temp.chat_source")
+    cursor.execute(f"CREATE TEMP TABLE chat_source AS SELECT DISTINCT {cols} FROM {source}")
+    cursor.execute(f"CREATE INDEX temp.idx_chat_source_key ON chat_source({CHAT_KEY})")
+    # Rows merged before migration 007 carry no raw_db: claim them by source file
+    cursor.execute(f"""
+        UPDATE main.{CHATS_TABLE} SET raw_db = ?
+        WHERE raw_db IS NULL
+          AND source_file IN (SELECT source_file FROM temp.chat_source)
+    """, (db_file,))
+    cursor.execute(f"""
+        DELETE FROM main.{CHATS_TABLE} AS m
+        WHERE raw_db = ?
+          AND NOT EXISTS (SELECT 1 FROM temp.chat_source s WHERE {CHAT_KEY_MATCH})
+    """, (db_file,))
+    deleted = cursor.rowcount
+    # Not INSERT OR IGNORE: the unique index lets rows with a NULL key column through
+    cursor.execute(f"""
+        INSERT INTO main.{CHATS_TABLE} ({cols}, raw_db)
+        SELECT {cols}, ? FROM temp.chat_source s
+        WHERE NOT EXISTS (SELECT 1 FROM main.{CHATS_TABLE} m WHERE {CHAT_KEY_MATCH})
+    """, (db_file,))
+    inserted = cursor.rowcount
+    cursor.execute("DROP TABLE temp.chat_source")
+    return inserted, deleted
+
+
+def merge_table(cursor, table, since_rowid, db_file):
+    """Copies raw rows with rowid > since_rowid into the main DB."""
+    if table == CHATS_TABLE:
+        cols = chat_columns(cursor)
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO {table} ({cols}, raw_db)
+            SELECT {cols}, ? FROM raw_db.{table} WHERE rowid > ?
+        """, (db_file, since_rowid))
+    else:
+        cursor.execute(
+            f"INSERT OR IGNORE INTO {table} SELECT * FROM raw_db.{table} WHERE rowid > ?",
+            (since_rowid,),
+        )
+    return cursor.rowcount
+
+
+def merge_contacts(cursor):
+    """Set-based upsert: new usernames are inserted, known ones take non-null raw values."""
+    cursor.execute(f"""
+        INSERT INTO {CONTACTS_TABLE} (username, nickname, type)
+        SELECT username, nickname, type FROM raw_db.{CONTACTS_TABLE} WHERE true
+        ON CONFLICT(username) DO UPDATE SET
+            nickname = excluded.nickname,
+            type = excluded.type
+        WHERE excluded.nickname IS NOT NULL OR excluded.type IS NOT NULL
+    """)
+
+
+def merge_dbs(full=False):
     if not os.path.exists(RAW_DB_DIR):
         logging.info(f"Raw DB directory not found: {RAW_DB_DIR}")
         return
@@ -18,72 +197,116 @@ def merge_dbs():
     # 1. Setup the main database
     logging.info(f"Setting up main database: {DB_PATH}")
     setup_db(DB_PATH)
-    
+
     main_conn = sqlite3.connect(DB_PATH)
     main_cursor = main_conn.cursor()
+    if full:
+        main_cursor.execute("DELETE FROM merge_watermarks")
+        main_conn.commit()
 
     # 2. Get all raw databases
     raw_dbs = [f for f in os.listdir(RAW_DB_DIR) if f.endswith(".sqlite")]
     logging.info(f"Found {len(raw_dbs)} raw databases to merge.")
 
-    tables = [
-        "wechat_raw_messages",
-        "other_raw_chats",
-        "wechat_raw_contacts",
-        "wechat_moments",
-        "wechat_raw_media"
-    ]
-
     for db_file in raw_dbs:
         db_path = os.path.join(RAW_DB_DIR, db_file)
+        st = os.stat(db_path)
+        watermarks = get_watermarks(main_cursor, db_file)
+        if watermarks and all(
+            (w[2], w[3]) == (st.st_size, st.st_mtime) for w in watermarks.values()
+        ):
+            logging.info(f"Skipping {db_file}: unchanged since last merge.")
+            continue
+
         logging.info(f"Merging {db_file}...")
-        
+
         try:
             # Attach the raw DB
             main_cursor.execute(f"ATTACH DATABASE '{db_path}' AS raw_db")
-            
-            for table in tables:
-                # Check if table exists in raw_db
+
+            for table in TABLES + [CONTACTS_TABLE] + list(CHAT_FEEDS):
+                # Check if table (or view) exists in raw_db
                 main_cursor.execute(
-                    f"SELECT name FROM raw_db.sqlite_master WHERE type='table' AND name='{table}'"
+                    f"SELECT name FROM raw_db.sqlite_master "
+                    f"WHERE type IN ('table', 'view') AND name='{table}'"
                 )
                 if not main_cursor.fetchone():
                     continue
 
-                logging.info(f"  - Merging table: {table}")
-                
-                # Special handling for tables with AUTOINCREMENT or specific PKs
-                if table == "other_raw_chats":
-                    # Skip the 'id' column to let the main DB autoincrement it
-                    main_cursor.execute(f"""
-                        INSERT OR IGNORE INTO {table} 
-                        (source_file, username, nickname, create_time, content, platform, subfolder, msg_hash)
-                        SELECT source_file, username, nickname, create_time, content, platform, subfolder, msg_hash
-                        FROM raw_db.{table}
-                    """)
-                elif table == "wechat_raw_contacts":
-                    # Update nickname if it's NULL in main but present in raw
-                    main_cursor.execute(f"""
-                        INSERT OR IGNORE INTO {table} SELECT * FROM raw_db.{table}
-                    """)
-                    main_cursor.execute(f"""
-                        UPDATE {table} SET 
-                        nickname = (SELECT nickname FROM raw_db.{table} WHERE raw_db.{table}.username = {table}.username),
-                        type = (SELECT type FROM raw_db.{table} WHERE raw_db.{table}.username = {table}.username)
-                        WHERE username IN (SELECT username FROM raw_db.{table} WHERE nickname IS NOT NULL OR type IS NOT NULL)
-                    """)
+                if table == CONTACTS_TABLE:
+                    logging.info(f"  - Reconciling table: {table}")
+                    merge_contacts(main_cursor)
+                    last_rowid, anchor = 0, None
+                elif table in CHAT_FEEDS:
+                    inserted, deleted = reconcile_chats(
+                        main_cursor, db_file, FEED_COLUMNS, f"({CHAT_FEEDS[table]})"
+                    )
+                    logging.info(
+                        f"  - Reconciled {table} into {CHATS_TABLE} "
+                        f"({inserted} new rows, {deleted} deleted)"
+                    )
+                    last_rowid, anchor = 0, None
                 else:
-                    main_cursor.execute(f"INSERT OR IGNORE INTO {table} SELECT * FROM raw_db.{table}")
-            
+                    last_rowid, anchor = watermarks.get(table, (0, None, None, None))[:2]
+                    rebuilt = last_rowid and row_hash(main_cursor, table, last_rowid) != anchor
+                    if table == CHATS_TABLE and (
+                        rebuilt or chats_out_of_sync(main_cursor, db_file, last_rowid)
+                    ):
+                        inserted, deleted = reconcile_chats(
+                            main_cursor, db_file, chat_columns(main_cursor), f"raw_db.{table}"
+                        )
+                        logging.info(
+                            f"  - Reconciled table: {table} ({inserted} new rows, {deleted} deleted)"
+                        )
+                    else:
+                        if rebuilt:
+                            # Keyed tables: re-inserting known rows is a no-op
+                            logging.info(f"  - {table}: raw DB was rebuilt, merging from the start")
+                            last_rowid = 0
+                        inserted = merge_table(main_cursor, table, last_rowid, db_file)
+                        logging.info(f"  - Merged table: {table} ({inserted} new rows after rowid {last_rowid})")
+                    main_cursor.execute(f"SELECT MAX(rowid) FROM raw_db.{table}")
+                    last_rowid = main_cursor.fetchone()[0] or 0
+                    anchor = row_hash(main_cursor, table, last_rowid) if last_rowid else None
+
+                main_cursor.execute(
+                    "INSERT OR REPLACE INTO merge_watermarks "
+                    "(raw_db, table_name, last_rowid, anchor_hash, db_size, db_mtime) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (db_file, table, last_rowid, anchor, st.st_size, st.st_mtime),
+                )
+
             main_conn.commit()
             main_cursor.execute("DETACH DATABASE raw_db")
-            
+
         except Exception as e:
             logging.error(f"Error merging {db_file}: {e}")
             main_conn.rollback()
+            try:
+                main_cursor.execute("DETACH DATABASE raw_db")
+            except sqlite3.Error:
+                pass
+
+    # 3. Collapse the same message merged from several sources
+    removed = dedup_messages(main_conn)
+    logging.info(f"Removed {removed} cross-source duplicate messages.")
+
+    # 4. Fold the new rows into the per-person timeline
+    added = sync_timeline(main_conn)
+    logging.info(f"Added {added} timeline rows.")
+
+    # 5. Bigram search index for the new (and removed) documents
+    synced = sync_bigrams(main_conn)
+    logging.info(f"Bigram index: {synced} documents indexed.")
 
     main_conn.close()
     logging.info("Merge completed.")
 
 if __name__ == "__main__":
-    merge_dbs()
+    parser = argparse.ArgumentParser(description="Merge raw group DBs into the main database.")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Ignore merge watermarks and re-merge every raw table.",
+    )
+    args = parser.parse_args()
+    merge_dbs(full=args.full)
@@ -0,0 +1,217 @@
+"""
+Cross-Source Message Deduplication
+----------------------------------
+Collapses the same WeChat message merged from several raw sources (iOS FTS,
+MM.sqlite, the 2016 backup, txt exports) into one `wechat_raw_messages` row.
+`INSERT OR IGNORE` only catches identical primary keys; here messages are
+matched on a fingerprint of (username, minute bucket, normalized content,
+media_path).
+Features:
+1. Normalizes content (NFKC, collapsed whitespace) and buckets time to the
+   minute, so second- vs minute-precision sources and cleaning differences
+   still match (same rule as check_wechat_txt_dupes.py).
+2. Only copies from different sources are merged: a kept row absorbs at most
+   one row per other source, within TIME_TOLERANCE seconds of the kept row.
+   Repeats within one source (a second "ok", the other side of the chat
+   repeating a reply, two "[图片]" in a row) are real messages and stay, as do
+   rows with different attachments (media_path).
+3. `message_fingerprints` (indexed by fingerprint) holds the kept rows;
+   `message_sources` records every source row and the kept row it maps to.
+4. Sort-based grouping, O(n log n); only rows that are not already a kept
+   row are fingerprinted on each run.
+5. The kept row is the most precise copy: second-level timestamp first, then
+   the longest content.
+"""
+
+import hashlib
+import logging
+import re
+import unicodedata
+
+# Copies of one message from different sources are at most this far apart
+# (minute-precision sources truncate the seconds)
+TIME_TOLERANCE = 60
+
+DEDUP_SQL = """
+CREATE TABLE IF NOT EXISTS message_fingerprints (
+    username TEXT,
+    local_id INTEGER,
+    source TEXT,
+    fingerprint TEXT NOT NULL,
+    create_time INTEGER,
+    PRIMARY KEY (username, local_id, source)
+);
+CREATE INDEX IF NOT EXISTS idx_message_fingerprints_fp ON message_fingerprints(fingerprint);
+CREATE TABLE IF NOT EXISTS message_sources (
+    username TEXT,
+    local_id INTEGER,
+    source TEXT,
+    fingerprint TEXT,
+    kept_local_id INTEGER,
+    kept_source TEXT,
+    PRIMARY KEY (username, local_id, source)
+);
+CREATE INDEX IF NOT EXISTS idx_message_sources_kept
+    ON message_sources(username, kept_local_id, kept_source);
+CREATE VIEW IF NOT EXISTS message_source_summary AS
+    SELECT username, kept_local_id AS local_id, kept_source AS source, fingerprint,
+           COUNT(*) AS copies, GROUP_CONCAT(DISTINCT source) AS sources
+    FROM message_sources GROUP BY username, kept_local_id, kept_source;
+"""
+# Layout before kept rows were tracked per source (one row per fingerprint)
+DROP_OLD_SQL = """
+DROP VIEW IF EXISTS message_source_summary;
+DROP TABLE IF EXISTS message_fingerprints;
+DROP TABLE IF EXISTS message_sources;
+"""
+
+# Rows that are not a kept row yet (new merges and re-merged copies), with
+# the kept row they were mapped to before, if it still exists
+PENDING_SQL = """
+SELECT m.rowid, m.username, m.local_id, m.source, m.create_time, m.content, m.media_path,
+       s.kept_local_id, s.kept_source, k.rowid IS NOT NULL
+FROM wechat_raw_messages m
+LEFT JOIN message_fingerprints f
+    ON f.username IS m.username AND f.local_id IS m.local_id AND f.source IS m.source
+LEFT JOIN message_sources s
+    ON s.username IS m.username AND s.local_id IS m.local_id AND s.source IS m.source
+LEFT JOIN wechat_raw_messages k
+    ON k.username IS s.username AND k.local_id IS s.kept_local_id AND k.source IS s.kept_source
+WHERE f.fingerprint IS NULL
+"""
+# Kept rows (still present) for the fingerprints of this batch, with the
+# sources already merged into each
+KEPT_SQL = """
+SELECT f.fingerprint, f.username, f.local_id, f.source, f.create_time, s.source
+FROM dedup_batch b
+JOIN message_fingerprints f ON f.fingerprint = b.fingerprint
+JOIN wechat_raw_messages m
+    ON m.username IS f.username AND m.local_id IS f.local_id AND m.source IS f.source
+LEFT JOIN message_sources s
+    ON s.username IS f.username AND s.kept_local_id IS f.local_id AND s.kept_source IS f.source
+"""
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_content(content):
+    """Content as compared across sources."""
+    if not content:
+        return ""
+    return WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", content)).strip()
+
+
+def message_fingerprint(username, create_time, content, media_path=None):
+    """md5 of username | minute bucket | normalized content | media_path."""
+    minute = (create_time // 60) * 60 if create_time is not None else ""
+    base_str = f"{username}|{minute}|{normalize_content(content)}|{media_path or ''}"
+    return hashlib.md5(base_str.encode("utf-8", errors="replace")).hexdigest()
+
+
+def _precision(create_time, content):
+    """Sort key preferring second-level timestamps, then longer content."""
+    has_seconds = create_time is not None and create_time % 60 != 0
+    return (not has_seconds, -len(content or ""))
+
+
+def _within_tolerance(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    return abs(a - b) < TIME_TOLERANCE
+
+
+class _Kept:
+    """One kept row and the sources merged into it."""
+
+    def __init__(self, key, create_time, sources):
+        self.key = key
+        self.create_time = create_time
+        self.sources = set(sources)
+
+
+def _setup(conn):
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(message_fingerprints)")}
+    if columns and "create_time" not in columns:
+        # Rebuilt from the messages; rows the old rule removed come back with
+        # `merge_dbs.py --full`
+        logging.warning("Dedup: rebuilding message_fingerprints in the per-source layout.")
+        conn.executescript(DROP_OLD_SQL)
+    conn.executescript(DEDUP_SQL)
+
+
+def dedup_messages(conn):
+    """
+    Fingerprints new wechat_raw_messages rows and deletes copies of messages
+    already kept from another source. Returns the number of rows removed.
+    """
+    _setup(conn)
+    rows = conn.execute(PENDING_SQL).fetchall()
+    if not rows:
+        logging.info("Dedup: no new messages to fingerprint.")
+        return 0
+
+    drop, entries = [], []
+    for (rowid, username, local_id, source, create_time, content, media_path,
+         kept_local_id, kept_source, kept_exists) in rows:
+        key = (username, local_id, source)
+        if kept_exists and (kept_local_id, kept_source) != (local_id, source):
+            # Re-merged copy of a message that is already kept
+            drop.append((rowid,))
+            continue
+        fp = message_fingerprint(username, create_time, content, media_path)
+        entries.append((fp, _precision(create_time, content), rowid, key, create_time))
+    entries.sort(key=lambda e: e[:3])
+
+    # Kept rows of earlier runs that this batch may merge into
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS dedup_batch (fingerprint TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM dedup_batch")
+    conn.executemany(
+        "INSERT OR IGNORE INTO dedup_batch (fingerprint) VALUES (?)", [(e[0],) for e in entries]
+    )
+    kept = {}
+    by_key = {}
+    for fp, username, local_id, source, create_time, merged_source in conn.execute(KEPT_SQL):
+        key = (username, local_id, source)
+        if key not in by_key:
+            by_key[key] = _Kept(key, create_time, [source])
+            kept.setdefault(fp, []).append(by_key[key])
+        if merged_source is not None:
+            by_key[key].sources.add(merged_source)
+
+    survivors, sources = [], []
+    for fp, _, rowid, key, create_time in entries:
+        source = key[2]
+        candidates = [
+            k for k in kept.get(fp, ())
+            if source not in k.sources and _within_tolerance(create_time, k.create_time)
+        ]
+        if candidates:
+            target = min(
+                candidates,
+                key=lambda k: abs((create_time or 0) - (k.create_time or 0)),
+            )
+            target.sources.add(source)
+            drop.append((rowid,))
+        else:
+            target = _Kept(key, create_time, [source])
+            kept.setdefault(fp, []).append(target)
+            survivors.append(key + (fp, create_time))
+        sources.append(key + (fp, target.key[1], target.key[2]))
+
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO message_fingerprints "
+            "(username, local_id, source, fingerprint, create_time) VALUES (?, ?, ?, ?, ?)",
+            survivors,
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO message_sources "
+            "(username, local_id, source, fingerprint, kept_local_id, kept_source) "
+            "VALUES (?, ?, ?, ?, ?, ?)", sources,
+        )
+        conn.executemany("DELETE FROM wechat_raw_messages WHERE rowid = ?", drop)
+    logging.info(
+        f"Dedup: {len(rows)} rows fingerprinted, {len(survivors)} new messages, "
+        f"{len(drop)} duplicates removed."
+    )
+    return len(drop)
@@ -0,0 +1,93 @@
+"""
+Streaming MHT/MHTML Reader
+--------------------------
+Yields the inner HTML of each `<tr>` row of an MHT chat export without
+loading the file into memory. Used by the QQ MHT parsers (groups 2 and 3).
+Features:
+1. Reads the file in fixed-size binary chunks.
+2. Finds the HTML part and its Content-Transfer-Encoding from the MIME headers.
+3. Decodes quoted-printable bodies and UTF-8 incrementally, chunk by chunk.
+4. Stops at `</html>`, so trailing base64 image parts are never read.
+Memory is bounded by the chunk size plus the longest single row.
+"""
+
+import binascii
+import codecs
+import re
+
+CHUNK_SIZE = 1024 * 1024
+# Header bytes kept while looking for the start of the HTML part
+PREAMBLE_TAIL = 64 * 1024
+
+HTML_START_RE = re.compile(rb"<html", re.IGNORECASE)
+ENCODING_RE = re.compile(rb"Content-Transfer-Encoding:\s*([\w-]+)", re.IGNORECASE)
+HTML_END_RE = re.compile(r"</html>", re.IGNORECASE)
+ROW_RE = re.compile(r"<tr.*?>(.*?)</tr>", re.DOTALL)
+
+
+def _read_html_chunks(f, chunk_size):
+    """Yields raw byte chunks of the HTML part and its transfer encoding."""
+    preamble = b""
+    encoding = None
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        preamble += chunk
+        start = HTML_START_RE.search(preamble)
+        head = preamble[:start.start()] if start else preamble
+        for m in ENCODING_RE.finditer(head):
+            encoding = m.group(1).lower().decode("ascii")
+        if start:
+            yield encoding, preamble[start.start():]
+            break
+        # Keep a tail so a header split across chunks is still found
+        preamble = preamble[-PREAMBLE_TAIL:]
+
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield encoding, chunk
+
+
+def _decode_chunks(f, chunk_size):
+    """Yields decoded text of the HTML part, one chunk at a time."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    pending = b""
+    for encoding, chunk in _read_html_chunks(f, chunk_size):
+        if encoding == "quoted-printable":
+            data = pending + chunk
+            # Hold back an escape ("=", "=X", "=\r") cut by the chunk boundary
+            cut = data.rfind(b"=", max(len(data) - 2, 0))
+            if cut != -1:
+                data, pending = data[:cut], data[cut:]
+            else:
+                pending = b""
+            chunk = binascii.a2b_qp(data)
+        yield decoder.decode(chunk)
+    if pending:
+        yield decoder.decode(binascii.a2b_qp(pending))
+    yield decoder.decode(b"", final=True)
+
+
+def iter_mht_rows(filepath, chunk_size=CHUNK_SIZE):
+    """Yields the inner HTML of every <tr> row inside the file's HTML part."""
+    buf = ""
+    with open(filepath, "rb") as f:
+        for text in _decode_chunks(f, chunk_size):
+            buf += text
+            end = HTML_END_RE.search(buf)
+            limit = end.start() if end else len(buf)
+            pos = 0
+            while True:
+                m = ROW_RE.search(buf, pos, limit)
+                if not m:
+                    break
+                yield m.group(1)
+                pos = m.end()
+            if end:
+                return
+            # Keep from the first unfinished row, or a short tail for split tags
+            open_row = buf.find("<tr", pos)
+            buf = buf[open_row:] if open_row != -1 else buf[max(pos, len(buf) - 8):]
@@ -0,0 +1,171 @@
+"""
+Database Migration Runner
+-------------------------
+Applies the versioned SQL files in data/schema/persons/migrations/ to an
+existing main database (data/db/database.sqlite).
+Features:
+1. Files are named NNN_description.sql and applied once each, in version order.
+2. Applied versions are recorded in `schema_migrations`; each file runs in its
+   own transaction together with its bookkeeping row.
+3. `--benchmark` times the main access paths before and after migrating.
+
+Usage:
+    python scripts/migrate_db.py                # apply pending migrations
+    python scripts/migrate_db.py --benchmark    # ...and print before/after timings
+"""
+
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import time
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+DB_PATH = "data/db/database.sqlite"
+MIGRATIONS_DIR = "data/schema/persons/migrations"
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_([\w-]+)\.sql$")
+
+MIGRATIONS_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# (label, query, query that picks a realistic parameter row or None)
+BENCHMARK_QUERIES = [
+    (
+        "contact message counts",
+        "SELECT c.username, m.n FROM (SELECT username, COUNT(*) AS n "
+        "FROM wechat_raw_messages GROUP BY username) m "
+        "JOIN wechat_raw_contacts c ON c.username = m.username ORDER BY m.n DESC",
+        None,
+    ),
+    (
+        "contact timeline (200 rows)",
+        "SELECT create_time, content FROM wechat_raw_messages "
+        "WHERE username = ? ORDER BY create_time LIMIT 200",
+        "SELECT username FROM wechat_raw_messages LIMIT 1",
+    ),
+    (
+        "message by media_path",
+        "SELECT content, media_id FROM wechat_raw_messages WHERE media_path = ?",
+        "SELECT media_path FROM wechat_raw_messages WHERE media_path IS NOT NULL LIMIT 1",
+    ),
+    (
+        "contact by (type, value)",
+        "SELECT person_id FROM contacts WHERE type = ? AND value = ?",
+        "SELECT type, value FROM contacts LIMIT 1",
+    ),
+    (
+        "contact by (person_id, type, value)",
+        "SELECT id FROM contacts WHERE person_id = ? AND type = ? AND value = ?",
+        "SELECT person_id, type, value FROM contacts LIMIT 1",
+    ),
+    (
+        "person by name",
+        "SELECT id FROM persons WHERE name = ?",
+        "SELECT name FROM persons LIMIT 1",
+    ),
+]
+BENCHMARK_REPEAT = 20
+
+
+def list_migrations(migrations_dir=MIGRATIONS_DIR):
+    """[(version, name, path)] sorted by version."""
+    migrations = []
+    for filename in os.listdir(migrations_dir):
+        m = MIGRATION_FILE_RE.match(filename)
+        if m:
+            migrations.append((int(m.group(1)), m.group(2), os.path.join(migrations_dir, filename)))
+    return sorted(migrations)
+
+
+def applied_versions(conn):
+    conn.executescript(MIGRATIONS_SQL)
+    return {r[0] for r in conn.execute("SELECT version FROM schema_migrations")}
+
+
+def migrate(conn, migrations_dir=MIGRATIONS_DIR):
+    """Applies pending migrations; returns the list of versions applied."""
+    done = applied_versions(conn)
+    applied = []
+    for version, name, path in list_migrations(migrations_dir):
+        if version in done:
+            continue
+        with open(path, 'r') as f:
+            sql = f.read()
+        start = time.perf_counter()
+        # One transaction per file, bookkeeping row included
+        try:
+            conn.executescript(
+                f"BEGIN;\n{sql}\n"
+                f"INSERT INTO schema_migrations (version, name) VALUES ({version}, '{name}');\n"
+                "COMMIT;"
+            )
+        except sqlite3.Error:
+            # executescript stops at the failing statement with BEGIN still open
+            conn.rollback()
+            logging.error(f"Migration {version:03d}_{name} failed; rolled back.")
+            raise
+        logging.info(
+            f"Applied migration {version:03d}_{name} in {time.perf_counter() - start:.2f}s"
+        )
+        applied.append(version)
+    if not applied:
+        logging.info("Database schema is up to date.")
+    return applied
+
+
+def benchmark(conn):
+    """Average milliseconds per run of each benchmark query that can run here."""
+    timings = {}
+    for label, query, param_query in BENCHMARK_QUERIES:
+        try:
+            params = ()
+            if param_query:
+                row = conn.execute(param_query).fetchone()
+                if not row:
+                    continue
+                params = tuple(row)
+            start = time.perf_counter()
+            for _ in range(BENCHMARK_REPEAT):
+                conn.execute(query, params).fetchall()
+            timings[label] = (time.perf_counter() - start) * 1000 / BENCHMARK_REPEAT
+        except sqlite3.Error as e:
+            logging.warning(f"Benchmark '{label}' skipped: {e}")
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations to the main database.")
+    parser.add_argument("--db", default=DB_PATH, help="Database to migrate.")
+    parser.add_argument(
+        "--benchmark", action="store_true",
+        help="Time the main access paths before and after migrating.",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        logging.info(f"Database not found: {args.db}")
+        return
+
+    conn = sqlite3.connect(args.db)
+    before = benchmark(conn) if args.benchmark else {}
+    migrate(conn)
+    if args.benchmark:
+        conn.execute("ANALYZE")
+        after = benchmark(conn)
+        for label, ms in before.items():
+            logging.info(f"{label}: {ms:.2f} ms -> {after.get(label, float('nan')):.2f} ms")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
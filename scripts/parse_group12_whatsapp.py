@@ -2,37 +2,50 @@
 Group 12: WhatsApp Chat Parser
 Target: blobs/WhatsApp Chat - Jenny/_chat.txt
 Output: data/db/raw/group12_whatsapp.sqlite (group12_raw_whatsapp)
+Skips the run when the chat file is unchanged (ingest manifest); `--full` forces a rebuild.
 """
 
+import argparse
 import hashlib
 import logging
 import os
 import re
-import sqlite3
 from datetime import datetime
 
+from batch_writer import BatchWriter
+from ingest_manifest import IngestManifest, open_output_db
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 OUTPUT_DB = "data/db/raw/group12_whatsapp.sqlite"
 WHATSAPP_FILE = "blobs/WhatsApp Chat - Jenny/_chat.txt"
+# Bump when parsing logic changes so the chat is re-ingested
+PARSER_VERSION = "1"
 
 def compute_msg_hash(sender_id, create_time, content):
     base_str = f"{sender_id}|{create_time}|{content}"
     return hashlib.md5(base_str.encode('utf-8', errors='replace')).hexdigest()
 
 def main():
-    if os.path.exists(OUTPUT_DB):
-        os.remove(OUTPUT_DB)
-        logging.info(f"Deleted existing database: {OUTPUT_DB}")
+    parser = argparse.ArgumentParser(description="Parse the WhatsApp chat export (group 12).")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Delete the DB and re-parse even if the chat file is unchanged.",
+    )
+    args = parser.parse_args()
 
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    conn = sqlite3.connect(OUTPUT_DB)
+    conn = open_output_db(OUTPUT_DB, full=args.full)
     cursor = conn.cursor()
     
     table_name = "group12_raw_whatsapp"
-    cursor.execute(f"CREATE TABLE {table_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, source_file TEXT, sender_name TEXT, sender_id TEXT, create_time INTEGER, content TEXT, platform TEXT, subfolder TEXT, msg_hash TEXT)")
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, source_file TEXT, sender_name TEXT, sender_id TEXT, create_time INTEGER, content TEXT, platform TEXT, subfolder TEXT, msg_hash TEXT)")
+    writer = BatchWriter(conn)
+    manifest = IngestManifest(conn, PARSER_VERSION)
     
-    if os.path.exists(WHATSAPP_FILE):
+    if os.path.exists(WHATSAPP_FILE) and manifest.is_current(WHATSAPP_FILE):
+        logging.info(f"Chat unchanged since last run, nothing to do: {WHATSAPP_FILE}")
+    elif os.path.exists(WHATSAPP_FILE):
+        manifest.purge(table_name, "source_file", [WHATSAPP_FILE])
         logging.info(f"Parsing WhatsApp chat: {WHATSAPP_FILE}")
         with open(WHATSAPP_FILE, "r", encoding="utf-8", errors="replace") as f:
             messages = []
@@ -64,13 +77,17 @@ def main():
             if current_msg:
                 messages.append(current_msg)
 
+            insert_sql = f"INSERT OR IGNORE INTO {table_name} (source_file, sender_name, sender_id, create_time, content, platform, subfolder, msg_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
             for m in messages:
                 m_hash = compute_msg_hash(m["sender_name"], m["create_time"], m["content"])
-                cursor.execute(f"INSERT OR IGNORE INTO {table_name} (source_file, sender_name, sender_id, create_time, content, platform, subfolder, msg_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                               (WHATSAPP_FILE, m["sender_name"], m["sender_id"], m["create_time"], m["content"], "whatsapp_txt", "WhatsApp Chat - Jenny", m_hash))
+                writer.add(table_name, insert_sql,
+                           (WHATSAPP_FILE, m["sender_name"], m["sender_id"], m["create_time"], m["content"], "whatsapp_txt", "WhatsApp Chat - Jenny", m_hash))
             
             logging.info(f"Extracted {len(messages)} messages.")
+        writer.flush()
+        manifest.record(WHATSAPP_FILE)
     
+    writer.close()
     conn.commit()
     conn.close()
 
@@ -5,17 +5,23 @@ Features:
 1. Parses QQ chat logs from individual text files.
 2. Uses local schema file for database setup.
 3. Correctly handles sender names, nicknames, and timestamps.
+4. `--workers N` parses files on a process pool; the main process is the only writer.
+5. Incremental by default: unchanged files are skipped via the ingest manifest;
+   `--full` deletes and rebuilds the DB.
 """
 
+import argparse
 import hashlib
 import logging
 import os
 import re
-import sqlite3
-import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from glob import glob
 
+from batch_writer import BatchWriter
+from ingest_manifest import IngestManifest, open_output_db
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -25,6 +31,8 @@ logging.basicConfig(
 OUTPUT_DB = "data/db/raw/group1_qq_txt.sqlite"
 SCHEMA_FILE = "data/schema/raw/group1_qq_txt.sql"
 OWNER_NAME = '几何体'
+# Bump when parsing logic changes so every file is re-ingested
+PARSER_VERSION = "1"
 
 
 def compute_msg_hash(sender, create_time, content):
@@ -41,21 +49,22 @@ def clean_msg(msg):
     return msg.strip()
 
 
-def init_db():
-    """Initialize DB using the local schema file."""
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    with open(SCHEMA_FILE, 'r') as f:
-        schema_sql = f.read()
-
-    conn = sqlite3.connect(OUTPUT_DB)
-    cursor = conn.cursor()
-    cursor.executescript(schema_sql)
-    conn.commit()
+def init_db(full=False):
+    """Initialize DB using the local schema file (kept as-is unless `full`)."""
+    conn = open_output_db(OUTPUT_DB, SCHEMA_FILE, full=full)
     logging.info(f"Database initialized at {OUTPUT_DB} using {SCHEMA_FILE}")
     return conn
 
 
-def parse_file(filepath, cursor):
+INSERT_CHAT_SQL = (
+    "INSERT OR IGNORE INTO group1_qq_txt_raw_chats "
+    "(source_file, username, nickname, create_time, content, platform, subfolder, msg_hash) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def parse_rows(filepath):
+    """Parses one chat file into group1_qq_txt_raw_chats row tuples."""
     logging.info(f"Processing {filepath}")
     filename = os.path.basename(filepath)
     # Filename format: Name_QQID.txt
@@ -72,7 +81,7 @@ def parse_file(filepath, cursor):
         lines = f.read().splitlines()
 
     i, msg_start = 0, 0
-    total_msgs = 0
+    rows = []
     while i <= len(lines):
         line = lines[i].strip() if i < len(lines) else "日期: END"
         time_match = re.match(r'^(\d{1,2}:\d{2}:\d{2})$', line) if i < len(lines) else None
@@ -91,13 +100,9 @@ def parse_file(filepath, cursor):
                 ts_str = f"{date_} {time_}"
                 ts = int(datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S").timestamp())
                 m_hash = compute_msg_hash(username, ts, msg)
-                cursor.execute(
-                    "INSERT OR IGNORE INTO group1_qq_txt_raw_chats "
-                    "(source_file, username, nickname, create_time, content, platform, subfolder, msg_hash) "
-                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows.append(
                     (filepath, username, nickname, ts, msg, "qq_txt", qqid, m_hash)
                 )
-                total_msgs += 1
             if i >= len(lines):
                 break
 
@@ -124,12 +129,42 @@ def parse_file(filepath, cursor):
                 time_ = new_time
                 msg_start = i + 1
         i += 1
-    return total_msgs
+    return rows
+
+
+def iter_parsed(files, workers):
+    """Yields (filepath, rows) in file order, parsing on a process pool if workers > 1."""
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {filepath: pool.submit(parse_rows, filepath) for filepath in files}
+            for filepath, future in futures.items():
+                try:
+                    yield filepath, future.result()
+                except Exception as e:
+                    logging.error(f"Failed to process {filepath}: {e}")
+    else:
+        for filepath in files:
+            try:
+                yield filepath, parse_rows(filepath)
+            except Exception as e:
+                logging.error(f"Failed to process {filepath}: {e}")
 
 
 def main():
-    if len(sys.argv) > 1:
-        files = [sys.argv[1]]
+    parser = argparse.ArgumentParser(description="Parse QQ txt chat logs (group 1).")
+    parser.add_argument("file", nargs="?", help="Parse a single file instead of blobs/qq_txt/*.txt.")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of parser processes (default: 1, sequential).",
+    )
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Delete the DB and re-parse every file instead of only changed ones.",
+    )
+    args = parser.parse_args()
+
+    if args.file:
+        files = [args.file]
     else:
         files = glob("blobs/qq_txt/*.txt")
 
@@ -140,19 +175,23 @@ def main():
     logging.info(f"Found {len(files)} files to process.")
 
     # Initialize DB using local schema file
-    conn = init_db()
-    cursor = conn.cursor()
+    conn = init_db(full=args.full)
+    writer = BatchWriter(conn)
+    manifest = IngestManifest(conn, PARSER_VERSION)
+    changed, removed = manifest.plan(sorted(files), prune=not args.file)
+    manifest.purge("group1_qq_txt_raw_chats", "source_file", changed + removed)
+    for filepath in removed:
+        manifest.forget(filepath)
 
     total_extracted = 0
-    for filepath in sorted(files):
-        try:
-            total_extracted += parse_file(filepath, cursor)
-            if total_extracted % 1000 == 0:
-                conn.commit()
-        except Exception as e:
-            logging.error(f"Failed to process {filepath}: {e}")
-
-    conn.commit()
+    for filepath, rows in iter_parsed(changed, args.workers):
+        writer.add_many("group1_qq_txt_raw_chats", INSERT_CHAT_SQL, rows)
+        # Rows must be on disk before the file is marked as ingested
+        writer.flush()
+        manifest.record(filepath)
+        total_extracted += len(rows)
+
+    writer.close()
     conn.close()
     logging.info(f"Processing complete. Total messages: {total_extracted}")
 
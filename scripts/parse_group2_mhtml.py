@@ -6,18 +6,26 @@ Features:
 2. Improved sender and receiver recognition for 1-on-1 AND Group chats.
 3. Detects group context to correctly assign sender/receiver.
 4. Uses global name-to-ID mapping and handles nicknames.
-5. Deduplication based on (sender_id or sender_name), create_time, and content.
+5. Deduplication based on (sender_id or sender_name), create_time, and content:
+   within a file when rows are inserted, across files in the `group2_messages`
+   view (first file in sorted order wins, as in a --full run), so purging
+   one file's rows never hides another file's copy.
+6. Incremental by default: unchanged files are skipped via the ingest manifest;
+   `--full` deletes and rebuilds the DB.
 """
 
+import argparse
 import json
 import logging
 import os
 import re
-import sqlite3
-import sys
 from datetime import datetime
 from glob import glob
 
+from batch_writer import BatchWriter
+from ingest_manifest import IngestManifest, open_output_db
+from mht_stream import iter_mht_rows
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -29,6 +37,25 @@ SCHEMA_FILE = "data/schema/raw/group2_mhtml.sql"
 PARTNERS_MAP_FILE = "data/partners_map.json"
 OWNER_NAME = '几何体'
 OWNER_ID = 610784125
+# Bump when parsing logic changes so every file is re-ingested
+PARSER_VERSION = "2"
+
+# Cross-file dedup happens at query time: every file keeps its own rows
+MESSAGES_VIEW_SQL = """
+CREATE INDEX IF NOT EXISTS idx_group2_raw_mhtml_key
+    ON group2_raw_mhtml(create_time, content);
+CREATE VIEW IF NOT EXISTS group2_messages AS
+SELECT id, source_file, sender_name, sender_id, receiver_name, receiver_id,
+       nicknames, create_time, content
+FROM (
+    SELECT *, ROW_NUMBER() OVER (
+        PARTITION BY COALESCE(sender_id, sender_name), create_time, content
+        ORDER BY source_file, id
+    ) AS copy
+    FROM group2_raw_mhtml
+)
+WHERE copy = 1;
+"""
 
 # Global mappings
 NAME_TO_ID = {}
@@ -49,16 +76,10 @@ def clean_html(html):
     return text.strip()
 
 
-def init_db():
-    """Initialize DB using the local schema file."""
-    if os.path.exists(OUTPUT_DB):
-        os.remove(OUTPUT_DB)
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    with open(SCHEMA_FILE, 'r') as f:
-        schema_sql = f.read()
-    conn = sqlite3.connect(OUTPUT_DB)
-    conn.executescript(schema_sql)
-    conn.commit()
+def init_db(full=False):
+    """Initialize DB using the local schema file (kept as-is unless `full`)."""
+    conn = open_output_db(OUTPUT_DB, SCHEMA_FILE, full=full)
+    conn.executescript(MESSAGES_VIEW_SQL)
     return conn
 
 
@@ -109,7 +130,14 @@ def load_global_mappings():
     logging.info(f"Loaded {len(NAME_TO_ID)} name-to-ID mappings. Identified {len(GROUPS)} groups.")
 
 
-def parse_file(filepath, cursor, seen_msgs):
+INSERT_MSG_SQL = (
+    "INSERT INTO group2_raw_mhtml "
+    "(source_file, sender_name, sender_id, receiver_name, receiver_id, nicknames, create_time, content) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def parse_file(filepath, writer):
     logging.info(f"Processing {filepath}")
     filename = os.path.basename(filepath)
     
@@ -123,18 +151,13 @@ def parse_file(filepath, cursor, seen_msgs):
     current_context_name = ID_TO_NAME.get(current_context_id) if current_context_id else f_name
     is_group_context = current_context_id in GROUPS or current_context_name in GROUPS or 'group' in filename.lower()
 
-    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-        content = f.read()
-
-    html_match = re.search(r'(<html.*</html>)', content, re.DOTALL | re.IGNORECASE)
-    if not html_match: return 0
-    
-    html_content = html_match.group(1)
-    rows = re.findall(r'<tr.*?>(.*?)</tr>', html_content, re.DOTALL)
     current_date = '1900-01-01'
     total_msgs = 0
+    # Repeats within this file; copies in other files are left to group2_messages
+    seen_msgs = set()
     
-    for row in rows:
+    # Rows are streamed from the HTML part so memory stays bounded
+    for row in iter_mht_rows(filepath):
         # Detect Category/Group context change
         cat_match = re.search(r'消息分组:\s*(.*?)($|<)', row.replace('&nbsp;', ' '))
         if cat_match:
@@ -190,10 +213,8 @@ def parse_file(filepath, cursor, seen_msgs):
             if msg_key in seen_msgs: continue
             seen_msgs.add(msg_key)
                 
-            cursor.execute(
-                "INSERT INTO group2_raw_mhtml "
-                "(source_file, sender_name, sender_id, receiver_name, receiver_id, nicknames, create_time, content) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            writer.add(
+                "group2_raw_mhtml", INSERT_MSG_SQL,
                 (filepath, s_name, s_id, r_name, r_id, nickname, ts, clean_content)
             )
             total_msgs += 1
@@ -202,25 +223,39 @@ def parse_file(filepath, cursor, seen_msgs):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Parse QQ MHT chat exports (group 2).")
+    parser.add_argument("file", nargs="?", help="Parse a single file instead of blobs/qq_mht/*.mht.")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Delete the DB and re-parse every file instead of only changed ones.",
+    )
+    args = parser.parse_args()
+
     load_global_mappings()
-    files = [sys.argv[1]] if len(sys.argv) > 1 else glob("blobs/qq_mht/*.mht")
-    if len(sys.argv) == 1:
+    files = [args.file] if args.file else glob("blobs/qq_mht/*.mht")
+    if not args.file:
         # Exclude the large consolidated archive which is now Group 3
         files = [f for f in files if "QQ_chat_history_archive" not in f]
     if not files: return
-    conn = init_db()
-    cursor = conn.cursor()
-    seen_msgs = set()
+    conn = init_db(full=args.full)
+    writer = BatchWriter(conn)
+    manifest = IngestManifest(conn, PARSER_VERSION)
+    changed, removed = manifest.plan(sorted(files), prune=not args.file)
+    manifest.purge("group2_raw_mhtml", "source_file", changed + removed)
+    for filepath in removed:
+        manifest.forget(filepath)
     total_extracted = 0
-    for filepath in sorted(files):
+    for filepath in changed:
         try:
-            count = parse_file(filepath, cursor, seen_msgs)
+            count = parse_file(filepath, writer)
             total_extracted += count
             logging.info(f"Extracted {count} unique messages from {os.path.basename(filepath)}")
-            if total_extracted % 10000 == 0: conn.commit()
+            # Rows must be on disk before the file is marked as ingested
+            writer.flush()
+            manifest.record(filepath)
         except Exception as e:
             logging.error(f"Failed to process {filepath}: {e}")
-    conn.commit()
+    writer.close()
     conn.close()
     logging.info(f"Processing complete. Total unique messages: {total_extracted}")
 
@@ -7,17 +7,22 @@ Features:
 3. Detects group context to correctly assign sender/receiver.
 4. Uses global name-to-ID mapping and handles nicknames.
 5. Deduplication based on (sender_id or sender_name), create_time, and content.
+6. Streams <tr> rows from the archive in chunks (see mht_stream.py) instead of reading it whole.
+7. Skips the run when the archive is unchanged (ingest manifest); `--full` forces a rebuild.
 """
 
+import argparse
 import json
 import logging
 import os
 import re
-import sqlite3
-import sys
 from datetime import datetime
 from glob import glob
 
+from batch_writer import BatchWriter
+from ingest_manifest import IngestManifest, open_output_db
+from mht_stream import iter_mht_rows
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -30,6 +35,8 @@ PARTNERS_MAP_FILE = "data/partners_map.json"
 SOURCE_FILE = "blobs/QQ_chat_history_archive(2007-2018.5).mht"
 OWNER_NAME = '几何体'
 OWNER_ID = 610784125
+# Bump when parsing logic changes so the archive is re-ingested
+PARSER_VERSION = "1"
 
 # Global mappings
 NAME_TO_ID = {}
@@ -50,17 +57,9 @@ def clean_html(html):
     return text.strip()
 
 
-def init_db():
-    """Initialize DB using the local schema file."""
-    if os.path.exists(OUTPUT_DB):
-        os.remove(OUTPUT_DB)
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    with open(SCHEMA_FILE, 'r') as f:
-        schema_sql = f.read()
-    conn = sqlite3.connect(OUTPUT_DB)
-    conn.executescript(schema_sql)
-    conn.commit()
-    return conn
+def init_db(full=False):
+    """Initialize DB using the local schema file (kept as-is unless `full`)."""
+    return open_output_db(OUTPUT_DB, SCHEMA_FILE, full=full)
 
 
 def extract_qq_id(text):
@@ -110,25 +109,25 @@ def load_global_mappings():
     logging.info(f"Loaded {len(NAME_TO_ID)} name-to-ID mappings. Identified {len(GROUPS)} groups.")
 
 
-def parse_file(filepath, cursor, seen_msgs):
+INSERT_MSG_SQL = (
+    "INSERT INTO group3_raw_qq_mht_archive "
+    "(source_file, sender_name, sender_id, receiver_name, receiver_id, nicknames, create_time, content) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def parse_file(filepath, writer, seen_msgs):
     logging.info(f"Processing archive: {filepath}")
     
     current_context_id = None
     current_context_name = "Unknown"
     is_group_context = False
 
-    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-        content = f.read()
-
-    html_match = re.search(r'(<html.*</html>)', content, re.DOTALL | re.IGNORECASE)
-    if not html_match: return 0
-    
-    html_content = html_match.group(1)
-    rows = re.findall(r'<tr.*?>(.*?)</tr>', html_content, re.DOTALL)
     current_date = '1900-01-01'
     total_msgs = 0
     
-    for row in rows:
+    # Rows are streamed from the HTML part so memory stays bounded
+    for row in iter_mht_rows(filepath):
         # Detect Category/Group context change
         cat_match = re.search(r'消息分组:\s*(.*?)($|<)', row.replace('&nbsp;', ' '))
         if cat_match:
@@ -182,10 +181,8 @@ def parse_file(filepath, cursor, seen_msgs):
             if msg_key in seen_msgs: continue
             seen_msgs.add(msg_key)
                 
-            cursor.execute(
-                "INSERT INTO group3_raw_qq_mht_archive "
-                "(source_file, sender_name, sender_id, receiver_name, receiver_id, nicknames, create_time, content) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            writer.add(
+                "group3_raw_qq_mht_archive", INSERT_MSG_SQL,
                 (filepath, s_name, s_id, r_name, r_id, nickname, ts, clean_content)
             )
             total_msgs += 1
@@ -194,18 +191,32 @@ def parse_file(filepath, cursor, seen_msgs):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Parse the consolidated QQ MHT archive (group 3).")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Delete the DB and re-parse even if the archive is unchanged.",
+    )
+    args = parser.parse_args()
+
     load_global_mappings()
     if not os.path.exists(SOURCE_FILE):
         logging.error(f"Source file not found: {SOURCE_FILE}")
         return
         
-    conn = init_db()
-    cursor = conn.cursor()
+    conn = init_db(full=args.full)
+    manifest = IngestManifest(conn, PARSER_VERSION)
+    if manifest.is_current(SOURCE_FILE):
+        logging.info(f"Archive unchanged since last run, nothing to do: {SOURCE_FILE}")
+        conn.close()
+        return
+    manifest.purge("group3_raw_qq_mht_archive", "source_file", [SOURCE_FILE])
+    writer = BatchWriter(conn)
     seen_msgs = set()
     
     try:
-        count = parse_file(SOURCE_FILE, cursor, seen_msgs)
-        conn.commit()
+        count = parse_file(SOURCE_FILE, writer, seen_msgs)
+        writer.close()
+        manifest.record(SOURCE_FILE)
         logging.info(f"Processing complete. Total unique messages from archive: {count}")
     except Exception as e:
         logging.error(f"Failed to process archive: {e}")
@@ -9,29 +9,34 @@ Features:
 1. Parses contacts, messages, moments, and media from iOS backup.
 2. Uses local schema file for database initialization.
 3. Deduplication based on message hash.
-4. Converts WeChat Silk (.aud/.silk) to MP3 using pilk and ffmpeg.
-5. Media path: data/media/wechat_media/<contact folder hash>/<fileID>.<ext>
+4. Converts WeChat Silk (.aud/.silk) to MP3 in memory (audio_transcode).
+5. Media path: data/media/wechat_media/<contact folder hash>/<fileID>.<ext>, a hard
+   link into the content-addressed blob store (media_store); duplicate content
+   is stored once and `media_blob_refs` maps each media row to its blob.
 6. Converts .video_thum to .jpg (they are JPEG files).
 7. Converts various .pic* and .dftemp formats to .jpg or .png based on file content.
 8. Extracts nicknames and remarks from WCDB_Contact.sqlite blobs.
+9. `--workers N` copies and converts media on a process pool; the main process
+   is the only writer.
+10. Skips the run when the backup's Manifest.db is unchanged (ingest manifest);
+    a changed backup, or `--full`, rebuilds the DB.
 """
 
+import argparse
 import hashlib
 import logging
 import os
 import shutil
 import sqlite3
-import sys
-import subprocess
 import re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-# Try to import pilk for Silk decoding
-try:
-    import pilk
-    HAS_PILK = True
-except ImportError:
-    HAS_PILK = False
+from audio_transcode import convert_silk_to_mp3
+from batch_writer import BatchWriter
+from ingest_manifest import IngestManifest, open_output_db
+from ios_manifest import ManifestIndex
+from media_store import BLOB_DIR, BLOB_REFS_SQL, INSERT_BLOB_REF_SQL, MediaStore
 
 # Setup logging
 logging.basicConfig(
@@ -45,19 +50,47 @@ PARTNERS_MAP_FILE = "data/partners_map.json"
 OWNER_NAME = '几何体'
 OWNER_ID = 610784125
 MEDIA_ROOT = "data/media/wechat_media"
+MEDIA_STORE = MediaStore(MEDIA_ROOT)
 IOS_BACKUP_DIR = "blobs/Wechat2/4c29b1307decf4b1224800b65ab52a877104e9d3"
+# Upper bound on media jobs handed to a pool worker at once
+MEDIA_CHUNK_SIZE = 64
+# Bump when parsing logic changes so the backup is re-ingested
+PARSER_VERSION = "1"
+
+# Friend rows overwrite names only when the blob yielded something
+UPSERT_CONTACT_SQL = (
+    "INSERT INTO group4_raw_contacts (username, type, nickname, remark) "
+    "VALUES (?, ?, ?, ?) ON CONFLICT(username) DO UPDATE SET "
+    "nickname = excluded.nickname, remark = excluded.remark "
+    "WHERE excluded.nickname IS NOT NULL OR excluded.remark IS NOT NULL"
+)
+# Moments nicknames only fill contacts that have no nickname yet
+UPSERT_NICKNAME_SQL = (
+    "INSERT INTO group4_raw_contacts (username, nickname) VALUES (?, ?) "
+    "ON CONFLICT(username) DO UPDATE SET nickname = excluded.nickname "
+    "WHERE group4_raw_contacts.nickname IS NULL"
+)
+INSERT_MOMENT_SQL = (
+    "INSERT OR IGNORE INTO group4_raw_moments "
+    "(id, username, nickname, create_time, content, msg_hash) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+INSERT_MESSAGE_SQL = (
+    "INSERT OR IGNORE INTO group4_raw_messages "
+    "(username, create_time, content, local_id, "
+    "source, msg_hash) VALUES (?, ?, ?, ?, ?, ?)"
+)
+INSERT_MEDIA_SQL = (
+    "INSERT OR IGNORE INTO group4_raw_media "
+    "(id, username, type, relative_path, original_path, "
+    "file_size, source) VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
 
 
-def init_db():
-    """Initialize DB using the local schema file."""
-    if os.path.exists(OUTPUT_DB):
-        os.remove(OUTPUT_DB)
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    with open(SCHEMA_FILE, 'r') as f:
-        schema_sql = f.read()
-    conn = sqlite3.connect(OUTPUT_DB)
-    conn.executescript(schema_sql)
-    conn.commit()
+def init_db(full=False):
+    """Initialize DB using the local schema file (kept as-is unless `full`)."""
+    conn = open_output_db(OUTPUT_DB, SCHEMA_FILE, full=full)
+    conn.executescript(BLOB_REFS_SQL)
     return conn
 
 
@@ -68,67 +101,6 @@ def load_global_mappings():
     pass
 
 
-def convert_silk_to_mp3(src_path):
-    """Converts WeChat Silk (.aud/.silk) to MP3 using pilk and ffmpeg."""
-    if not HAS_PILK:
-        logging.warning("pilk not installed, skipping silk conversion.")
-        return src_path
-
-    # Check for silk v3 header (might have 0x02 prefix)
-    if not os.path.exists(src_path):
-        return src_path
-        
-    with open(src_path, "rb") as f:
-        header = f.read(10)
-    
-    is_silk = False
-    actual_silk_path = src_path
-    temp_silk = None
-
-    if header.startswith(b"#!SILK_V3"):
-        is_silk = True
-    elif header.startswith(b"\x02#!SILK_V3"):
-        is_silk = True
-        # Need to strip the first byte for some decoders
-        temp_silk = src_path + ".tmp.silk"
-        with open(src_path, "rb") as f:
-            f.seek(1)
-            with open(temp_silk, "wb") as tf:
-                tf.write(f.read())
-        actual_silk_path = temp_silk
-
-    if not is_silk:
-        return src_path
-
-    dest_path = os.path.splitext(src_path)[0] + ".mp3"
-    pcm_path = src_path + ".pcm"
-    
-    try:
-        # 1. Decode Silk to PCM
-        pilk.decode(actual_silk_path, pcm_path)
-        
-        # 2. Encode PCM to MP3
-        cmd = [
-            "ffmpeg", "-y", "-loglevel", "error",
-            "-f", "s16le", "-ar", "24000", "-ac", "1",
-            "-i", pcm_path,
-            dest_path
-        ]
-        subprocess.run(cmd, check=True)
-        # Cleanup original silk in destination if converted
-        if os.path.exists(dest_path) and dest_path != src_path:
-            os.remove(src_path)
-        return dest_path
-    except Exception as e:
-        logging.error(f"Error converting silk {src_path}: {e}")
-        return src_path
-    finally:
-        if os.path.exists(pcm_path):
-            os.remove(pcm_path)
-        if temp_silk and os.path.exists(temp_silk):
-            os.remove(temp_silk)
-
-
 def convert_video_thum_to_jpg(src_path):
     """Renames .video_thum to .jpg as they are usually JPEGs."""
     if not src_path.lower().endswith(".video_thum"):
@@ -178,33 +150,6 @@ def convert_image(src_path):
         return src_path
 
 
-def get_file_path(backup_dir, manifest_db, relative_path):
-    """Map iOS relative path to the actual file ID in the backup folder."""
-    if not os.path.exists(manifest_db):
-        return None
-    try:
-        conn = sqlite3.connect(manifest_db)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT fileID FROM Files WHERE relativePath = ?", (relative_path,)
-        )
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            file_id = row[0]
-            # Newer backups use subfolders based on first 2 chars of fileID
-            path = os.path.join(backup_dir, file_id[:2], file_id)
-            if os.path.exists(path):
-                return path
-            # Older backups might have everything in the root
-            root_path = os.path.join(backup_dir, file_id)
-            if os.path.exists(root_path):
-                return root_path
-    except Exception as e:
-        logging.error(f"Error querying Manifest.db: {e}")
-    return None
-
-
 def clean_blob(blob_data):
     """Extract human readable strings from WeChat BLOBs."""
     if not blob_data or not isinstance(blob_data, bytes):
@@ -249,7 +194,80 @@ def compute_msg_hash(username, create_time, content):
     return hashlib.md5(base_str.encode('utf-8', errors='replace')).hexdigest()
 
 
-def parse_ios_backup(backup_dir, out_conn):
+def convert_media(path, mtype):
+    """Converts a copied media file to a standard format if needed."""
+    # Convert silk/aud to mp3 if needed
+    if mtype == "audio" and path.lower().endswith((".aud", ".silk")):
+        return convert_silk_to_mp3(path)
+    elif path.lower().endswith(".video_thum"):
+        return convert_video_thum_to_jpg(path)
+    elif path.lower().endswith((".pic", ".pic_hd", ".pic_thum", ".pic_mid", ".pic_cmid", ".dftemp")):
+        return convert_image(path)
+    return path
+
+
+def process_media(job):
+    """
+    Stores one backup media file in the blob store (converting it if the
+    content is new) and links it at its MEDIA_ROOT path.
+    Returns (job, (final_rel_path, size, content_hash, blob_rel_path)), or
+    (job, None) on failure.
+    Runs in pool workers, so it must not touch the output DB.
+    """
+    fid, rel, mtype, src_path, user_hash = job
+    parts = rel.split("/")
+    # Identify contact folder hash from path
+    # Pattern: Documents/{user_hash}/Audio/{contact_hash}/...
+    contact_folder_hash = user_hash
+    if len(parts) >= 5:
+        contact_folder_hash = parts[3]
+
+    # Get extension from the original backup path
+    file_ext = os.path.splitext(parts[-1])[1]
+    if not file_ext:
+        if mtype == "image": file_ext = ".jpg"
+        elif mtype == "video": file_ext = ".mp4"
+        elif mtype == "audio": file_ext = ".aud"
+
+    dest_filename = fid + file_ext
+    dest_rel_path = os.path.join(contact_folder_hash, dest_filename)
+    dest_path = os.path.join(MEDIA_ROOT, dest_rel_path)
+
+    try:
+        digest, final_dest_path, blob = MEDIA_STORE.place(
+            src_path, dest_path, convert=lambda path: convert_media(path, mtype)
+        )
+        final_rel_path = os.path.relpath(final_dest_path, MEDIA_ROOT)
+        return job, (
+            final_rel_path, os.path.getsize(final_dest_path),
+            digest, MEDIA_STORE.relpath(blob),
+        )
+    except Exception as e:
+        logging.error(f"Error copying/converting media {rel}: {e}")
+        return job, None
+
+
+def iter_media_results(jobs, workers):
+    """
+    Yields (job, result) for successfully processed media, in job order.
+    With workers > 1 the copy/convert work (file I/O, pilk, ffmpeg) runs on a
+    process pool; the caller stays the only writer to the output DB.
+    """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, min(MEDIA_CHUNK_SIZE, len(jobs) // (workers * 4)))
+            results = pool.map(process_media, jobs, chunksize=chunksize)
+            for job, result in results:
+                if result:
+                    yield job, result
+    else:
+        for job in jobs:
+            job, result = process_media(job)
+            if result:
+                yield job, result
+
+
+def parse_ios_backup(backup_dir, writer, workers=1):
     """Main parsing logic for iOS backups."""
     logging.info(f"Parsing iOS backup: {backup_dir}")
     manifest_db = os.path.join(backup_dir, "Manifest.db")
@@ -257,26 +275,13 @@ def parse_ios_backup(backup_dir, out_conn):
         logging.warning(f"Manifest.db not found in {backup_dir}")
         return
 
-    out_cursor = out_conn.cursor()
+    out_conn = writer.conn
+
+    # Load Manifest.db once; all lookups below are in-memory
+    index = ManifestIndex(backup_dir)
 
     # Identify user hashes (32-char hex folders in Documents)
-    user_hashes = []
-    try:
-        conn = sqlite3.connect(manifest_db)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT DISTINCT substr(relativePath, 11, 32) FROM Files "
-            "WHERE domain LIKE '%com.tencent.xin%' "
-            "AND relativePath LIKE 'Documents/________________________________/%'"
-        )
-        user_hashes = [
-            row[0]
-            for row in cursor.fetchall()
-            if row[0] and len(row[0]) == 32 and row[0] != "0" * 32
-        ]
-        conn.close()
-    except Exception as e:
-        logging.error(f"Error finding user hashes: {e}")
+    user_hashes = [h for h in index.user_hashes() if h != "0" * 32]
 
     if not user_hashes:
         logging.warning(f"No user hashes found in {backup_dir}")
@@ -289,7 +294,7 @@ def parse_ios_backup(backup_dir, out_conn):
 
         # 1. Contacts (WCDB_Contact.sqlite)
         contact_db_rel = f"Documents/{user_hash}/DB/WCDB_Contact.sqlite"
-        contact_db_path = get_file_path(backup_dir, manifest_db, contact_db_rel)
+        contact_db_path = index.path_for(contact_db_rel)
         if contact_db_path:
             conn = sqlite3.connect(contact_db_path)
             cursor = conn.cursor()
@@ -302,17 +307,12 @@ def parse_ios_backup(backup_dir, out_conn):
                     utype = row[1]
                     unick = clean_blob(row[2])
                     uremark = clean_blob(row[3])
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group4_raw_contacts "
-                        "(username, type, nickname, remark) VALUES (?, ?, ?, ?)",
+                    writer.add(
+                        "group4_raw_contacts", UPSERT_CONTACT_SQL,
                         (uname, utype, unick, uremark),
                     )
-                    # Update if already exists but has no names
-                    if unick or uremark:
-                        out_cursor.execute(
-                            "UPDATE group4_raw_contacts SET nickname = ?, remark = ? "
-                            "WHERE username = ?", (unick, uremark, uname),
-                        )
+                # Moments nicknames below must see these rows
+                writer.flush("group4_raw_contacts")
                 logging.info(f"Processed {len(rows)} contacts.")
             except Exception as e:
                 logging.error(f"Error parsing contacts: {e}")
@@ -320,7 +320,7 @@ def parse_ios_backup(backup_dir, out_conn):
 
         # 2. Moments & Nicknames (wc005_008.db)
         wc_db_rel = f"Documents/{user_hash}/wc/wc005_008.db"
-        wc_db_path = get_file_path(backup_dir, manifest_db, wc_db_rel)
+        wc_db_path = index.path_for(wc_db_rel)
         if wc_db_path:
             conn = sqlite3.connect(wc_db_path)
             cursor = conn.cursor()
@@ -330,17 +330,10 @@ def parse_ios_backup(backup_dir, out_conn):
                     "SELECT DISTINCT FromUser, from_nickname FROM MyWC_Message01 "
                     "WHERE from_nickname IS NOT NULL AND from_nickname != ''"
                 )
-                for row in cursor.fetchall():
-                    out_cursor.execute(
-                        "UPDATE group4_raw_contacts SET nickname = ? "
-                        "WHERE username = ? AND nickname IS NULL", (row[1], row[0]),
-                    )
-                    if out_cursor.rowcount == 0:
-                        out_cursor.execute(
-                            "INSERT OR IGNORE INTO group4_raw_contacts "
-                            "(username, nickname) VALUES (?, ?)",
-                            (row[0], row[1]),
-                        )
+                writer.add_many(
+                    "group4_raw_contacts", UPSERT_NICKNAME_SQL, cursor.fetchall()
+                )
+                writer.flush("group4_raw_contacts")
 
                 # Insert moments
                 cursor.execute(
@@ -350,10 +343,8 @@ def parse_ios_backup(backup_dir, out_conn):
                 rows = cursor.fetchall()
                 for row in rows:
                     m_hash = compute_msg_hash(row[1], row[3], row[4])
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group4_raw_moments "
-                        "(id, username, nickname, create_time, content, msg_hash) "
-                        "VALUES (?, ?, ?, ?, ?, ?)", (*row, m_hash),
+                    writer.add(
+                        "group4_raw_moments", INSERT_MOMENT_SQL, (*row, m_hash)
                     )
                 logging.info(f"Processed {len(rows)} moments.")
             except Exception as e:
@@ -362,7 +353,7 @@ def parse_ios_backup(backup_dir, out_conn):
 
         # 3. Messages from FTS (fts_message.db)
         fts_db_rel = f"Documents/{user_hash}/fts/fts_message.db"
-        fts_db_path = get_file_path(backup_dir, manifest_db, fts_db_rel)
+        fts_db_path = index.path_for(fts_db_rel)
         total_msgs = 0
         if fts_db_path:
             conn = sqlite3.connect(fts_db_path)
@@ -383,10 +374,8 @@ def parse_ios_backup(backup_dir, out_conn):
                     for row in rows:
                         username = user_map.get(row[0], f"unknown_{row[0]}")
                         m_hash = compute_msg_hash(username, row[1], row[2])
-                        out_cursor.execute(
-                            "INSERT OR IGNORE INTO group4_raw_messages "
-                            "(username, create_time, content, local_id, "
-                            "source, msg_hash) VALUES (?, ?, ?, ?, ?, ?)",
+                        writer.add(
+                            "group4_raw_messages", INSERT_MESSAGE_SQL,
                             (username, row[1], row[2], row[3], source_name, m_hash),
                         )
                     total_msgs += len(rows)
@@ -394,87 +383,29 @@ def parse_ios_backup(backup_dir, out_conn):
             except Exception as e:
                 logging.error(f"Error parsing FTS messages: {e}")
             conn.close()
+            writer.flush("group4_raw_messages")
             verify_insertion(
                 out_conn, "group4_raw_messages", source_name,
                 expected_min=total_msgs
             )
 
-        # 4. Media Mapping
-        conn = sqlite3.connect(manifest_db)
-        cursor = conn.cursor()
-        media_patterns = [
-            (f"Documents/{user_hash}/Audio/%", "audio"),
-            (f"Documents/{user_hash}/Video/%", "video"),
-            (f"Documents/{user_hash}/OpenData/%", "image"),
-            (f"Documents/{user_hash}/Img/%", "image"),
-        ]
+        # 4. Media Mapping (Audio, Video, OpenData, Img)
+        jobs = []
+        for fid, rel, mtype in index.media(user_hash):
+            src_path = index.resolve(fid)
+            if src_path:
+                jobs.append((fid, rel, mtype, src_path, user_hash))
         total_media = 0
-        for pattern, mtype in media_patterns:
-            cursor.execute(
-                "SELECT fileID, relativePath FROM Files "
-                "WHERE domain LIKE '%com.tencent.xin%' "
-                "AND relativePath LIKE ?", (pattern,),
+        for job, result in iter_media_results(jobs, workers):
+            fid, rel, mtype, _, _ = job
+            final_rel_path, size, digest, blob_rel_path = result
+            writer.add(
+                "group4_raw_media", INSERT_MEDIA_SQL,
+                (fid, user_hash, mtype, final_rel_path, rel, size, source_name),
             )
-            for fid, rel in cursor.fetchall():
-                src_path = os.path.join(backup_dir, fid[:2], fid)
-                if not os.path.exists(src_path):
-                    src_path = os.path.join(backup_dir, fid)
-                if not os.path.exists(src_path):
-                    continue
-
-                parts = rel.split("/")
-                # Identify contact folder hash from path
-                # Pattern: Documents/{user_hash}/Audio/{contact_hash}/...
-                contact_folder_hash = user_hash
-                if len(parts) >= 5:
-                    contact_folder_hash = parts[3]
-
-                # Get extension from the original backup path
-                file_ext = os.path.splitext(parts[-1])[1]
-                if not file_ext:
-                    if mtype == "image": file_ext = ".jpg"
-                    elif mtype == "video": file_ext = ".mp4"
-                    elif mtype == "audio": file_ext = ".aud"
-                
-                dest_filename = fid + file_ext
-                dest_rel_path = os.path.join(contact_folder_hash, dest_filename)
-                dest_path = os.path.join(MEDIA_ROOT, dest_rel_path)
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                
-                try:
-                    if not os.path.exists(dest_path):
-                        shutil.copy2(src_path, dest_path)
-                    
-                    # Convert silk/aud to mp3 if needed
-                    final_dest_path = dest_path
-                    final_rel_path = dest_rel_path
-                    if mtype == "audio" and dest_path.lower().endswith((".aud", ".silk")):
-                        converted_path = convert_silk_to_mp3(dest_path)
-                        if converted_path != dest_path:
-                            final_dest_path = converted_path
-                            final_rel_path = os.path.relpath(final_dest_path, MEDIA_ROOT)
-                    elif dest_path.lower().endswith(".video_thum"):
-                        converted_path = convert_video_thum_to_jpg(dest_path)
-                        if converted_path != dest_path:
-                            final_dest_path = converted_path
-                            final_rel_path = os.path.relpath(final_dest_path, MEDIA_ROOT)
-                    elif dest_path.lower().endswith((".pic", ".pic_hd", ".pic_thum", ".pic_mid", ".pic_cmid", ".dftemp")):
-                        converted_path = convert_image(dest_path)
-                        if converted_path != dest_path:
-                            final_dest_path = converted_path
-                            final_rel_path = os.path.relpath(final_dest_path, MEDIA_ROOT)
-
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group4_raw_media "
-                        "(id, username, type, relative_path, original_path, "
-                        "file_size, source) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (fid, user_hash, mtype, final_rel_path, rel,
-                         os.path.getsize(final_dest_path), source_name),
-                    )
-                    total_media += 1
-                except Exception as e:
-                    logging.error(f"Error copying/converting media {rel}: {e}")
-        conn.close()
+            writer.add("media_blob_refs", INSERT_BLOB_REF_SQL, (fid, digest, blob_rel_path))
+            total_media += 1
+        writer.flush("group4_raw_media")
         verify_insertion(
             out_conn, "group4_raw_media", source_name, expected_min=total_media
         )
@@ -488,23 +419,50 @@ def cleanup_old_structures():
     for item in os.listdir(MEDIA_ROOT):
         item_path = os.path.join(MEDIA_ROOT, item)
         if os.path.isdir(item_path):
-            # If not a 32-char hex string, remove it
-            if not re.match(r'^[0-9a-f]{32}$', item):
+            # If not a 32-char hex string (or the blob store), remove it
+            if item != BLOB_DIR and not re.match(r'^[0-9a-f]{32}$', item):
                 logging.info(f"Removing old folder: {item}")
                 shutil.rmtree(item_path)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Parse a WeChat iOS backup (group 4).")
+    parser.add_argument("backup_dir", nargs="?", default=IOS_BACKUP_DIR, help="iOS backup folder.")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Delete the DB and re-parse even if the backup is unchanged.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of media copy/convert processes (default: 1, sequential).",
+    )
+    args = parser.parse_args()
+
     load_global_mappings()
-    backup_dir = sys.argv[1] if len(sys.argv) > 1 else IOS_BACKUP_DIR
+    backup_dir = args.backup_dir
     
     if not os.path.exists(backup_dir):
         logging.info(f"Directory not found: {backup_dir}")
         return
 
-    conn = init_db()
-    parse_ios_backup(backup_dir, conn)
-    conn.commit()
+    manifest_db = os.path.join(backup_dir, "Manifest.db")
+    conn = init_db(full=args.full)
+    manifest = IngestManifest(conn, PARSER_VERSION)
+    if os.path.exists(manifest_db) and manifest.is_current(manifest_db):
+        logging.info(f"Backup unchanged since last run, nothing to do: {backup_dir}")
+        conn.close()
+        return
+    if not args.full:
+        # A changed backup touches every table (contacts have no source), so rebuild
+        conn.close()
+        conn = init_db(full=True)
+        manifest = IngestManifest(conn, PARSER_VERSION)
+
+    writer = BatchWriter(conn)
+    parse_ios_backup(backup_dir, writer, workers=args.workers)
+    writer.close()
+    if os.path.exists(manifest_db):
+        manifest.record(manifest_db)
     conn.close()
     
     cleanup_old_structures()
@@ -10,18 +10,28 @@ Features:
 4. Converts XML-formatted messages to descriptive plain text (Title + Description).
 5. Links media files to contacts using filename hash fragments.
 6. Converts AMR to MP3 and identifies image formats.
+7. Incremental by default: unchanged MM*.sqlite files (ingest manifest) and media
+   files already in group5_raw_media are skipped; `--full` rebuilds the DB.
+   A database that fails to parse is not recorded, so the next run retries it.
+8. Messages are keyed per source DB; copies found in several DBs are counted
+   once in the `group5_messages` view (first source in sorted order wins), so
+   purging one source never hides another source's copy.
 """
 
+import argparse
 import hashlib
 import logging
 import os
 import re
-import shutil
 import sqlite3
-import subprocess
 from datetime import datetime
 import xml.etree.ElementTree as ET
 
+from audio_transcode import FFMPEG_BATCH_SIZE, transcode_amr_batch
+from batch_writer import BatchWriter
+from ingest_manifest import IngestManifest, open_output_db
+from media_store import BLOB_REFS_SQL, INSERT_BLOB_REF_SQL, MediaStore
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -35,22 +45,56 @@ OLD_WECHAT_DB = "blobs/old_wechat.sqlite"
 GROUP4_DB = "data/db/raw/group4_wechat_ios.sqlite"
 GROUP8_DB = "data/db/raw/group8_wechat_txt.sqlite"
 MEDIA_ROOT = "data/media/wechat_media"
+MEDIA_STORE = MediaStore(MEDIA_ROOT)
+# Bump when parsing logic changes so every source is re-ingested
+PARSER_VERSION = "2"
+# Unique key of group5_raw_messages since PARSER_VERSION 2 (was msg_hash alone)
+MESSAGES_KEY = "UNIQUE (source, msg_hash)"
+
+# Cross-source dedup happens at query time: every source keeps its own rows
+MESSAGES_VIEW_SQL = """
+CREATE INDEX IF NOT EXISTS idx_group5_raw_messages_hash ON group5_raw_messages(msg_hash);
+CREATE VIEW IF NOT EXISTS group5_messages AS
+SELECT id, username, create_time, content, local_id, source, msg_hash
+FROM (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY msg_hash ORDER BY source, id) AS copy
+    FROM group5_raw_messages
+)
+WHERE copy = 1;
+"""
+
+INSERT_CONTACT_SQL = (
+    "INSERT OR IGNORE INTO group5_raw_contacts (username, nickname) VALUES (?, ?)"
+)
+INSERT_MESSAGE_SQL = (
+    "INSERT OR IGNORE INTO group5_raw_messages "
+    "(username, create_time, content, local_id, source, msg_hash) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+INSERT_MEDIA_SQL = (
+    "INSERT OR IGNORE INTO group5_raw_media "
+    "(id, username, type, relative_path, original_path, file_size, source) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
 
 
-def init_db():
-    """Initialize DB using the local schema file."""
-    if os.path.exists(OUTPUT_DB):
-        os.remove(OUTPUT_DB)
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    with open(SCHEMA_FILE, 'r') as f:
-        schema_sql = f.read()
-    conn = sqlite3.connect(OUTPUT_DB)
-    conn.executescript(schema_sql)
-    conn.commit()
+def init_db(full=False):
+    """Initialize DB using the local schema file (kept as-is unless `full`)."""
+    conn = open_output_db(OUTPUT_DB, SCHEMA_FILE, full=full)
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'group5_raw_messages'"
+    ).fetchone()
+    if row and MESSAGES_KEY not in row[0]:
+        # Old layout: the parser version bump re-ingests every source into the new table
+        logging.warning("Rebuilding group5_raw_messages with a per-source key.")
+        with open(SCHEMA_FILE, 'r') as f:
+            conn.executescript(f"DROP TABLE group5_raw_messages;\n{f.read()}")
+    conn.executescript(BLOB_REFS_SQL)
+    conn.executescript(MESSAGES_VIEW_SQL)
     return conn
 
 
-def get_contact_mapping(out_conn):
+def get_contact_mapping(writer):
     """
     Aggregates contact info from master databases.
     Returns:
@@ -62,8 +106,6 @@ def get_contact_mapping(out_conn):
     hash_to_id = {}
     prefix_to_id = {}
     
-    out_cursor = out_conn.cursor()
-    
     # Sources to check
     sources = [
         (OLD_WECHAT_DB, "SELECT username, nickname FROM contacts"),
@@ -88,10 +130,7 @@ def get_contact_mapping(out_conn):
                 prefix_to_id[uhash[:8]] = uname
                 
                 # Pre-populate output DB contacts
-                out_cursor.execute(
-                    "INSERT OR IGNORE INTO group5_raw_contacts (username, nickname) VALUES (?, ?)",
-                    (uname, unick)
-                )
+                writer.add("group5_raw_contacts", INSERT_CONTACT_SQL, (uname, unick))
             conn.close()
         except Exception as e:
             logging.error(f"Error loading contacts from {db_path}: {e}")
@@ -159,16 +198,6 @@ def clean_xml_content(content):
         return " | ".join(parts) if parts else content
 
 
-def convert_amr_to_mp3(src_path, dest_path):
-    """Converts AMR to MP3."""
-    try:
-        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-i", src_path, dest_path]
-        subprocess.run(cmd, check=True)
-        return True
-    except Exception:
-        return False
-
-
 def identify_format_and_fix_ext(file_path):
     """Identifies format and fixes extension."""
     if not os.path.exists(file_path): return file_path
@@ -196,14 +225,13 @@ def compute_msg_hash(username, create_time, content):
     return hashlib.md5(base_str.encode('utf-8', errors='replace')).hexdigest()
 
 
-def parse_wcdb_sqlite(sqlite_path, out_conn, id_to_nick, hash_to_id):
-    """Parses standard WeChat message tables."""
+def parse_wcdb_sqlite(sqlite_path, writer, id_to_nick, hash_to_id):
+    """Parses standard WeChat message tables; raises if the DB cannot be read."""
     logging.info(f"Parsing WCDB messages: {sqlite_path}")
     source_name = f"sqlite_{os.path.basename(sqlite_path)}"
-    out_cursor = out_conn.cursor()
 
+    conn = sqlite3.connect(sqlite_path)
     try:
-        conn = sqlite3.connect(sqlite_path)
         cursor = conn.cursor()
         
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Chat_%' AND name NOT LIKE 'ChatExt%'")
@@ -217,10 +245,7 @@ def parse_wcdb_sqlite(sqlite_path, out_conn, id_to_nick, hash_to_id):
             nickname = id_to_nick.get(username, f"Unknown_{username[:8]}")
             
             # Ensure contact is logged
-            out_cursor.execute(
-                "INSERT OR IGNORE INTO group5_raw_contacts (username, nickname) VALUES (?, ?)",
-                (username, nickname)
-            )
+            writer.add("group5_raw_contacts", INSERT_CONTACT_SQL, (username, nickname))
             
             cursor.execute(f"PRAGMA table_info({table})")
             columns = [c[1].lower() for c in cursor.fetchall()]
@@ -233,24 +258,60 @@ def parse_wcdb_sqlite(sqlite_path, out_conn, id_to_nick, hash_to_id):
                 if not row[1]: continue
                 clean_content = clean_xml_content(row[1])
                 m_hash = compute_msg_hash(username, row[0], clean_content)
-                out_cursor.execute(
-                    "INSERT OR IGNORE INTO group5_raw_messages "
-                    "(username, create_time, content, local_id, source, msg_hash) "
-                    "VALUES (?, ?, ?, ?, ?, ?)",
+                writer.add(
+                    "group5_raw_messages", INSERT_MESSAGE_SQL,
                     (username, row[0], clean_content, row[2], source_name, m_hash)
                 )
                 total_msgs += 1
         
-        conn.close()
         logging.info(f"Inserted {total_msgs} messages from {sqlite_path}")
-    except Exception as e:
-        logging.error(f"Error parsing messages from {sqlite_path}: {e}")
+    finally:
+        conn.close()
+
 
+def add_media_row(writer, row, final_path):
+    """Queues one group5_raw_media row, typed by the final file extension."""
+    file_id, real_id, src_path, source_name, digest, blob_rel_path = row
+    mtype = "unknown"
+    if final_path.lower().endswith((".jpg", ".png", ".gif")): mtype = "image"
+    elif final_path.lower().endswith(".mp3"): mtype = "audio"
+    
+    rel_path = os.path.relpath(final_path, MEDIA_ROOT)
+    
+    writer.add(
+        "group5_raw_media", INSERT_MEDIA_SQL,
+        (file_id, real_id, mtype, rel_path, src_path, os.path.getsize(final_path), source_name)
+    )
+    writer.add("media_blob_refs", INSERT_BLOB_REF_SQL, (file_id, digest, blob_rel_path))
+
+
+def flush_media(writer, pending):
+    """
+    Stores the queued files in the blob store and writes their rows. AMR clips
+    are converted to MP3 (one ffmpeg run per batch) before they become blobs;
+    a failed clip is stored as .amr.
+    """
+    placed = MEDIA_STORE.place_many(
+        [(src_path, dest_path) for src_path, dest_path, _ in pending],
+        convert=identify_format_and_fix_ext, convert_batch=transcode_amr_batch,
+    )
+    count = 0
+    for (src_path, _, row), result in zip(pending, placed):
+        if result is None:
+            continue
+        digest, final_path, blob = result
+        try:
+            add_media_row(writer, row + (digest, MEDIA_STORE.relpath(blob)), final_path)
+            count += 1
+        except Exception as e:
+            logging.error(f"Error processing media {src_path}: {e}")
+    pending.clear()
+    return count
 
-def parse_media(wechat_dir, out_conn, hash_to_id, prefix_to_id):
+
+def parse_media(wechat_dir, writer, hash_to_id, prefix_to_id):
     """Scans media folders and logs files using fuzzy matching."""
     logging.info("Scanning media folders...")
-    out_cursor = out_conn.cursor()
     source_name = "wechat_legacy_media"
     media_count = 0
 
@@ -259,12 +320,20 @@ def parse_media(wechat_dir, out_conn, hash_to_id, prefix_to_id):
     # Sort by length to prefer longer matches
     sorted_prefixes = sorted(prefix_to_id.keys(), key=len, reverse=True)
 
+    # Media files are immutable; ids already present came from earlier runs
+    writer.flush("group5_raw_media")
+    known_ids = {r[0] for r in writer.conn.execute("SELECT id FROM group5_raw_media")}
+    # (src, dest, row) queued for the blob store, converted a batch at a time
+    pending = []
+
     for mdir in media_dirs:
         if not os.path.exists(mdir): continue
         for root, _, files in os.walk(mdir):
             for f in files:
                 if f.startswith(".") or f == "index.dat": continue
                 src_path = os.path.join(root, f)
+                file_id = hashlib.md5(src_path.encode()).hexdigest()
+                if file_id in known_ids: continue
                 
                 # Identify contact by hash or prefix in filename
                 real_id = "legacy_unknown"
@@ -281,55 +350,55 @@ def parse_media(wechat_dir, out_conn, hash_to_id, prefix_to_id):
                             real_id = prefix_to_id[p]
                             break
                 
-                dest_dir = os.path.join(MEDIA_ROOT, real_id)
-                os.makedirs(dest_dir, exist_ok=True)
-                dest_path = os.path.join(dest_dir, f)
-                
-                try:
-                    if not os.path.exists(dest_path):
-                        shutil.copy2(src_path, dest_path)
-                    
-                    final_path = identify_format_and_fix_ext(dest_path)
-                    if final_path.lower().endswith(".amr"):
-                        mp3_path = os.path.splitext(final_path)[0] + ".mp3"
-                        if convert_amr_to_mp3(final_path, mp3_path):
-                            os.remove(final_path)
-                            final_path = mp3_path
-                    
-                    mtype = "unknown"
-                    if final_path.lower().endswith((".jpg", ".png", ".gif")): mtype = "image"
-                    elif final_path.lower().endswith(".mp3"): mtype = "audio"
-                    
-                    rel_path = os.path.relpath(final_path, MEDIA_ROOT)
-                    file_id = hashlib.md5(src_path.encode()).hexdigest()
-                    
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group5_raw_media "
-                        "(id, username, type, relative_path, original_path, file_size, source) "
-                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (file_id, real_id, mtype, rel_path, src_path, os.path.getsize(final_path), source_name)
-                    )
-                    media_count += 1
-                except Exception as e:
-                    logging.error(f"Error processing media {src_path}: {e}")
+                dest_path = os.path.join(MEDIA_ROOT, real_id, f)
+                # Stored once per content; dest_path becomes a link to the blob
+                pending.append((src_path, dest_path, (file_id, real_id, src_path, source_name)))
+                if len(pending) >= FFMPEG_BATCH_SIZE:
+                    media_count += flush_media(writer, pending)
+
+    media_count += flush_media(writer, pending)
 
     logging.info(f"Extracted {media_count} media files.")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Parse WeChat WCDB databases and media (group 5).")
+    parser.add_argument("--full", action="store_true", help="Delete the DB and re-parse every source.")
+    args = parser.parse_args()
+
     if not os.path.exists(WECHAT_DIR): return
     
-    conn = init_db()
-    id_to_nick, hash_to_id, prefix_to_id = get_contact_mapping(conn)
+    conn = init_db(full=args.full)
+    writer = BatchWriter(conn)
+    manifest = IngestManifest(conn, PARSER_VERSION)
+    id_to_nick, hash_to_id, prefix_to_id = get_contact_mapping(writer)
     logging.info(f"Loaded {len(id_to_nick)} contacts from multiple sources.")
 
-    for f in os.listdir(WECHAT_DIR):
-        if f.endswith(".sqlite") or f.endswith(".db"):
-            parse_wcdb_sqlite(os.path.join(WECHAT_DIR, f), conn, id_to_nick, hash_to_id)
+    db_paths = [
+        os.path.join(WECHAT_DIR, f) for f in os.listdir(WECHAT_DIR)
+        if f.endswith(".sqlite") or f.endswith(".db")
+    ]
+    changed, removed = manifest.plan(db_paths)
+    manifest.purge(
+        "group5_raw_messages", "source",
+        [f"sqlite_{os.path.basename(p)}" for p in changed + removed],
+    )
+    for path in removed:
+        manifest.forget(path)
+    for path in sorted(changed):
+        try:
+            parse_wcdb_sqlite(path, writer, id_to_nick, hash_to_id)
+        except Exception as e:
+            # Left unrecorded: its rows stay purged until a later run parses it
+            logging.error(f"Error parsing messages from {path}: {e}")
+            continue
+        # Rows must be on disk before the file is marked as ingested
+        writer.flush()
+        manifest.record(path)
     
-    parse_media(WECHAT_DIR, conn, hash_to_id, prefix_to_id)
+    parse_media(WECHAT_DIR, writer, hash_to_id, prefix_to_id)
 
-    conn.commit()
+    writer.close()
     conn.close()
     logging.info("Group 5 parsing finished.")
 
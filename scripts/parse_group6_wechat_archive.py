@@ -6,21 +6,26 @@ Analysis: Extracted MicroMsg folders from legacy backups (2013-2014).
 Contains image2, voice2, video folders.
 Features:
 1. Recursively finds and extracts media from legacy structures.
-2. Converts AMR to MP3 (legacy voice format).
+2. Converts AMR to MP3 (legacy voice format), many clips per ffmpeg call.
 3. Deduplication based on file path/hash.
 4. Media path: data/media/wechat_media/<hash>/<fileID>.<ext>
+5. Incremental by default: files already in group6_raw_media are skipped;
+   `--full` rebuilds the DB.
 """
 
+import argparse
 import hashlib
 import logging
 import os
-import shutil
-import sqlite3
 import sys
-import subprocess
 import re
 from datetime import datetime
 
+from audio_transcode import FFMPEG_BATCH_SIZE, transcode_amr_batch
+from batch_writer import BatchWriter
+from ingest_manifest import open_output_db
+from media_store import BLOB_REFS_SQL, INSERT_BLOB_REF_SQL, MediaStore
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -30,36 +35,20 @@ logging.basicConfig(
 OUTPUT_DB = "data/db/raw/group6_wechat_archive.sqlite"
 SCHEMA_FILE = "data/schema/raw/group6_wechat_archive.sql"
 MEDIA_ROOT = "data/media/wechat_media"
+MEDIA_STORE = MediaStore(MEDIA_ROOT)
 ARCHIVES_DIR = "blobs/Wechat3"
 
-
-def init_db():
-    """Initialize DB using the local schema file."""
-    if os.path.exists(OUTPUT_DB):
-        os.remove(OUTPUT_DB)
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    with open(SCHEMA_FILE, 'r') as f:
-        schema_sql = f.read()
-    conn = sqlite3.connect(OUTPUT_DB)
-    conn.executescript(schema_sql)
-    conn.commit()
-    return conn
+INSERT_MEDIA_SQL = (
+    "INSERT OR IGNORE INTO group6_raw_media (id, username, type, relative_path, original_path, file_size, source) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
 
 
-def convert_amr_to_mp3(src_path):
-    """Converts legacy AMR to MP3."""
-    if not os.path.exists(src_path):
-        return src_path
-    dest_path = os.path.splitext(src_path)[0] + ".mp3"
-    try:
-        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-i", src_path, dest_path]
-        subprocess.run(cmd, check=True)
-        if os.path.exists(dest_path):
-            os.remove(src_path)
-        return dest_path
-    except Exception as e:
-        logging.error(f"Error converting AMR {src_path}: {e}")
-        return src_path
+def init_db(full=False):
+    """Initialize DB using the local schema file (kept as-is unless `full`)."""
+    conn = open_output_db(OUTPUT_DB, SCHEMA_FILE, full=full)
+    conn.executescript(BLOB_REFS_SQL)
+    return conn
 
 
 def identify_format_and_fix_ext(file_path):
@@ -81,13 +70,52 @@ def identify_format_and_fix_ext(file_path):
     return file_path
 
 
-def parse_legacy_micromsg(base_dir, out_conn):
+def add_media_row(writer, row, final_path):
+    """Queues one group6_raw_media row for a file now in MEDIA_ROOT."""
+    file_id, contact_hash, mtype, src_path, source_name, digest, blob_rel_path = row
+    rel_path = os.path.relpath(final_path, MEDIA_ROOT)
+    writer.add(
+        "group6_raw_media", INSERT_MEDIA_SQL,
+        (file_id, contact_hash, mtype, rel_path, src_path, os.path.getsize(final_path), source_name)
+    )
+    writer.add("media_blob_refs", INSERT_BLOB_REF_SQL, (file_id, digest, blob_rel_path))
+
+
+def flush_media(writer, pending):
+    """
+    Stores the queued files in the blob store and writes their rows. AMR clips
+    are converted to MP3 (one ffmpeg run per batch) before they become blobs;
+    a failed clip is stored as .amr.
+    """
+    placed = MEDIA_STORE.place_many(
+        [(src_path, dest_path) for src_path, dest_path, _ in pending],
+        convert=identify_format_and_fix_ext, convert_batch=transcode_amr_batch,
+    )
+    count = 0
+    for (src_path, _, row), result in zip(pending, placed):
+        if result is None:
+            continue
+        digest, final_path, blob = result
+        try:
+            add_media_row(writer, row + (digest, MEDIA_STORE.relpath(blob)), final_path)
+            count += 1
+        except Exception as e:
+            logging.error(f"Error media {src_path}: {e}")
+    pending.clear()
+    return count
+
+
+def parse_legacy_micromsg(base_dir, writer):
     """Recursively finds media in MicroMsg legacy folders."""
     logging.info(f"Scanning for media in: {base_dir}")
-    out_cursor = out_conn.cursor()
     source_name = "legacy_archive"
 
     media_count = 0
+    # Media files are immutable; ids already present came from earlier runs
+    writer.flush("group6_raw_media")
+    known_ids = {r[0] for r in writer.conn.execute("SELECT id FROM group6_raw_media")}
+    # (src, dest, row) queued for the blob store, converted a batch at a time
+    pending = []
     # Search for media folders
     for root, dirs, files in os.walk(base_dir):
         # We look for image2, voice2, video, sns
@@ -107,6 +135,8 @@ def parse_legacy_micromsg(base_dir, out_conn):
             if f.startswith(".") or f == "index.dat": continue
             src_path = os.path.join(root, f)
             if not os.path.isfile(src_path): continue
+            file_id = hashlib.md5(src_path.encode()).hexdigest()
+            if file_id in known_ids: continue
             
             # Use parent folder's parent name as 'contact' if possible
             # Standard MicroMsg path: .../df128d59.../image2/ab/cd/filename
@@ -117,42 +147,32 @@ def parse_legacy_micromsg(base_dir, out_conn):
                     contact_hash = parts[i-1]
                     break
             
-            dest_dir = os.path.join(MEDIA_ROOT, contact_hash)
-            os.makedirs(dest_dir, exist_ok=True)
-            dest_path = os.path.join(dest_dir, f)
-            
-            try:
-                if not os.path.exists(dest_path):
-                    shutil.copy2(src_path, dest_path)
-                
-                final_path = identify_format_and_fix_ext(dest_path)
-                if final_path.lower().endswith(".amr"):
-                    final_path = convert_amr_to_mp3(final_path)
-                
-                rel_path = os.path.relpath(final_path, MEDIA_ROOT)
-                file_id = hashlib.md5(src_path.encode()).hexdigest()
-                
-                out_cursor.execute(
-                    "INSERT OR IGNORE INTO group6_raw_media (id, username, type, relative_path, original_path, file_size, source) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (file_id, contact_hash, mtype, rel_path, src_path, os.path.getsize(final_path), source_name)
-                )
-                media_count += 1
-            except Exception as e:
-                logging.error(f"Error media {src_path}: {e}")
+            dest_path = os.path.join(MEDIA_ROOT, contact_hash, f)
+            # Stored once per content; dest_path becomes a link to the blob
+            pending.append((src_path, dest_path, (file_id, contact_hash, mtype, src_path, source_name)))
+            if len(pending) >= FFMPEG_BATCH_SIZE:
+                media_count += flush_media(writer, pending)
+
+    media_count += flush_media(writer, pending)
 
     logging.info(f"Extracted {media_count} media files from legacy archive.")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Parse legacy WeChat MicroMsg archives (group 6).")
+    parser.add_argument("--full", action="store_true", help="Delete the DB and re-scan every media file.")
+    args = parser.parse_args()
+
     if not os.path.exists(ARCHIVES_DIR): return
-    conn = init_db()
+    conn = init_db(full=args.full)
+    writer = BatchWriter(conn)
     # Process all subfolders in Wechat3 that are not WechatBackup (handled by group 7)
     for d in os.listdir(ARCHIVES_DIR):
         dir_path = os.path.join(ARCHIVES_DIR, d)
         if os.path.isdir(dir_path) and "WechatBackup" not in d:
-            parse_legacy_micromsg(dir_path, conn)
+            parse_legacy_micromsg(dir_path, writer)
     
-    conn.commit()
+    writer.close()
     conn.close()
     logging.info("Group 6 legacy archive parsing finished.")
 
@@ -7,28 +7,29 @@ Features:
 1. Parses contacts, messages, moments, and media from iOS backup.
 2. Uses local schema file for database initialization.
 3. Deduplication based on message hash.
-4. Converts WeChat Silk (.aud/.silk) to MP3 using pilk and ffmpeg.
-5. Media path: data/media/wechat_media/<contact folder hash>/<fileID>.<ext>
+4. Converts WeChat Silk (.aud/.silk) to MP3 in memory (audio_transcode).
+5. Media path: data/media/wechat_media/<contact folder hash>/<fileID>.<ext>, linked
+   from the content-addressed blob store (media_store, `media_blob_refs`).
 6. Converts .video_thum to .jpg (they are JPEG files).
 7. Converts various .pic* and .dftemp formats to .jpg or .png based on file content.
+8. Skips the run when the backup's Manifest.db is unchanged (ingest manifest);
+   a changed backup, or `--full`, rebuilds the DB.
 """
 
+import argparse
 import hashlib
 import logging
 import os
-import shutil
 import sqlite3
 import sys
-import subprocess
 import re
 from datetime import datetime
 
-# Try to import pilk for Silk decoding
-try:
-    import pilk
-    HAS_PILK = True
-except ImportError:
-    HAS_PILK = False
+from audio_transcode import convert_silk_to_mp3
+from batch_writer import BatchWriter
+from ingest_manifest import IngestManifest, open_output_db
+from ios_manifest import ManifestIndex
+from media_store import BLOB_REFS_SQL, INSERT_BLOB_REF_SQL, MediaStore
 
 # Setup logging
 logging.basicConfig(
@@ -39,62 +40,38 @@ logging.basicConfig(
 OUTPUT_DB = "data/db/raw/group7_wechat_ios_2016.sqlite"
 SCHEMA_FILE = "data/schema/raw/group7_wechat_ios_2016.sql"
 MEDIA_ROOT = "data/media/wechat_media"
+MEDIA_STORE = MediaStore(MEDIA_ROOT)
 # Path to the actual backup folder inside the date-named folder
 IOS_BACKUP_DIR = "blobs/Wechat3/WechatBackup[2016-03-11]/2016年03月11日02点24分43秒"
+# Bump when parsing logic changes so the backup is re-ingested
+PARSER_VERSION = "1"
+
+UPSERT_CONTACT_SQL = (
+    "INSERT INTO group7_raw_contacts (username, type, nickname, remark) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(username) DO UPDATE SET nickname = excluded.nickname, remark = excluded.remark "
+    "WHERE excluded.nickname IS NOT NULL OR excluded.remark IS NOT NULL"
+)
+INSERT_MOMENT_SQL = "INSERT OR IGNORE INTO group7_raw_moments (id, username, nickname, create_time, content, msg_hash) VALUES (?, ?, ?, ?, ?, ?)"
+INSERT_MESSAGE_SQL = "INSERT OR IGNORE INTO group7_raw_messages (username, create_time, content, local_id, source, msg_hash) VALUES (?, ?, ?, ?, ?, ?)"
+INSERT_MEDIA_SQL = "INSERT OR IGNORE INTO group7_raw_media (id, username, type, relative_path, original_path, file_size, source) VALUES (?, ?, ?, ?, ?, ?, ?)"
 
 
-def init_db():
-    """Initialize DB using the local schema file."""
-    if os.path.exists(OUTPUT_DB):
-        os.remove(OUTPUT_DB)
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    with open(SCHEMA_FILE, 'r') as f:
-        schema_sql = f.read()
-    conn = sqlite3.connect(OUTPUT_DB)
-    conn.executescript(schema_sql)
-    conn.commit()
+def init_db(full=False):
+    """Initialize DB using the local schema file (kept as-is unless `full`)."""
+    conn = open_output_db(OUTPUT_DB, SCHEMA_FILE, full=full)
+    conn.executescript(BLOB_REFS_SQL)
     return conn
 
 
-def convert_silk_to_mp3(src_path):
-    """Converts WeChat Silk (.aud/.silk) to MP3."""
-    if not HAS_PILK:
-        return src_path
-    if not os.path.exists(src_path):
-        return src_path
-    with open(src_path, "rb") as f:
-        header = f.read(10)
-    
-    is_silk = False
-    actual_silk_path = src_path
-    temp_silk = None
-    if header.startswith(b"#!SILK_V3"):
-        is_silk = True
-    elif header.startswith(b"\x02#!SILK_V3"):
-        is_silk = True
-        temp_silk = src_path + ".tmp.silk"
-        with open(src_path, "rb") as f:
-            f.seek(1)
-            with open(temp_silk, "wb") as tf:
-                tf.write(f.read())
-        actual_silk_path = temp_silk
-    if not is_silk:
-        return src_path
-    dest_path = os.path.splitext(src_path)[0] + ".mp3"
-    pcm_path = src_path + ".pcm"
-    try:
-        pilk.decode(actual_silk_path, pcm_path)
-        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-f", "s16le", "-ar", "24000", "-ac", "1", "-i", pcm_path, dest_path]
-        subprocess.run(cmd, check=True)
-        if os.path.exists(dest_path):
-            os.remove(src_path)
-        return dest_path
-    except Exception as e:
-        logging.error(f"Error converting silk {src_path}: {e}")
-        return src_path
-    finally:
-        if os.path.exists(pcm_path): os.remove(pcm_path)
-        if temp_silk and os.path.exists(temp_silk): os.remove(temp_silk)
+def convert_media(path, mtype):
+    """Converts a copied media file to a standard format if needed."""
+    if mtype == "audio" and path.lower().endswith((".aud", ".silk")):
+        return convert_silk_to_mp3(path)
+    elif path.lower().endswith(".video_thum"):
+        return convert_video_thum_to_jpg(path)
+    elif path.lower().endswith((".pic", ".pic_hd", ".pic_thum", ".pic_mid", ".pic_cmid", ".dftemp")):
+        return convert_image(path)
+    return path
 
 
 def convert_video_thum_to_jpg(src_path):
@@ -138,27 +115,6 @@ def convert_image(src_path):
         return src_path
 
 
-def get_file_path(backup_dir, manifest_db, relative_path):
-    """Map iOS relative path to fileID."""
-    if not os.path.exists(manifest_db):
-        return None
-    try:
-        conn = sqlite3.connect(manifest_db)
-        cursor = conn.cursor()
-        cursor.execute("SELECT fileID FROM Files WHERE relativePath = ?", (relative_path,))
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            file_id = row[0]
-            path = os.path.join(backup_dir, file_id[:2], file_id)
-            if os.path.exists(path): return path
-            root_path = os.path.join(backup_dir, file_id)
-            if os.path.exists(root_path): return root_path
-    except Exception as e:
-        logging.error(f"Error querying Manifest.db: {e}")
-    return None
-
-
 def clean_blob(blob_data):
     """Extract strings from blobs."""
     if not blob_data or not isinstance(blob_data, bytes): return None
@@ -180,7 +136,7 @@ def compute_msg_hash(username, create_time, content):
     return hashlib.md5(base_str.encode('utf-8', errors='replace')).hexdigest()
 
 
-def parse_ios_backup(backup_dir, out_conn):
+def parse_ios_backup(backup_dir, writer):
     """Main parsing logic."""
     logging.info(f"Parsing iOS backup: {backup_dir}")
     manifest_db = os.path.join(backup_dir, "Manifest.db")
@@ -188,30 +144,20 @@ def parse_ios_backup(backup_dir, out_conn):
         logging.warning(f"Manifest.db not found in {backup_dir}")
         return
 
-    out_cursor = out_conn.cursor()
     source_name = f"ios_backup_2016"
 
+    # Load Manifest.db once; all lookups below are in-memory
+    index = ManifestIndex(backup_dir)
+
     # Identify user hashes
-    user_hashes = []
-    try:
-        conn = sqlite3.connect(manifest_db)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT DISTINCT substr(relativePath, 11, 32) FROM Files "
-            "WHERE domain LIKE '%com.tencent.xin%' "
-            "AND relativePath LIKE 'Documents/________________________________/%'"
-        )
-        user_hashes = [row[0] for row in cursor.fetchall() if row[0] and len(row[0]) == 32]
-        conn.close()
-    except Exception as e:
-        logging.error(f"Error finding user hashes: {e}")
+    user_hashes = index.user_hashes()
 
     for user_hash in user_hashes:
         logging.info(f"Processing user hash: {user_hash}")
         
         # 1. Contacts
         contact_db_rel = f"Documents/{user_hash}/DB/WCDB_Contact.sqlite"
-        contact_db_path = get_file_path(backup_dir, manifest_db, contact_db_rel)
+        contact_db_path = index.path_for(contact_db_rel)
         if contact_db_path:
             conn = sqlite3.connect(contact_db_path)
             cursor = conn.cursor()
@@ -220,18 +166,13 @@ def parse_ios_backup(backup_dir, out_conn):
                 for row in cursor.fetchall():
                     uname, utype = row[0], row[1]
                     unick, uremark = clean_blob(row[2]), clean_blob(row[3])
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group7_raw_contacts (username, type, nickname, remark) VALUES (?, ?, ?, ?)",
-                        (uname, utype, unick, uremark)
-                    )
-                    if unick or uremark:
-                        out_cursor.execute("UPDATE group7_raw_contacts SET nickname = ?, remark = ? WHERE username = ?", (unick, uremark, uname))
+                    writer.add("group7_raw_contacts", UPSERT_CONTACT_SQL, (uname, utype, unick, uremark))
             except Exception as e: logging.error(f"Error parsing contacts: {e}")
             conn.close()
 
         # 2. Moments
         wc_db_rel = f"Documents/{user_hash}/wc/wc005_008.db"
-        wc_db_path = get_file_path(backup_dir, manifest_db, wc_db_rel)
+        wc_db_path = index.path_for(wc_db_rel)
         if wc_db_path:
             conn = sqlite3.connect(wc_db_path)
             cursor = conn.cursor()
@@ -239,16 +180,13 @@ def parse_ios_backup(backup_dir, out_conn):
                 cursor.execute("SELECT Id, FromUser, from_nickname, CreateTime, content FROM MyWC_Message01")
                 for row in cursor.fetchall():
                     m_hash = compute_msg_hash(row[1], row[3], row[4])
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group7_raw_moments (id, username, nickname, create_time, content, msg_hash) VALUES (?, ?, ?, ?, ?, ?)",
-                        (*row, m_hash)
-                    )
+                    writer.add("group7_raw_moments", INSERT_MOMENT_SQL, (*row, m_hash))
             except Exception as e: logging.error(f"Error parsing moments: {e}")
             conn.close()
 
         # 3. Messages
         fts_db_rel = f"Documents/{user_hash}/fts/fts_message.db"
-        fts_db_path = get_file_path(backup_dir, manifest_db, fts_db_rel)
+        fts_db_path = index.path_for(fts_db_rel)
         if fts_db_path:
             conn = sqlite3.connect(fts_db_path)
             cursor = conn.cursor()
@@ -261,60 +199,65 @@ def parse_ios_backup(backup_dir, out_conn):
                     for row in cursor.fetchall():
                         username = user_map.get(row[0], f"unknown_{row[0]}")
                         m_hash = compute_msg_hash(username, row[1], row[2])
-                        out_cursor.execute(
-                            "INSERT OR IGNORE INTO group7_raw_messages (username, create_time, content, local_id, source, msg_hash) VALUES (?, ?, ?, ?, ?, ?)",
+                        writer.add(
+                            "group7_raw_messages", INSERT_MESSAGE_SQL,
                             (username, row[1], row[2], row[3], source_name, m_hash)
                         )
             except Exception as e: logging.error(f"Error parsing FTS: {e}")
             conn.close()
 
         # 4. Media
-        conn = sqlite3.connect(manifest_db)
-        cursor = conn.cursor()
-        media_patterns = [(f"Documents/{user_hash}/Audio/%", "audio"), (f"Documents/{user_hash}/Video/%", "video"), (f"Documents/{user_hash}/OpenData/%", "image"), (f"Documents/{user_hash}/Img/%", "image")]
-        for pattern, mtype in media_patterns:
-            cursor.execute("SELECT fileID, relativePath FROM Files WHERE domain LIKE '%com.tencent.xin%' AND relativePath LIKE ?", (pattern,))
-            for fid, rel in cursor.fetchall():
-                src_path = os.path.join(backup_dir, fid[:2], fid)
-                if not os.path.exists(src_path): src_path = os.path.join(backup_dir, fid)
-                if not os.path.exists(src_path): continue
-                
-                parts = rel.split("/")
-                contact_folder_hash = parts[3] if len(parts) >= 5 else user_hash
-                file_ext = os.path.splitext(parts[-1])[1]
-                if not file_ext:
-                    if mtype == "image": file_ext = ".jpg"
-                    elif mtype == "video": file_ext = ".mp4"
-                    elif mtype == "audio": file_ext = ".aud"
-                
-                dest_rel_path = os.path.join(contact_folder_hash, fid + file_ext)
-                dest_path = os.path.join(MEDIA_ROOT, dest_rel_path)
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                
-                try:
-                    if not os.path.exists(dest_path): shutil.copy2(src_path, dest_path)
-                    
-                    final_path = dest_path
-                    if mtype == "audio" and dest_path.lower().endswith((".aud", ".silk")):
-                        final_path = convert_silk_to_mp3(dest_path)
-                    elif dest_path.lower().endswith(".video_thum"):
-                        final_path = convert_video_thum_to_jpg(dest_path)
-                    elif dest_path.lower().endswith((".pic", ".pic_hd", ".pic_thum", ".pic_mid", ".pic_cmid", ".dftemp")):
-                        final_path = convert_image(dest_path)
-                    
-                    rel_path = os.path.relpath(final_path, MEDIA_ROOT)
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group7_raw_media (id, username, type, relative_path, original_path, file_size, source) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (fid, user_hash, mtype, rel_path, rel, os.path.getsize(final_path), source_name)
-                    )
-                except Exception as e: logging.error(f"Error media {rel}: {e}")
-        conn.close()
+        for fid, rel, mtype in index.media(user_hash):
+            src_path = index.resolve(fid)
+            if not src_path: continue
+            
+            parts = rel.split("/")
+            contact_folder_hash = parts[3] if len(parts) >= 5 else user_hash
+            file_ext = os.path.splitext(parts[-1])[1]
+            if not file_ext:
+                if mtype == "image": file_ext = ".jpg"
+                elif mtype == "video": file_ext = ".mp4"
+                elif mtype == "audio": file_ext = ".aud"
+            
+            dest_rel_path = os.path.join(contact_folder_hash, fid + file_ext)
+            dest_path = os.path.join(MEDIA_ROOT, dest_rel_path)
+            
+            try:
+                digest, final_path, blob = MEDIA_STORE.place(
+                    src_path, dest_path, convert=lambda path: convert_media(path, mtype)
+                )
+                rel_path = os.path.relpath(final_path, MEDIA_ROOT)
+                writer.add(
+                    "group7_raw_media", INSERT_MEDIA_SQL,
+                    (fid, user_hash, mtype, rel_path, rel, os.path.getsize(final_path), source_name)
+                )
+                writer.add("media_blob_refs", INSERT_BLOB_REF_SQL, (fid, digest, MEDIA_STORE.relpath(blob)))
+            except Exception as e: logging.error(f"Error media {rel}: {e}")
 
 def main():
+    parser = argparse.ArgumentParser(description="Parse the 2016 WeChat iOS backup (group 7).")
+    parser.add_argument("--full", action="store_true", help="Delete the DB and re-parse even if the backup is unchanged.")
+    args = parser.parse_args()
+
     if not os.path.exists(IOS_BACKUP_DIR): return
-    conn = init_db()
-    parse_ios_backup(IOS_BACKUP_DIR, conn)
-    conn.commit()
+    manifest_db = os.path.join(IOS_BACKUP_DIR, "Manifest.db")
+    conn = init_db(full=args.full)
+    manifest = IngestManifest(conn, PARSER_VERSION)
+    if os.path.exists(manifest_db) and manifest.is_current(manifest_db):
+        logging.info(f"Backup unchanged since last run, nothing to do: {IOS_BACKUP_DIR}")
+        conn.close()
+        return
+    if not args.full:
+        # A changed backup touches every table, so rebuild
+        conn.close()
+        conn = init_db(full=True)
+        manifest = IngestManifest(conn, PARSER_VERSION)
+
+    writer = BatchWriter(conn)
+    parse_ios_backup(IOS_BACKUP_DIR, writer)
+    writer.close()
+    if os.path.exists(manifest_db):
+        manifest.record(manifest_db)
     conn.close()
     logging.info("Group 7 parsing finished.")
 
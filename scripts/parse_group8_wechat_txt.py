@@ -6,16 +6,26 @@ Analysis: Text-based chat logs with Beijing time (UTC+8).
 Features:
 1. Parses date, nickname, status, type, content.
 2. Uses local schema file for database initialization.
-3. Deduplication based on message hash (normalized to UTC).
+3. Deduplication based on message hash (normalized to UTC): within a file when
+   rows are inserted, across files in the `group8_messages` view (first file
+   in sorted order wins), so purging one file never hides another's copy.
+4. `--workers N` parses files on a process pool; the main process is the only writer.
+5. Incremental by default: unchanged files are skipped via the ingest manifest;
+   `--full` deletes and rebuilds the DB. Unreadable files are not recorded, so
+   the next run retries them.
 """
 
+import argparse
 import hashlib
 import logging
 import os
 import re
-import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 
+from batch_writer import BatchWriter
+from ingest_manifest import IngestManifest, open_output_db
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -25,18 +35,47 @@ logging.basicConfig(
 OUTPUT_DB = "data/db/raw/group8_wechat_txt.sqlite"
 SCHEMA_FILE = "data/schema/raw/group8_wechat_txt.sql"
 EXPORT_DIR = "blobs/Wechat_txt"
+# Bump when parsing logic changes so every file is re-ingested
+PARSER_VERSION = "2"
+# Unique key of group8_raw_messages since PARSER_VERSION 2 (was msg_hash alone)
+MESSAGES_KEY = "UNIQUE (source, msg_hash)"
+ENCODINGS = ["utf-8", "gbk", "utf-16"]
+
+# Cross-file dedup happens at query time: every file keeps its own rows
+MESSAGES_VIEW_SQL = """
+CREATE INDEX IF NOT EXISTS idx_group8_raw_messages_hash ON group8_raw_messages(msg_hash);
+CREATE VIEW IF NOT EXISTS group8_messages AS
+SELECT id, username, create_time, content, local_id, source, msg_hash
+FROM (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY msg_hash ORDER BY source, id) AS copy
+    FROM group8_raw_messages
+)
+WHERE copy = 1;
+"""
+
+INSERT_MESSAGE_SQL = (
+    "INSERT OR IGNORE INTO group8_raw_messages "
+    "(username, create_time, content, source, "
+    "msg_hash) VALUES (?, ?, ?, ?, ?)"
+)
+INSERT_CONTACT_SQL = (
+    "INSERT OR IGNORE INTO group8_raw_contacts "
+    "(username, nickname) VALUES (?, ?)"
+)
 
 
-def init_db():
-    """Initialize DB using the local schema file."""
-    if os.path.exists(OUTPUT_DB):
-        os.remove(OUTPUT_DB)
-    os.makedirs(os.path.dirname(OUTPUT_DB), exist_ok=True)
-    with open(SCHEMA_FILE, 'r') as f:
-        schema_sql = f.read()
-    conn = sqlite3.connect(OUTPUT_DB)
-    conn.executescript(schema_sql)
-    conn.commit()
+def init_db(full=False):
+    """Initialize DB using the local schema file (kept as-is unless `full`)."""
+    conn = open_output_db(OUTPUT_DB, SCHEMA_FILE, full=full)
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'group8_raw_messages'"
+    ).fetchone()
+    if row and MESSAGES_KEY not in row[0]:
+        # Old layout: the parser version bump re-ingests every file into the new table
+        logging.warning("Rebuilding group8_raw_messages with a per-source key.")
+        with open(SCHEMA_FILE, 'r') as f:
+            conn.executescript(f"DROP TABLE group8_raw_messages;\n{f.read()}")
+    conn.executescript(MESSAGES_VIEW_SQL)
     return conn
 
 
@@ -46,80 +85,120 @@ def compute_msg_hash(username, create_time, content):
     return hashlib.md5(base_str.encode('utf-8', errors='replace')).hexdigest()
 
 
-def parse_exported_text(export_dir, out_conn):
+def parse_export_file(export_dir, filename):
+    """Parses one export file into (message rows, contact rows); raises if unreadable."""
+    beijing_tz = timezone(timedelta(hours=8))
+    username = filename.split("的消息记录")[0]
+    file_path = os.path.join(export_dir, filename)
+    messages, contacts = [], []
+
+    content = None
+    for enc in ENCODINGS:
+        try:
+            with open(file_path, "r", encoding=enc) as f:
+                content = f.read()
+            break
+        except: continue
+
+    if content is None:
+        # Not recorded by the caller, so the (already purged) file is retried
+        raise ValueError(f"Could not read {filename} as any of {', '.join(ENCODINGS)}")
+
+    lines = content.splitlines()
+    for line in lines:
+        # Format: 2018-06-15 11:34        Nickname                  Status                        Type                         Content
+        match = re.match(
+            r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2})\s+(.*?)\s+(发送|接收|未知类型)\s+(.*?)\s+(.*)",
+            line,
+        )
+        if match:
+            dt_str, contact, direction, mtype, msg_content = match.groups()
+            try:
+                dt = datetime.strptime(dt_str, "%Y-%m-%d %H:%M").replace(tzinfo=beijing_tz)
+                ts = int(dt.timestamp())
+            except: continue
+
+            msg_content = msg_content.strip()
+            m_hash = compute_msg_hash(username, ts, msg_content)
+            messages.append((username, ts, msg_content, filename, m_hash))
+            # Log contact
+            contacts.append((username, contact))
+    return messages, contacts
+
+
+def parse_exported_text(export_dir, writer, workers=1, manifest=None):
     """Parses text chat logs from the WeChat export directory."""
     logging.info(f"Parsing exported text from: {export_dir}")
     if not os.path.exists(export_dir):
         return
 
-    out_cursor = out_conn.cursor()
     total_msgs = 0
-    beijing_tz = timezone(timedelta(hours=8))
-
-    for filename in os.listdir(export_dir):
-        if not filename.endswith(".txt"):
-            continue
-
-        username = filename.split("的消息记录")[0]
-        file_path = os.path.join(export_dir, filename)
-
-        try:
-            content = None
-            for enc in ["utf-8", "gbk", "utf-16"]:
+    filenames = [f for f in os.listdir(export_dir) if f.endswith(".txt")]
+
+    if manifest:
+        paths = [os.path.join(export_dir, f) for f in filenames]
+        changed, removed = manifest.plan(paths)
+        # Rows are keyed by bare filename in the `source` column
+        manifest.purge(
+            "group8_raw_messages", "source",
+            [os.path.basename(p) for p in changed + removed],
+        )
+        for path in removed:
+            manifest.forget(path)
+        filenames = sorted(os.path.basename(p) for p in changed)
+
+    def write(filename, result):
+        nonlocal total_msgs
+        messages, contacts = result
+        writer.add_many("group8_raw_messages", INSERT_MESSAGE_SQL, messages)
+        writer.add_many("group8_raw_contacts", INSERT_CONTACT_SQL, contacts)
+        total_msgs += len(messages)
+        if manifest:
+            # Rows must be on disk before the file is marked as ingested
+            writer.flush()
+            manifest.record(os.path.join(export_dir, filename))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                filename: pool.submit(parse_export_file, export_dir, filename)
+                for filename in filenames
+            }
+            for filename, future in futures.items():
                 try:
-                    with open(file_path, "r", encoding=enc) as f:
-                        content = f.read()
-                    break
-                except: continue
-
-            if not content:
-                logging.error(f"Could not read {filename}")
-                continue
-
-            lines = content.splitlines()
-            for line in lines:
-                # Format: 2018-06-15 11:34        Nickname                  Status                        Type                         Content
-                match = re.match(
-                    r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2})\s+(.*?)\s+(发送|接收|未知类型)\s+(.*?)\s+(.*)",
-                    line,
-                )
-                if match:
-                    dt_str, contact, direction, mtype, msg_content = match.groups()
-                    try:
-                        dt = datetime.strptime(dt_str, "%Y-%m-%d %H:%M").replace(tzinfo=beijing_tz)
-                        ts = int(dt.timestamp())
-                    except: continue
-
-                    msg_content = msg_content.strip()
-                    m_hash = compute_msg_hash(username, ts, msg_content)
-
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group8_raw_messages "
-                        "(username, create_time, content, source, "
-                        "msg_hash) VALUES (?, ?, ?, ?, ?)",
-                        (username, ts, msg_content, filename, m_hash),
-                    )
-                    total_msgs += 1
-
-                    # Log contact
-                    out_cursor.execute(
-                        "INSERT OR IGNORE INTO group8_raw_contacts "
-                        "(username, nickname) VALUES (?, ?)",
-                        (username, contact),
-                    )
-        except Exception as e:
-            logging.error(f"Error parsing {filename}: {e}")
+                    write(filename, future.result())
+                except Exception as e:
+                    logging.error(f"Error parsing {filename}: {e}")
+    else:
+        for filename in filenames:
+            try:
+                write(filename, parse_export_file(export_dir, filename))
+            except Exception as e:
+                logging.error(f"Error parsing {filename}: {e}")
 
     logging.info(f"Inserted {total_msgs} messages into {OUTPUT_DB}")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Parse WeChat txt exports (group 8).")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of parser processes (default: 1, sequential).",
+    )
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Delete the DB and re-parse every file instead of only changed ones.",
+    )
+    args = parser.parse_args()
+
     if not os.path.exists(EXPORT_DIR):
         return
 
-    conn = init_db()
-    parse_exported_text(EXPORT_DIR, conn)
-    conn.commit()
+    conn = init_db(full=args.full)
+    writer = BatchWriter(conn)
+    manifest = IngestManifest(conn, PARSER_VERSION)
+    parse_exported_text(EXPORT_DIR, writer, workers=args.workers, manifest=manifest)
+    writer.close()
     conn.close()
     logging.info("WeChat Manual Text Export parsing finished.")
 
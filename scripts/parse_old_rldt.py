@@ -4,9 +4,10 @@ import zipfile
 import hashlib
 import csv
 from pathlib import Path
-from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 
+from media_crypto import encrypt_stream
+
 # Load environment variables
 load_dotenv()
 
@@ -17,13 +18,13 @@ if not ENCRYPTION_KEY:
         "Please ensure it is set before running the script."
     )
 
-cipher_suite = Fernet(ENCRYPTION_KEY.encode())
-
 # Constants
 DB_PATH = "data/db/database.sqlite"
 SOURCE_DIR = "blobs/user_content_rldt"
 MEDIA_DIR = "data/media"
 CSV_PATH = os.path.join(SOURCE_DIR, "img-list.csv")
+# Zip members are hashed and encrypted in pieces of this size
+READ_CHUNK = 1024 * 1024
 
 
 def init_db():
@@ -31,12 +32,11 @@ def init_db():
     return conn
 
 
-def get_file_hash(data):
-    return hashlib.md5(data).hexdigest()[:16]
-
-
-def encrypt_data(data):
-    return cipher_suite.encrypt(data)
+def get_file_hash(f):
+    hasher = hashlib.md5()
+    for block in iter(lambda: f.read(READ_CHUNK), b""):
+        hasher.update(block)
+    return hasher.hexdigest()[:16]
 
 
 def load_person_map():
@@ -98,8 +98,7 @@ def process_zips():
                 final_original_name = filename
 
                 with z.open(file_info) as f:
-                    file_data = f.read()
-                    file_hash_16 = get_file_hash(file_data)
+                    file_hash_16 = get_file_hash(f)
                     
                     # Check if media already exists
                     cursor.execute(
@@ -109,8 +108,6 @@ def process_zips():
                     if cursor.fetchone():
                         continue
 
-                    encrypted_data = encrypt_data(file_data)
-
                     # Determine file type category
                     ext = os.path.splitext(filename)[1].lower()
                     if ext == ".json":
@@ -146,8 +143,9 @@ def process_zips():
                     target_dir.mkdir(parents=True, exist_ok=True)
 
                     target_path = target_dir / f"{file_hash_16}{ext}"
-                    with open(target_path, "wb") as out_f:
-                        out_f.write(encrypted_data)
+                    # Second pass over the member, encrypted as it decompresses
+                    with z.open(file_info) as src, open(target_path, "wb") as out_f:
+                        encrypt_stream(src, out_f, ENCRYPTION_KEY)
 
                     # Update file_path in DB
                     relative_path = os.path.relpath(target_path, MEDIA_DIR)
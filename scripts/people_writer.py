@@ -0,0 +1,235 @@
+"""
+People Graph Writer
+-------------------
+Insert engine for LLM extraction results ({"people": [...], "relationships":
+[...]}, see extract_people_info.PROMPT_TEMPLATE) into the main database.
+Features:
+1. One transaction per extraction result; every table is written with
+   `executemany` (persons get explicit ids so child rows need no lastrowid).
+2. Position and group ids are preloaded into dictionaries once per run and
+   extended as new ones are created; no per-person lookups.
+3. Relationships are resolved against the whole result after the people.
+4. Run state: a person repeated in a later (overlapping) chunk is merged into
+   their existing row (empty columns filled, only new list items stored), and
+   repeated relationships are skipped. State only advances on commit.
+
+Usage:
+    writer = PeopleWriter(conn)
+    for data in results:
+        writer.write(data)
+"""
+
+import json
+import logging
+import unicodedata
+
+# Scalar persons columns; a person seen again in a later chunk fills the empty ones
+PERSON_FIELDS = [
+    "title", "display_name", "nick_name", "other_names", "gender", "birthdate",
+    "brief", "origins", "ethnicity", "notes",
+]
+# List section -> (table, item fields); person_id comes first in every row
+CHILD_TABLES = {
+    "contacts": ("contacts", ["type", "value"]),
+    "education": ("education", ["school", "degree", "major", "start_date", "end_date", "notes"]),
+    "financial_information": ("financial_information", ["type", "country", "details"]),
+    "career": ("career", ["company", "role", "start_date", "end_date", "notes"]),
+    "property": ("property", ["type", "details"]),
+}
+# Sections whose repeated items are only stored once per run
+CHILD_SECTIONS = list(CHILD_TABLES) + ["positions", "groups"]
+# SQLite host parameter limit stays well clear of this
+IN_CLAUSE_CHUNK = 500
+
+
+def to_str(val):
+    if val is None:
+        return None
+    if isinstance(val, (list, dict)):
+        return json.dumps(val)
+    s = str(val).strip()
+    return s if s else None
+
+
+def person_key(name):
+    """Name as compared across chunks: NFKC, case-folded, single spaces."""
+    return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+
+def _item_key(section, item):
+    return section, json.dumps(item, sort_keys=True, ensure_ascii=False)
+
+
+def _sql_insert(table, columns):
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))})"
+    )
+
+
+class PeopleWriter:
+    def __init__(self, conn):
+        self.conn = conn
+        # person_key -> {"id": person_id, "items": set of _item_key}
+        self.people = {}
+        # (person1_id, person2_id, type)
+        self.relationships = set()
+        self.positions = dict(conn.execute("SELECT name, id FROM positions"))
+        self.groups = {
+            (name, gtype): gid for gid, name, gtype in conn.execute("SELECT id, name, type FROM groups")
+        }
+
+    def _next_id(self, table):
+        return self.conn.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").fetchone()[0]
+
+    def write(self, data):
+        """
+        Writes one extraction result in a single transaction.
+        Returns {"inserted", "merged", "relationships"} counts; on error the
+        whole result is rolled back and the counts are zero.
+        """
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            counts, state = self._write(data)
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logging.error(f"Error inserting extraction result: {e}")
+            return {"inserted": 0, "merged": 0, "relationships": 0}
+        # Advance the run state only once the rows are committed
+        people, relationships, positions, groups = state
+        for key, (person_id, items) in people.items():
+            entry = self.people.setdefault(key, {"id": person_id, "items": set()})
+            entry["items"].update(items)
+        self.relationships.update(relationships)
+        self.positions.update(positions)
+        self.groups.update(groups)
+        return counts
+
+    def _write(self, data):
+        cur = self.conn.cursor()
+        next_person = self._next_id("persons")
+        person_rows, merge_rows = [], []
+        child_rows = {section: [] for section in CHILD_TABLES}
+        position_links, group_links = [], []
+        name_to_id = {}
+        # key -> (person_id, item keys added by this result)
+        touched = {}
+
+        for person in data.get("people", []):
+            name = to_str(person.get("name")) or to_str(person.get("display_name"))
+            if not name:
+                logging.warning(f"Skipping entry with no name: {person}")
+                continue
+            key = person_key(name)
+            known = self.people.get(key)
+            if key in touched:
+                person_id, items = touched[key]
+            else:
+                person_id = known["id"] if known else None
+                items = set()
+            stored = known["items"] if known else set()
+
+            values = [to_str(person.get(field)) for field in PERSON_FIELDS]
+            if person_id is None:
+                person_id = next_person
+                next_person += 1
+                person_rows.append([person_id, name] + values)
+            else:
+                merge_rows.append(values + [person_id])
+            touched[key] = (person_id, items)
+            name_to_id[name] = person_id
+
+            for section in CHILD_SECTIONS:
+                for item in person.get(section) or []:
+                    if not isinstance(item, dict):
+                        continue
+                    item_key = _item_key(section, item)
+                    if item_key in stored or item_key in items:
+                        continue
+                    items.add(item_key)
+                    if section == "positions":
+                        if to_str(item.get("name")):
+                            position_links.append((person_id, item))
+                    elif section == "groups":
+                        if to_str(item.get("name")):
+                            group_links.append((person_id, item))
+                    elif section != "contacts" or to_str(item.get("value")):
+                        fields = CHILD_TABLES[section][1]
+                        child_rows[section].append(
+                            [person_id] + [to_str(item.get(f)) for f in fields]
+                        )
+
+        cur.executemany(_sql_insert("persons", ["id", "name"] + PERSON_FIELDS), person_rows)
+        assignments = ", ".join(f"{f} = COALESCE({f}, ?)" for f in PERSON_FIELDS)
+        cur.executemany(f"UPDATE persons SET {assignments} WHERE id = ?", merge_rows)
+        for section, (table, fields) in CHILD_TABLES.items():
+            cur.executemany(_sql_insert(table, ["person_id"] + fields), child_rows[section])
+
+        positions = self._resolve_positions(cur, position_links)
+        cur.executemany(
+            _sql_insert("person_positions", ["person_id", "position_id", "organization", "notes"]),
+            [
+                (pid, positions[to_str(p["name"])], to_str(p.get("organization")), to_str(p.get("notes")))
+                for pid, p in position_links
+            ],
+        )
+        groups = self._resolve_groups(cur, group_links)
+        cur.executemany(
+            _sql_insert("person_groups", ["person_id", "group_id", "role"]),
+            [
+                (pid, groups[(to_str(g["name"]), to_str(g.get("type")))], to_str(g.get("role")))
+                for pid, g in group_links
+            ],
+        )
+
+        # Relationships, against every person of this result
+        rel_rows, rel_keys = [], set()
+        for rel in data.get("relationships", []):
+            p1_id = name_to_id.get(to_str(rel.get("person1_name")))
+            p2_id = name_to_id.get(to_str(rel.get("person2_name")))
+            rel_key = (p1_id, p2_id, to_str(rel.get("type")))
+            if not (p1_id and p2_id) or rel_key in self.relationships or rel_key in rel_keys:
+                continue
+            rel_keys.add(rel_key)
+            rel_rows.append((p1_id, p2_id, rel_key[2], to_str(rel.get("notes"))))
+        cur.executemany(
+            _sql_insert("relationships", ["person1_id", "person2_id", "type", "notes"]), rel_rows
+        )
+
+        counts = {
+            "inserted": len(person_rows),
+            "merged": len(merge_rows),
+            "relationships": len(rel_rows),
+        }
+        new_positions = {k: v for k, v in positions.items() if k not in self.positions}
+        new_groups = {k: v for k, v in groups.items() if k not in self.groups}
+        return counts, (touched, rel_keys, new_positions, new_groups)
+
+    def _resolve_positions(self, cur, links):
+        """name -> id for every linked position, creating missing ones (UNIQUE name)."""
+        positions = dict(self.positions)
+        missing = sorted({to_str(p["name"]) for _, p in links} - positions.keys())
+        cur.executemany("INSERT OR IGNORE INTO positions (name) VALUES (?)", [(n,) for n in missing])
+        for i in range(0, len(missing), IN_CLAUSE_CHUNK):
+            part = missing[i:i + IN_CLAUSE_CHUNK]
+            positions.update(cur.execute(
+                f"SELECT name, id FROM positions WHERE name IN ({', '.join('?' * len(part))})", part
+            ))
+        return positions
+
+    def _resolve_groups(self, cur, links):
+        """(name, type) -> id for every linked group, creating missing ones."""
+        groups = dict(self.groups)
+        missing = sorted(
+            {(to_str(g["name"]), to_str(g.get("type"))) for _, g in links} - groups.keys(),
+            key=str,
+        )
+        next_group = self._next_id("groups")
+        rows = []
+        for name, gtype in missing:
+            groups[(name, gtype)] = next_group
+            rows.append((next_group, name, gtype))
+            next_group += 1
+        cur.executemany("INSERT INTO groups (id, name, type) VALUES (?, ?, ?)", rows)
+        return groups
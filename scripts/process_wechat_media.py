@@ -1,14 +1,46 @@
+"""
+WeChat Media Processing
+-----------------------
+Turns WeChat media (wechat_raw_media) into message content: audio
+transcripts, image captions, video/file summaries; audio is also copied
+(encrypted) into the mapped person's media folder.
+Features:
+1. Work queue: one `media_jobs` row per media file (migration
+   006_media_jobs.sql) with status, kind, attempts and error. New media rows
+   are enqueued on every run; jobs left running by an interrupted run and
+   failed jobs with attempts left go back to pending.
+2. Jobs are claimed in batches per kind and handled on separate thread pools
+   (audio: resident FunASR worker per thread; image: vision captioning;
+   video/file: summaries), with workers and batch size tunable per kind.
+3. Each finished batch is recorded in one transaction (message content,
+   captions, job status), so a restart resumes exactly where it stopped.
+
+Usage:
+    python scripts/process_wechat_media.py
+    python scripts/process_wechat_media.py --image-workers 4 --audio-batch 32
+"""
+
+import argparse
 import os
-import sqlite3
 import logging
 import hashlib
-import subprocess
-import base64
 import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 
+from audio_transcode import convert_silk_to_mp3
+from caption_images import (
+    HAS_PIL, VISION_CONCURRENCY, Captioner, known_captions, variant_groups,
+    INSERT_SQL as CAPTION_INSERT_SQL,
+)
+from db import close_all, execute, get_connection, query, query_one
+from media_crypto import encrypt_file
+from migrate_db import migrate
+from transcribe_worker import AUDIO_BATCH_SIZE, TranscriptionWorker
+
 # Load environment variables
 load_dotenv()
 
@@ -22,106 +54,64 @@ DB_PATH = "data/db/database.sqlite"
 WECHAT_MEDIA_DIR = "data/media"
 PERSONS_MEDIA_ROOT = "data/media"
 
-MODEL_PATH = os.path.expanduser("~/llm_models/modelscope/models/iic/SenseVoiceSmall")
-PYTHON_WITH_FUNASR = "../sermon-voices/venv/bin/python"
-OLLAMA_API = "http://localhost:11434/api/generate"
-VISION_MODEL = "llava:7b"
-
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
-CIPHER = Fernet(ENCRYPTION_KEY.encode()) if ENCRYPTION_KEY else None
-
-try:
-    import pilk
-    HAS_PILK = True
-except ImportError:
-    HAS_PILK = False
-
-
-def convert_silk_to_mp3(src_path):
-    """Converts WeChat Silk (.aud/.silk) to MP3 using pilk and ffmpeg."""
-    if not HAS_PILK:
-        return src_path
-
-    # Check for silk v3 header (might have 0x02 prefix)
-    with open(src_path, "rb") as f:
-        header = f.read(10)
-    
-    is_silk = False
-    actual_silk_path = src_path
-    temp_silk = None
-
-    if header.startswith(b"#!SILK_V3"):
-        is_silk = True
-    elif header.startswith(b"\x02#!SILK_V3"):
-        is_silk = True
-        # Need to strip the first byte for some decoders, 
-        # but pilk might handle it or we might need a temp file.
-        temp_silk = src_path + ".tmp.silk"
-        with open(src_path, "rb") as f:
-            f.seek(1)
-            with open(temp_silk, "wb") as tf:
-                tf.write(f.read())
-        actual_silk_path = temp_silk
-
-    if not is_silk:
-        return src_path
-
-    dest_path = os.path.splitext(src_path)[0] + ".mp3"
-    pcm_path = src_path + ".pcm"
-    
-    try:
-        # 1. Decode Silk to PCM
-        pilk.decode(actual_silk_path, pcm_path)
-        
-        # 2. Encode PCM to MP3
-        cmd = [
-            "ffmpeg", "-y", "-loglevel", "error",
-            "-f", "s16le", "-ar", "24000", "-ac", "1",
-            "-i", pcm_path,
-            dest_path
-        ]
-        subprocess.run(cmd, check=True)
-        
-        # Cleanup originals
-        os.remove(src_path)
-        return dest_path
-    except Exception as e:
-        logging.error(f"Error converting silk {src_path}: {e}")
-        return src_path
-    finally:
-        if os.path.exists(pcm_path):
-            os.remove(pcm_path)
-        if temp_silk and os.path.exists(temp_silk):
-            os.remove(temp_silk)
+# Files are hashed and encrypted in pieces of this size
+READ_CHUNK = 1024 * 1024
+
+# Per media kind: batches in flight and jobs per batch
+WORKERS = {"audio": 1, "image": VISION_CONCURRENCY, "video": 2, "file": 1}
+BATCH_SIZES = {"audio": AUDIO_BATCH_SIZE, "image": 8, "video": 64, "file": 64}
+MAX_ATTEMPTS = 3
+
+# New media rows become jobs. Content written before the queue existed is
+# classified once here, with the checks the script used to run on every pass.
+ENQUEUE_SQL = """
+INSERT OR IGNORE INTO media_jobs (media_id, kind, status)
+SELECT m.id,
+    CASE WHEN m.type IN ('audio', 'image', 'video') THEN m.type ELSE 'file' END,
+    CASE
+        WHEN msg.content IS NULL OR msg.content = '' THEN 'pending'
+        WHEN m.type = 'audio' AND (msg.content LIKE '%[语音转文字]%'
+                                   OR msg.content LIKE '%funasr version%') THEN 'pending'
+        WHEN m.type = 'image' AND instr(msg.content, ':') = 0 THEN 'pending'
+        ELSE 'done'
+    END
+FROM wechat_raw_media m
+LEFT JOIN wechat_raw_messages msg ON msg.media_path = m.relative_path
+WHERE m.relative_path IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM media_jobs j WHERE j.media_id = m.id)
+"""
+# Ordered by path so variants of one picture land in the same batch
+CLAIM_SQL = """
+SELECT m.id, m.username, m.type, m.relative_path, m.original_path, m.file_size, m.source
+FROM media_jobs j JOIN wechat_raw_media m ON m.id = j.media_id
+WHERE j.kind = ? AND j.status = 'pending'
+ORDER BY m.username, m.original_path
+LIMIT ?
+"""
+MEDIA_EXISTS_SQL = "SELECT id FROM media WHERE file_hash = ? AND person_id = ?"
+MEDIA_INSERT_SQL = """
+INSERT INTO media (person_id, file_path, file_type, original_filename, file_hash, encryption_status)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
 
 
 def get_wechat_person_mapping():
     """Returns a dict mapping wechat username/hash to person_id."""
     if not os.path.exists(DB_PATH):
         return {}
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT person_id, value FROM contacts WHERE type = 'wechat'")
-    mapping = {row[1]: row[0] for row in cursor.fetchall()}
-    conn.close()
-    return mapping
+    rows = query("SELECT person_id, value FROM contacts WHERE type = 'wechat'", path=DB_PATH)
+    return {value: person_id for person_id, value in rows}
 
 
 def get_person_info(person_id):
     """Returns (name, folder_hash) for a person."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, folder_hash FROM persons WHERE id = ?", (person_id,))
-    row = cursor.fetchone()
+    row = query_one("SELECT name, folder_hash FROM persons WHERE id = ?", (person_id,), DB_PATH)
     if row and not row[1]:
         # Generate folder_hash if missing
         folder_hash = hashlib.md5(f"{row[0]}_{person_id}".encode()).hexdigest()[:16]
-        cursor.execute(
-            "UPDATE persons SET folder_hash = ? WHERE id = ?", (folder_hash, person_id)
-        )
-        conn.commit()
+        execute("UPDATE persons SET folder_hash = ? WHERE id = ?", (folder_hash, person_id), DB_PATH)
         row = (row[0], folder_hash)
-    conn.close()
     return row
 
 
@@ -133,42 +123,31 @@ def copy_to_person_media(person_id, src_path, mtype):
     name, folder_hash = person_info
 
     file_ext = Path(src_path).suffix or ".bin"
+    hasher = hashlib.md5()
     with open(src_path, "rb") as f:
-        file_data = f.read()
+        for block in iter(lambda: f.read(READ_CHUNK), b""):
+            hasher.update(block)
 
-    file_hash = hashlib.md5(file_data).hexdigest()[:16]
+    file_hash = hasher.hexdigest()[:16]
     dest_dir = os.path.join(PERSONS_MEDIA_ROOT, folder_hash, mtype)
     os.makedirs(dest_dir, exist_ok=True)
 
     dest_filename = f"{file_hash}{file_ext}"
     dest_path = os.path.join(dest_dir, dest_filename)
 
-    # Encrypt if cipher available
+    # Encrypt (streamed, chunked format) if a key is available
     encryption_status = 0
-    if CIPHER:
-        encrypted_data = CIPHER.encrypt(file_data)
-        with open(dest_path, "wb") as f:
-            f.write(encrypted_data)
+    if ENCRYPTION_KEY:
+        encrypt_file(src_path, dest_path, ENCRYPTION_KEY)
         encryption_status = 1
     else:
         shutil.copy2(src_path, dest_path)
 
     # Record in persons DB
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
     rel_path = os.path.relpath(dest_path, PERSONS_MEDIA_ROOT)
-
-    cursor.execute(
-        "SELECT id FROM media WHERE file_hash = ? AND person_id = ?",
-        (file_hash, person_id),
-    )
-    if not cursor.fetchone():
-        cursor.execute(
-            """
-            INSERT INTO media (person_id, file_path, file_type, original_filename, file_hash, encryption_status)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """,
+    if not query_one(MEDIA_EXISTS_SQL, (file_hash, person_id), DB_PATH):
+        execute(
+            MEDIA_INSERT_SQL,
             (
                 person_id,
                 rel_path,
@@ -177,188 +156,311 @@ def copy_to_person_media(person_id, src_path, mtype):
                 file_hash,
                 encryption_status,
             ),
+            DB_PATH,
         )
-        conn.commit()
-    conn.close()
     return rel_path
 
 
-def get_audio_transcription(audio_abs_path):
-    if not os.path.exists(audio_abs_path):
-        return None
-    temp_script = "temp_transcribe.py"
-    with open(temp_script, "w") as f:
-        f.write(
-            f"""
-import sys
-import re
-from funasr import AutoModel
-model = AutoModel(model="{MODEL_PATH}", device="cpu", disable_update=True)
-res = model.generate(input="{audio_abs_path}", cache={{}}, language="zh", use_itn=True)
-text = re.sub(r'<\|.*?\|>', '', res[0]['text']).strip() if res else ""
-# Strip FunASR version info if present
-text = re.sub(r'funasr version: .*?\\n', '', text)
-text = re.sub(r'funasr version: .*', '', text)
-print(text.strip())
-"""
-        )
+def get_video_info(video_abs_path):
     try:
-        result = subprocess.run(
-            [PYTHON_WITH_FUNASR, temp_script], capture_output=True, text=True
-        )
-        return result.stdout.strip() if result.returncode == 0 else None
-    except Exception as e:
-        logging.error(f"Error calling funasr: {e}")
-    finally:
-        if os.path.exists(temp_script):
-            os.remove(temp_script)
-    return None
+        filesize = os.path.getsize(video_abs_path)
+        return f"{filesize/(1024*1024):.1f}MB"
+    except Exception:
+        return "unknown size"
 
 
-def get_image_info(image_abs_path):
-    try:
-        from PIL import Image
+def save_media_content(cursor, username, source, mtype, rel_path, mid, content):
+    """Updates the message row of a media file, or inserts one if there is none."""
+    cursor.execute(
+        "UPDATE wechat_raw_messages SET content = ?, media_id = ?, message_type = ? WHERE media_path = ?",
+        (content, mid, mtype, rel_path),
+    )
+    if cursor.rowcount == 0:
+        local_id = int(hashlib.md5(rel_path.encode()).hexdigest()[:7], 16) + 1000000000
+        cursor.execute(
+            """
+            INSERT INTO wechat_raw_messages (username, content, local_id, source, message_type, media_path, media_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (username, content, local_id, source, mtype, rel_path, mid),
+        )
 
-        with Image.open(image_abs_path) as img:
-            width, height = img.size
-            filesize = os.path.getsize(image_abs_path)
-            return f"{filesize/1024:.1f}KB, {width}x{height}", image_abs_path
-    except Exception:
-        return "unknown size", None
 
+# --- job queue ---
 
-def get_image_description(image_abs_path):
-    """Use Ollama LLava to describe image."""
-    try:
-        with open(image_abs_path, "rb") as f:
-            img_data = base64.b64encode(f.read()).decode("utf-8")
+def enqueue_jobs(conn):
+    """Adds a job for every new media row; returns how many were added."""
+    with conn:
+        added = conn.execute(ENQUEUE_SQL).rowcount
+        # Jobs claimed by an interrupted run, and failures with attempts left
+        conn.execute(
+            "UPDATE media_jobs SET status = 'pending' "
+            "WHERE status = 'running' OR (status = 'failed' AND attempts < ?)",
+            (MAX_ATTEMPTS,),
+        )
+    return added
 
-        import requests
 
-        payload = {
-            "model": VISION_MODEL,
-            "prompt": "Describe this image in one short sentence in English.",
-            "stream": False,
-            "images": [img_data],
+def claim_jobs(conn, kind, limit):
+    """Marks up to `limit` pending jobs of a kind as running; returns them as dicts."""
+    with conn:
+        rows = conn.execute(CLAIM_SQL, (kind, limit)).fetchall()
+        conn.executemany(
+            "UPDATE media_jobs SET status = 'running', attempts = attempts + 1, "
+            "updated_at = CURRENT_TIMESTAMP WHERE media_id = ?",
+            [(row[0],) for row in rows],
+        )
+    jobs = [
+        {
+            "media_id": media_id, "username": username, "kind": kind, "type": mtype,
+            "rel_path": rel_path, "original_path": original_path,
+            "file_size": file_size, "source": source,
         }
-        response = requests.post(OLLAMA_API, json=payload, timeout=60)
-        if response.status_code == 200:
-            return response.json().get("response", "").strip()
-    except Exception as e:
-        logging.error(f"Error getting image description: {e}")
-    return ""
+        for media_id, username, mtype, rel_path, original_path, file_size, source in rows
+    ]
+    if kind == "image" and jobs:
+        # Images captioned before (e.g. by caption_images.py) need no request
+        paths = [job["rel_path"] for job in jobs]
+        captions = {
+            rel_path: (info, description)
+            for rel_path, info, description in conn.execute(
+                "SELECT relative_path, info, description FROM image_captions "
+                f"WHERE relative_path IN ({', '.join('?' * len(paths))})",
+                paths,
+            )
+        }
+        for job in jobs:
+            job["caption"] = captions.get(job["rel_path"])
+    return jobs
 
 
-def get_video_info(video_abs_path):
-    try:
-        filesize = os.path.getsize(video_abs_path)
-        return f"{filesize/(1024*1024):.1f}MB"
-    except Exception:
-        return "unknown size"
+def _fail(job, error):
+    job["content"], job["error"] = None, error
+    return job
 
 
-def process_media():
-    if not os.path.exists(DB_PATH):
-        return
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, username, type, relative_path, source FROM wechat_raw_media"
-    )
-    media_records = cursor.fetchall()
+# --- handlers: run on the worker pools, no DB access; results are applied by the scheduler ---
 
-    wechat_person_map = get_wechat_person_mapping()
+_audio_local = threading.local()
+_audio_workers = []
+_audio_workers_lock = threading.Lock()
+
+
+def _transcription_worker():
+    """The calling pool thread's resident transcription worker."""
+    worker = getattr(_audio_local, "worker", None)
+    if worker is None:
+        worker = _audio_local.worker = TranscriptionWorker()
+        with _audio_workers_lock:
+            _audio_workers.append(worker)
+    return worker
 
-    total_processed = 0
-    for mid, username, mtype, rel_path, source in media_records:
-        abs_path = os.path.join(WECHAT_MEDIA_DIR, rel_path)
+
+def handle_audio(jobs):
+    """Converts Silk clips to MP3 and transcribes the batch with one worker request."""
+    ready = []
+    for job in jobs:
+        abs_path = os.path.join(WECHAT_MEDIA_DIR, job["rel_path"])
+        mp3_path = os.path.splitext(abs_path)[0] + ".mp3"
+        if not os.path.exists(abs_path) and os.path.exists(mp3_path):
+            # Converted by a run that stopped before recording it
+            abs_path = mp3_path
         if not os.path.exists(abs_path):
+            _fail(job, "file missing")
             continue
+        if abs_path.lower().endswith((".aud", ".silk")):
+            abs_path = convert_silk_to_mp3(abs_path)
+        new_rel_path = os.path.relpath(abs_path, WECHAT_MEDIA_DIR)
+        if new_rel_path != job["rel_path"]:
+            job["new_rel_path"] = new_rel_path
+        job["abs_path"] = abs_path
+        ready.append(job)
+
+    texts = _transcription_worker().transcribe([job["abs_path"] for job in ready]) if ready else []
+    for job, transcription in zip(ready, texts):
+        if transcription:
+            job["content"], job["error"] = f"[Audio Transcription]: {transcription}", None
+        else:
+            # Placeholder until a retry succeeds
+            job["content"], job["error"] = "[语音消息]", "transcription failed"
+    return jobs
+
+
+def make_image_handler(captioner):
+    def handle_image(jobs):
+        """Captions the batch's images, variants of one picture together."""
+        pending = []
+        for job in jobs:
+            if job["caption"] is not None:
+                info, description = job["caption"]
+                job["content"], job["error"] = f"image({info}): {description}", None
+            elif not os.path.exists(os.path.join(WECHAT_MEDIA_DIR, job["rel_path"])):
+                _fail(job, "file missing")
+            else:
+                pending.append(job)
+        by_path = {job["rel_path"]: job for job in pending}
+        rows = [
+            (job["rel_path"], job["original_path"], job["username"], job["file_size"])
+            for job in pending
+        ]
+        for members in variant_groups(rows):
+            for row in captioner.caption_group(members):
+                rel_path, _, info, description = row[:4]
+                job = by_path[rel_path]
+                job["content"], job["error"] = f"image({info}): {description}", None
+                job["caption_row"] = row
+        for job in pending:
+            if "caption_row" not in job:
+                _fail(job, "captioning failed")
+        return jobs
+    return handle_image
+
+
+def handle_video(jobs):
+    for job in jobs:
+        abs_path = os.path.join(WECHAT_MEDIA_DIR, job["rel_path"])
+        if os.path.exists(abs_path):
+            job["content"], job["error"] = f"video({get_video_info(abs_path)})", None
+        else:
+            _fail(job, "file missing")
+    return jobs
+
 
-        # Convert audio if needed
-        original_abs_path = abs_path
-        if mtype == "audio" and abs_path.lower().endswith((".aud", ".silk")):
-            new_abs_path = convert_silk_to_mp3(abs_path)
-            if new_abs_path != abs_path:
-                abs_path = new_abs_path
-                # Update DB for the new extension/path
-                new_rel_path = os.path.relpath(abs_path, WECHAT_MEDIA_DIR)
-                new_size = os.path.getsize(abs_path)
+def handle_file(jobs):
+    for job in jobs:
+        if os.path.exists(os.path.join(WECHAT_MEDIA_DIR, job["rel_path"])):
+            job["content"], job["error"] = f"[{job['type']} file]", None
+        else:
+            _fail(job, "file missing")
+    return jobs
+
+
+# --- scheduler ---
+
+def apply_results(conn, jobs, wechat_person_map):
+    """Records one finished batch: message content, captions and job status in one transaction."""
+    # Copies commit their media rows (on this thread's pooled connection, i.e.
+    # `conn`), so they run before the transaction; they are idempotent (by file
+    # hash) if the batch is redone after a crash
+    for job in jobs:
+        person_id = wechat_person_map.get(job["username"])
+        if job["kind"] == "audio" and job.get("abs_path") and person_id:
+            copy_to_person_media(person_id, job["abs_path"], "audio")
+
+    with conn:
+        cursor = conn.cursor()
+        for job in jobs:
+            rel_path = job["rel_path"]
+            if job.get("new_rel_path"):
+                rel_path = job["new_rel_path"]
                 cursor.execute(
                     "UPDATE wechat_raw_media SET relative_path = ?, original_path = original_path || ' (converted to mp3)', file_size = ? WHERE id = ?",
-                    (new_rel_path, new_size, mid)
+                    (rel_path, os.path.getsize(job["abs_path"]), job["media_id"]),
                 )
-                rel_path = new_rel_path
+            if job.get("caption_row"):
+                cursor.execute(CAPTION_INSERT_SQL, job["caption_row"])
+            if job.get("content") is not None:
+                save_media_content(
+                    cursor, job["username"], job["source"], job["type"], rel_path,
+                    job["media_id"], job["content"],
+                )
+            cursor.execute(
+                "UPDATE media_jobs SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP "
+                "WHERE media_id = ?",
+                ("failed" if job.get("error") else "done", job.get("error"), job["media_id"]),
+            )
 
-        cursor.execute(
-            "SELECT content, media_id FROM wechat_raw_messages WHERE media_path = ?",
-            (rel_path,),
-        )
-        row = cursor.fetchone()
-        existing_content, existing_mid = row if row else (None, None)
-
-        # Determine if we need to process
-        needs_processing = False
-        if not existing_content:
-            needs_processing = True
-        elif mtype == "audio" and (
-            "[语音转文字]" in existing_content or "funasr version" in existing_content
-        ):
-            needs_processing = True
-        elif mtype == "image" and ":" not in existing_content:  # No description yet
-            needs_processing = True
-
-        if not needs_processing:
-            continue
 
-        logging.info(f"Processing {mtype}: {rel_path}")
-        content = existing_content
+def run_jobs(conn, workers=None, batch_sizes=None):
+    """
+    Claims jobs in batches and runs each kind's handler on its own thread pool
+    (`workers[kind]` batches in flight). Returns {kind: [done, failed]}.
+    """
+    workers = {**WORKERS, **(workers or {})}
+    batch_sizes = {**BATCH_SIZES, **(batch_sizes or {})}
+    wechat_person_map = get_wechat_person_mapping()
 
-        if mtype == "audio":
-            transcription = get_audio_transcription(abs_path)
-            content = (
-                f"[Audio Transcription]: {transcription}"
-                if transcription
-                else "[语音消息]"
-            )
+    handlers = {"audio": handle_audio, "video": handle_video, "file": handle_file}
+    if HAS_PIL:
+        handlers["image"] = make_image_handler(Captioner(known_captions(conn)))
+    else:
+        logging.warning("Pillow not installed, image jobs stay pending.")
 
-            # Copy to persons media if mapped
-            person_id = wechat_person_map.get(username)
-            if person_id:
-                copy_to_person_media(person_id, abs_path, mtype)
-
-        elif mtype == "image":
-            info, valid_path = get_image_info(abs_path)
-            description = get_image_description(valid_path) if valid_path else ""
-            content = f"image({info}): {description}"
-        elif mtype == "video":
-            content = f"video({get_video_info(abs_path)})"
-        else:
-            content = f"[{mtype} file]"
+    pools = {kind: ThreadPoolExecutor(max_workers=max(workers[kind], 1)) for kind in handlers}
+    in_flight = {}
+    stats = {kind: [0, 0] for kind in handlers}
+    start = time.perf_counter()
+
+    def fill(kind):
+        while sum(1 for k in in_flight.values() if k == kind) < max(workers[kind], 1):
+            jobs = claim_jobs(conn, kind, batch_sizes[kind])
+            if not jobs:
+                return
+            in_flight[pools[kind].submit(handlers[kind], jobs)] = (kind, jobs)
+
+    try:
+        for kind in handlers:
+            fill(kind)
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                kind, jobs = in_flight.pop(future)
+                try:
+                    jobs = future.result()
+                except Exception as e:
+                    logging.error(f"{kind} batch failed: {e}")
+                    jobs = [_fail(job, f"{type(e).__name__}: {e}") for job in jobs]
+                apply_results(conn, jobs, wechat_person_map)
+                failed = sum(1 for job in jobs if job.get("error"))
+                stats[kind][0] += len(jobs) - failed
+                stats[kind][1] += failed
+                elapsed = time.perf_counter() - start
+                logging.info(
+                    f"{kind}: {stats[kind][0]} done, {stats[kind][1]} failed "
+                    f"({sum(stats[kind]) / elapsed:.1f}/s)"
+                )
+                fill(kind)
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+        for worker in _audio_workers:
+            worker.close()
+        _audio_workers.clear()
+    return stats
+
+
+def process_media(workers=None, batch_sizes=None):
+    if not os.path.exists(DB_PATH):
+        return
+    conn = get_connection(DB_PATH)
+    try:
+        migrate(conn)
+        added = enqueue_jobs(conn)
+        logging.info(f"Enqueued {added} new media jobs.")
+        stats = run_jobs(conn, workers, batch_sizes)
+    finally:
+        close_all()
+    for kind, (done, failed) in stats.items():
+        logging.info(f"Finished {kind}: {done} done, {failed} failed.")
 
-        local_id = int(hashlib.md5(rel_path.encode()).hexdigest()[:7], 16) + 1000000000
-        if existing_content or row:
-            cursor.execute(
-                "UPDATE wechat_raw_messages SET content = ?, media_id = ?, message_type = ? WHERE media_path = ?",
-                (content, mid, mtype, rel_path),
-            )
-        else:
-            cursor.execute(
-                """
-                INSERT INTO wechat_raw_messages (username, content, local_id, source, message_type, media_path, media_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
-                (username, content, local_id, source, mtype, rel_path, mid),
-            )
-        total_processed += 1
-        if total_processed % 10 == 0:
-            conn.commit()
-            logging.info(f"Progress: {total_processed} items...")
 
-    conn.commit()
-    conn.close()
-    logging.info(f"Finished! Processed {total_processed} items.")
+def main():
+    parser = argparse.ArgumentParser(description="Process WeChat media through the media_jobs queue.")
+    for kind in ("audio", "image", "video"):
+        parser.add_argument(
+            f"--{kind}-workers", type=int, default=WORKERS[kind],
+            help=f"{kind.capitalize()} batches processed concurrently.",
+        )
+        parser.add_argument(
+            f"--{kind}-batch", type=int, default=BATCH_SIZES[kind],
+            help=f"{kind.capitalize()} jobs claimed per batch.",
+        )
+    args = parser.parse_args()
+    process_media(
+        workers={kind: getattr(args, f"{kind}_workers") for kind in ("audio", "image", "video")},
+        batch_sizes={kind: getattr(args, f"{kind}_batch") for kind in ("audio", "image", "video")},
+    )
 
 
 if __name__ == "__main__":
-    process_media()
+    main()
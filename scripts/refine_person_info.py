@@ -1,18 +1,34 @@
-import os
 import json
+import logging
 import sqlite3
-import requests
 import argparse
 from dotenv import load_dotenv
 
-load_dotenv()
+from db import close_all, get_connection, transaction
+# LLM server configuration (LLM_API_BASE, LLM_MODEL, ...) lives in llm_client
+from llm_client import LLM_CONCURRENCY, LLMError, chat_json, disable_cache, run_ordered
 
-LLM_API_BASE = os.getenv("LLM_API_BASE", "http://localhost:11434/v1")
-LLM_API_KEY = os.getenv("LLM_API_KEY", "ollama")
-MODEL_NAME = os.getenv("LLM_MODEL", "llama3")
+load_dotenv()
 
 DB_PATH = "data/db/database.sqlite"
 
+# Part of the LLM response cache key: bump when a template changes meaning
+PROMPT_VERSION = "1"
+BATCH_PROMPT_VERSION = "1"
+
+UPDATABLE_FIELDS = [
+    "name",
+    "display_name",
+    "nick_name",
+    "title",
+    "gender",
+    "birthdate",
+    "brief",
+    "origins",
+    "ethnicity",
+    "notes",
+]
+
 PROMPT_TEMPLATE = """
 Refine the information for the following person record.
 
@@ -44,83 +60,152 @@ If no changes are needed, return an empty JSON object {{}}.
 Only return the JSON object.
 """
 
+BATCH_PROMPT_TEMPLATE = """
+Refine the information for each of the following person records independently.
 
-def query_llm(person_data):
-    payload = {
-        "model": MODEL_NAME,
-        "messages": [
-            {
-                "role": "system",
-                "content": "You are an expert at data cleansing and entity attribute extraction.",
-            },
-            {
-                "role": "user",
-                "content": PROMPT_TEMPLATE.format(
-                    person_json=json.dumps(person_data, indent=2, ensure_ascii=False)
-                ),
-            },
-        ],
-        "temperature": 0.1,
-        "response_format": {"type": "json_object"},
-    }
+Current Data (a JSON array of records, each with an "id"):
+{persons_json}
 
+For every record:
+1. Normalize the "name": Strip any group names, titles (Pastor, Dr, etc.), or parenthetical info.
+2. If the name contains both Chinese and English (e.g. "Zhang San (John)"), separate them.
+3. Identify if the current name is actually a group or a nickname rather than a real name.
+4. Extract missing fields from "notes" or "display_name": gender, birthdate, ethnicity, origins.
+5. Categorize any hints in the notes into "brief" or additional "notes".
+
+Return a JSON object with a "results" array holding exactly one object per input record,
+with the record's "id" and only the fields that should be updated:
+{{
+    "results": [
+        {{
+            "id": 123,
+            "name": "Clean Real Name",
+            "display_name": "Full name or how they are addressed",
+            "nick_name": "Short name",
+            "title": "Professional title",
+            "gender": "male/female",
+            "birthdate": "YYYY-MM-DD",
+            "brief": "One sentence summary",
+            "origins": "Origin info",
+            "ethnicity": "Ethnicity info",
+            "notes": "Remaining notes"
+        }}
+    ]
+}}
+
+If a record needs no changes, return {{"id": <its id>}} for it.
+Only return the JSON object.
+"""
+
+
+def query_llm(person_data):
+    messages = [
+        {
+            "role": "system",
+            "content": "You are an expert at data cleansing and entity attribute extraction.",
+        },
+        {
+            "role": "user",
+            "content": PROMPT_TEMPLATE.format(
+                person_json=json.dumps(person_data, indent=2, ensure_ascii=False)
+            ),
+        },
+    ]
     try:
-        response = requests.post(
-            f"{LLM_API_BASE}/chat/completions",
-            headers={"Authorization": f"Bearer {LLM_API_KEY}"},
-            json=payload,
-        )
-        response.raise_for_status()
-        content = response.json()["choices"][0]["message"]["content"]
-        return json.loads(content)
-    except Exception as e:
+        return chat_json(messages, temperature=0.1, template_version=PROMPT_VERSION)
+    except LLMError as e:
         print(f"Error querying LLM for person {person_data.get('id')}: {e}")
         return {}
 
 
+def validate_batch(response, ids):
+    """
+    {id: updates} for the records the batch response covers correctly.
+    A record is valid when it appears exactly once with a known id and only
+    string values for known fields; anything else is left for a single call.
+    """
+    results = response.get("results") if isinstance(response, dict) else None
+    if not isinstance(results, list):
+        return {}
+    seen, valid = set(), {}
+    for item in results:
+        if not isinstance(item, dict):
+            continue
+        try:
+            person_id = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if person_id not in ids or person_id in seen:
+            valid.pop(person_id, None)
+            seen.add(person_id)
+            continue
+        seen.add(person_id)
+        updates = {k: v for k, v in item.items() if k != "id"}
+        if all(k in UPDATABLE_FIELDS and isinstance(v, str) for k, v in updates.items()):
+            valid[person_id] = updates
+    return valid
+
+
+def query_llm_batch(persons):
+    """
+    Refines several persons with one request. Records missing from (or
+    malformed in) the reply fall back to one query_llm call each.
+    Returns [(person, suggestions)] in input order.
+    """
+    ids = {p["id"] for p in persons}
+    messages = [
+        {
+            "role": "system",
+            "content": "You are an expert at data cleansing and entity attribute extraction.",
+        },
+        {
+            "role": "user",
+            "content": BATCH_PROMPT_TEMPLATE.format(
+                persons_json=json.dumps(persons, indent=2, ensure_ascii=False)
+            ),
+        },
+    ]
+    try:
+        valid = validate_batch(
+            chat_json(messages, temperature=0.1, template_version=BATCH_PROMPT_VERSION), ids
+        )
+    except LLMError as e:
+        print(f"Error querying LLM for batch {sorted(ids)}: {e}")
+        valid = {}
+    if len(valid) < len(persons):
+        # Runs on a worker thread: logging keeps the line whole
+        logging.warning(
+            f"Batch reply covered {len(valid)}/{len(persons)} records; retrying the rest singly."
+        )
+    return [
+        (p, valid[p["id"]] if p["id"] in valid else query_llm(p)) for p in persons
+    ]
+
+
 def get_persons(limit=None):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = get_connection(DB_PATH).cursor()
+    cursor.row_factory = sqlite3.Row
     query = "SELECT * FROM persons"
     if limit:
         query += f" LIMIT {limit}"
     cursor.execute(query)
-    rows = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return rows
+    return [dict(row) for row in cursor.fetchall()]
 
 
-def update_person(person_id, updates):
+def update_person(cursor, person_id, updates):
     if not updates:
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
     fields = []
     params = []
     for key, value in updates.items():
-        if key in [
-            "name",
-            "display_name",
-            "nick_name",
-            "title",
-            "gender",
-            "birthdate",
-            "brief",
-            "origins",
-            "ethnicity",
-            "notes",
-        ]:
+        if key in UPDATABLE_FIELDS:
             fields.append(f"{key} = ?")
             params.append(value)
 
     if fields:
         params.append(person_id)
         cursor.execute(f"UPDATE persons SET {', '.join(fields)} WHERE id = ?", params)
-        conn.commit()
-    conn.close()
 
 
 def main():
@@ -129,23 +214,56 @@ def main():
     parser.add_argument(
         "--dry-run", action="store_true", help="Don't update the database."
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignore cached LLM responses and query the server for every person.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Persons per LLM request (1 = one request per person).",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=LLM_CONCURRENCY,
+        help="Maximum LLM requests in flight.",
+    )
     args = parser.parse_args()
+    if args.no_cache:
+        disable_cache()
 
     persons = get_persons(args.limit)
-    print(f"Processing {len(persons)} persons...")
+    batch_size = max(args.batch_size, 1)
+    batches = [persons[i:i + batch_size] for i in range(0, len(persons), batch_size)]
+    print(f"Processing {len(persons)} persons in {len(batches)} requests...")
 
-    for i, person in enumerate(persons):
-        print(
-            f"[{i + 1}/{len(persons)}] Refining {person['name']} (ID: {person['id']})..."
-        )
-        suggestions = query_llm(person)
-
-        if suggestions:
-            print(f"  Suggestions: {suggestions}")
-            if not args.dry_run:
-                update_person(person["id"], suggestions)
-        else:
-            print("  No suggestions.")
+    def refine(batch):
+        if len(batch) == 1:
+            return [(batch[0], query_llm(batch[0]))]
+        return query_llm_batch(batch)
+
+    # The connection that read the persons, one transaction per batch
+    done = 0
+    try:
+        for _, _, results in run_ordered(refine, batches, args.concurrency):
+            with transaction(DB_PATH) as conn:
+                cursor = conn.cursor()
+                for person, suggestions in results:
+                    done += 1
+                    print(
+                        f"[{done}/{len(persons)}] Refining {person['name']} (ID: {person['id']})..."
+                    )
+                    if suggestions:
+                        print(f"  Suggestions: {suggestions}")
+                        if not args.dry_run:
+                            update_person(cursor, person["id"], suggestions)
+                    else:
+                        print("  No suggestions.")
+    finally:
+        close_all()
 
 
 if __name__ == "__main__":
@@ -1,120 +1,274 @@
+"""
+Media Encryption Key Rotation
+-----------------------------
+Re-encrypts every encrypted media file (media.encryption_status = 1) from the
+current ENCRYPTION_KEY to a new key.
+Features:
+1. Files are rotated on a process pool; each one is streamed into a temp file
+   next to it in the chunked format (media_crypto; legacy Fernet files are
+   converted), fsynced and atomically renamed over the original, so a file is
+   always entirely in the old or the new key.
+2. The new key is saved to .env as ENCRYPTION_KEY_NEXT before any file is
+   touched; per-file progress goes to `key_rotation_log` (migration
+   004_key_rotation.sql). Rerunning after a crash resumes with the saved key
+   and skips files already done. Rotation accepts files in either key, so a
+   file renamed just before the crash is handled too.
+3. ENCRYPTION_KEY is only switched once every file is rotated; progress and
+   the final summary report throughput in MB/s.
+
+Usage:
+    python scripts/rotate_encryption.py
+    python scripts/rotate_encryption.py --workers 8
+"""
+
+import argparse
+import base64
+import hashlib
 import os
-import sys
 import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
 from pathlib import Path
+
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 
+from media_crypto import reencrypt_stream
+from migrate_db import migrate
+
 # Load environment variables
 load_dotenv()
 
 OLD_KEY = os.getenv("ENCRYPTION_KEY")
+# Set while a rotation is in progress; an interrupted rotation resumes with it
+NEXT_KEY = os.getenv("ENCRYPTION_KEY_NEXT")
 DB_PATH = "data/db/database.sqlite"
 ENV_PATH = ".env"
+TEMP_SUFFIX = ".rotating"
+# Log rows are committed in batches; a lost batch is simply redone on resume
+COMMIT_EVERY = 100
+PROGRESS_EVERY = 100
 
+SEED_LOG_SQL = """
+INSERT OR IGNORE INTO key_rotation_log (rotation_id, media_id, file_path)
+SELECT ?, id, file_path FROM media WHERE encryption_status = 1
+"""
+PENDING_SQL = """
+SELECT media_id, file_path FROM key_rotation_log
+WHERE rotation_id = ? AND status != 'done' ORDER BY media_id
+"""
+UPDATE_LOG_SQL = """
+UPDATE key_rotation_log SET status = ?, bytes = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+WHERE rotation_id = ? AND media_id = ?
+"""
 
-def rotate_keys():
-    """Rotates the encryption key for all media files."""
-    if not OLD_KEY:
-        print("Error: No existing ENCRYPTION_KEY found in .env")
-        sys.exit(1)
+# Per worker process: ([new key, old key], new key), set by _init_worker
+_keys = None
 
-    print(f"Current key: {OLD_KEY}")
-    prompt = (
+
+def prompt_new_key():
+    """Asks for a new key; a phrase that isn't a Fernet key is hashed into one."""
+    new_key_input = input(
         "Enter new 32-byte base64 encryption key (or press Enter to generate one): "
-    )
-    new_key_input = input(prompt).strip()
+    ).strip()
 
     if not new_key_input:
         new_key = Fernet.generate_key().decode()
         print(f"Generated new key: {new_key}")
-    else:
-        try:
-            # Try using it as a direct Fernet key first
-            Fernet(new_key_input.encode())
-            new_key = new_key_input
-        except Exception:
-            # If it's a random phrase, derive a 32-byte key using SHA-256
-            import base64
-            import hashlib
-
-            hasher = hashlib.sha256()
-            hasher.update(new_key_input.encode())
-            new_key = base64.urlsafe_b64encode(hasher.digest()).decode()
-            print(f"Derived valid Fernet key from your phrase: {new_key}")
-
-    # Initialize ciphers
-    old_cipher = Fernet(OLD_KEY.encode())
-    new_cipher = Fernet(new_key.encode())
-
+        return new_key
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, file_path FROM media WHERE encryption_status = 1")
-        rows = cursor.fetchall()
+        # Try using it as a direct Fernet key first
+        Fernet(new_key_input.encode())
+        return new_key_input
+    except Exception:
+        # If it's a random phrase, derive a 32-byte key using SHA-256
+        hasher = hashlib.sha256()
+        hasher.update(new_key_input.encode())
+        new_key = base64.urlsafe_b64encode(hasher.digest()).decode()
+        print(f"Derived valid Fernet key from your phrase: {new_key}")
+        return new_key
 
-        if not rows:
-            print("No encrypted media files found to rotate.")
-            return
 
-        print(f"Found {len(rows)} files to re-encrypt...")
+def key_fingerprint(key):
+    """Identifies a rotation in key_rotation_log without storing the key."""
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
 
-        for count, (media_id, file_path_str) in enumerate(rows, 1):
-            file_path = Path(file_path_str)
-            if not file_path.exists():
-                print(f"Warning: File missing, skipping: {file_path_str}")
-                continue
 
-            # 1. Read and Decrypt
-            with open(file_path, "rb") as f:
-                decrypted_data = old_cipher.decrypt(f.read())
+def update_env(updates, comment_old_key=False):
+    """
+    Sets (or, with a None value, removes) keys in .env. With comment_old_key,
+    the current ENCRYPTION_KEY line is kept as a dated comment.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    lines = []
+    if os.path.exists(ENV_PATH):
+        with open(ENV_PATH, "r") as f:
+            lines = f.readlines()
 
-            # 2. Encrypt with new key
-            re_encrypted_data = new_cipher.encrypt(decrypted_data)
+    new_lines = []
+    pending = dict(updates)
+    for line in lines:
+        name = line.strip().split("=", 1)[0]
+        if name in updates:
+            if name == "ENCRYPTION_KEY" and comment_old_key:
+                # Comment out the exact original line
+                new_lines.append(f"# {line.strip()} (rotated on {timestamp})\n")
+            value = pending.pop(name, None)
+            if value is not None:
+                new_lines.append(f"{name}={value}\n")
+        else:
+            new_lines.append(line)
+    for name, value in pending.items():
+        if value is not None:
+            new_lines.append(f"{name}={value}\n")
 
-            # 3. Write back
-            with open(file_path, "wb") as f:
-                f.write(re_encrypted_data)
+    # Atomic replace: a crash never leaves a truncated .env
+    tmp_path = ENV_PATH + TEMP_SUFFIX
+    with open(tmp_path, "w") as f:
+        f.writelines(new_lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ENV_PATH)
 
-            if count % 100 == 0:
-                print(f"Processed {count} files...")
 
-        conn.close()
-        print("All files re-encrypted successfully.")
+def _init_worker(old_key, new_key):
+    global _keys
+    _keys = ([new_key, old_key], new_key)
 
-        # 4. Update .env
-        from datetime import datetime
 
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def rotate_file(media_id, file_path_str):
+    """
+    Re-encrypts one file under the new key via temp file + rename.
+    Returns (media_id, status, bytes, error).
+    """
+    file_path = Path(file_path_str)
+    if not file_path.exists():
+        return media_id, "missing", 0, None
+    tmp_path = file_path.with_name(file_path.name + TEMP_SUFFIX)
+    try:
+        size = file_path.stat().st_size
+        # Decrypts with either key, always encrypts with the new one
+        with open(file_path, "rb") as src, open(tmp_path, "wb") as dst:
+            reencrypt_stream(src, dst, *_keys)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, file_path)
+        return media_id, "done", size, None
+    except Exception as e:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        return media_id, "failed", 0, f"{type(e).__name__}: {e}"
 
-        with open(ENV_PATH, "r") as f:
-            lines = f.readlines()
 
-        new_lines = []
-        key_replaced = False
-        for line in lines:
-            if line.strip().startswith("ENCRYPTION_KEY="):
-                # Comment out the exact original line
-                new_lines.append(f"# {line.strip()} (rotated on {timestamp})\n")
-                new_lines.append(f"ENCRYPTION_KEY={new_key}\n")
-                key_replaced = True
-            else:
-                new_lines.append(line)
+def _mb_per_s(nbytes, elapsed):
+    return nbytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
 
-        if not key_replaced:
-            new_lines.append(f"ENCRYPTION_KEY={new_key}\n")
 
-        with open(ENV_PATH, "w") as f:
-            f.writelines(new_lines)
+def rotate_files(conn, old_key, new_key, workers):
+    """
+    Rotates every file of this rotation not yet done.
+    Returns {status: count} for the files processed in this run.
+    """
+    rotation_id = key_fingerprint(new_key)
+    with conn:
+        conn.execute(SEED_LOG_SQL, (rotation_id,))
+    rows = conn.execute(PENDING_SQL, (rotation_id,)).fetchall()
+    done_before = conn.execute(
+        "SELECT COUNT(*) FROM key_rotation_log WHERE rotation_id = ? AND status = 'done'",
+        (rotation_id,),
+    ).fetchone()[0]
+    if done_before:
+        print(f"Resuming rotation {rotation_id}: {done_before} files already done.")
+    if not rows:
+        return {}
 
-        print(f"Updated {ENV_PATH} with the new key.")
-        print("Rotation complete.")
+    print(f"Re-encrypting {len(rows)} files with {workers} workers...")
+    paths = dict(rows)
+    counts = {}
+    total_bytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(old_key, new_key)
+    ) as executor:
+        futures = [executor.submit(rotate_file, media_id, path) for media_id, path in rows]
+        for count, future in enumerate(as_completed(futures), 1):
+            media_id, status, nbytes, error = future.result()
+            counts[status] = counts.get(status, 0) + 1
+            total_bytes += nbytes
+            conn.execute(UPDATE_LOG_SQL, (status, nbytes, error, rotation_id, media_id))
+            if status == "missing":
+                print(f"Warning: File missing, skipping: {paths[media_id]}")
+            elif status == "failed":
+                print(f"Error re-encrypting {paths[media_id]}: {error}")
+            if count % COMMIT_EVERY == 0:
+                conn.commit()
+            if count % PROGRESS_EVERY == 0:
+                elapsed = time.perf_counter() - start
+                print(
+                    f"Processed {count}/{len(rows)} files "
+                    f"({_mb_per_s(total_bytes, elapsed):.1f} MB/s)..."
+                )
+    conn.commit()
 
-    except Exception as e:
-        print(f"Critical Error during rotation: {e}")
-        print("Note: Some files might be in an inconsistent state.")
+    elapsed = time.perf_counter() - start
+    print(
+        f"Rotated {total_bytes / (1024 * 1024):.1f} MB in {elapsed:.1f}s "
+        f"({_mb_per_s(total_bytes, elapsed):.1f} MB/s)."
+    )
+    return counts
+
+
+def rotate_keys(db_path=DB_PATH, workers=None):
+    """Rotates the encryption key for all media files, resuming an interrupted rotation."""
+    if not OLD_KEY:
+        print("Error: No existing ENCRYPTION_KEY found in .env")
         sys.exit(1)
 
+    print(f"Current key: {OLD_KEY}")
+    if NEXT_KEY:
+        new_key = NEXT_KEY
+        print(f"Resuming interrupted rotation to ENCRYPTION_KEY_NEXT ({key_fingerprint(new_key)}).")
+    else:
+        new_key = prompt_new_key()
+        # Saved before any file changes: rotated files are unreadable without it
+        update_env({"ENCRYPTION_KEY_NEXT": new_key})
+        print(f"Saved the new key to {ENV_PATH} as ENCRYPTION_KEY_NEXT.")
+
+    conn = sqlite3.connect(db_path)
+    try:
+        migrate(conn)
+        counts = rotate_files(conn, OLD_KEY, new_key, workers or os.cpu_count() or 1)
+    finally:
+        conn.close()
+
+    if counts.get("failed"):
+        print(
+            f"{counts['failed']} files failed (see key_rotation_log). ENCRYPTION_KEY is "
+            "unchanged; rerun this script to retry them."
+        )
+        sys.exit(1)
+    if not counts:
+        print("No encrypted media files left to rotate.")
+    else:
+        print("All files re-encrypted successfully.")
+
+    update_env({"ENCRYPTION_KEY": new_key, "ENCRYPTION_KEY_NEXT": None}, comment_old_key=True)
+    print(f"Updated {ENV_PATH} with the new key.")
+    print("Rotation complete.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rotate the media encryption key.")
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="Worker processes (default: number of CPUs).",
+    )
+    parser.add_argument("--db", default=DB_PATH, help="Main database.")
+    args = parser.parse_args()
+    rotate_keys(args.db, args.workers)
+
 
 if __name__ == "__main__":
-    rotate_keys()
+    main()
@@ -0,0 +1,260 @@
+"""
+Full-Text Search
+----------------
+Searches WeChat messages, other chats, moments and emails in the main
+database through the `search_fts` FTS5 index (migration 002_search_fts.sql).
+Features:
+1. Trigram tokenizer: Chinese/Japanese/Korean text matches without word
+   segmentation; every whitespace-separated term must appear (AND).
+2. 2-character terms (most Chinese words and names) are looked up in the
+   `search_bigram` index (migration 008_search_bigram.sql), whose grams
+   `sync_bigrams` computes for documents queued by triggers; it runs before
+   each search and at the end of merge_dbs.py.
+3. 1-character terms, and 2-character ones containing punctuation, have no
+   index: they are applied as substring filters on the indexed hits, or, if
+   no term is indexed, as a scan of every document ordered by time (the CLI
+   warns about both).
+4. Hits are ranked by bm25 (email subjects weigh double) and paginated;
+   each hit carries its source, contact and timestamp in milliseconds.
+   Queries without a 3+ character term are ordered newest first.
+5. `--rebuild` repopulates both indexes from the source tables.
+
+Usage:
+    python scripts/search_messages.py 生日快乐
+    python scripts/search_messages.py "dinner 周末" --kind message --page 2
+    python scripts/search_messages.py 合同 --json
+    python scripts/search_messages.py --rebuild
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from migrate_db import MIGRATIONS_DIR, migrate
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+DB_PATH = "data/db/database.sqlite"
+SEARCH_MIGRATION = os.path.join(MIGRATIONS_DIR, "002_search_fts.sql")
+KINDS = ("message", "chat", "moment", "email")
+TRIGRAM = 3
+BIGRAM = 2
+BIGRAM_BATCH = 1000
+PAGE_SIZE = 20
+SNIPPET_TOKENS = 16
+# bm25 column weights: title (email subject), body
+RANK_SQL = "bm25(search_fts, 2.0, 1.0)"
+
+
+def _phrase(term):
+    """FTS5 string literal for one term (matched as a phrase)."""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like(term):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def bigrams(*texts):
+    """Space-separated distinct letter/digit bigrams of the texts (search_bigram.grams)."""
+    grams = set()
+    for text in texts:
+        for word in (text or "").split():
+            for a, b in zip(word, word[1:]):
+                if a.isalnum() and b.isalnum():
+                    grams.add(a + b)
+    return " ".join(sorted(grams))
+
+
+def is_bigram_term(term):
+    return len(term) == BIGRAM and term.isalnum()
+
+
+def unindexed_terms(text):
+    """Terms of a query that no index can serve (substring scans)."""
+    return [t for t in text.split() if len(t) < TRIGRAM and not is_bigram_term(t)]
+
+
+def sync_bigrams(conn):
+    """Computes the grams of queued documents (drops deleted ones). Returns documents indexed."""
+    synced = 0
+    while True:
+        with conn:
+            doc_ids = [
+                r[0] for r in conn.execute(
+                    "SELECT doc_id FROM search_bigram_queue LIMIT ?", (BIGRAM_BATCH,)
+                )
+            ]
+            if not doc_ids:
+                break
+            placeholders = ", ".join("?" * len(doc_ids))
+            docs = conn.execute(
+                f"SELECT rowid, title, body FROM search_fts WHERE rowid IN ({placeholders})",
+                doc_ids,
+            ).fetchall()
+            conn.executemany("DELETE FROM search_bigram WHERE rowid = ?", [(d,) for d in doc_ids])
+            conn.executemany(
+                "INSERT INTO search_bigram (rowid, grams) VALUES (?, ?)",
+                [(rowid, bigrams(title, body)) for rowid, title, body in docs],
+            )
+            conn.executemany(
+                "DELETE FROM search_bigram_queue WHERE doc_id = ?", [(d,) for d in doc_ids]
+            )
+        synced += len(docs)
+    return synced
+
+
+def build_query(text, kind=None):
+    """
+    (where clause, params, ranked) for a user query. Long terms go to the
+    trigram MATCH, 2-character ones to the bigram index; the rest become LIKE
+    filters on the stored title/body.
+    """
+    terms = text.split()
+    long_terms = [t for t in terms if len(t) >= TRIGRAM]
+    bigram_terms = [t for t in terms if is_bigram_term(t)]
+    clauses, params = [], []
+    if long_terms:
+        clauses.append("search_fts MATCH ?")
+        params.append(" AND ".join(_phrase(t) for t in long_terms))
+    if bigram_terms:
+        clauses.append(
+            "search_fts.rowid IN (SELECT rowid FROM search_bigram WHERE search_bigram MATCH ?)"
+        )
+        params.append(" AND ".join(_phrase(t) for t in bigram_terms))
+    for term in unindexed_terms(text):
+        clauses.append(
+            "(search_fts.title LIKE ? ESCAPE '\\' OR search_fts.body LIKE ? ESCAPE '\\')"
+        )
+        params += [_like(term), _like(term)]
+    if kind:
+        clauses.append("search_fts.kind = ?")
+        params.append(kind)
+    return " AND ".join(clauses), params, bool(long_terms)
+
+
+def to_ms(ts_ms, ts_text):
+    """Timestamp in ms: stored for chats, parsed from the Date header for emails."""
+    if ts_ms is not None:
+        return ts_ms
+    if not ts_text:
+        return None
+    try:
+        return int(parsedate_to_datetime(ts_text).timestamp() * 1000)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def search(conn, text, kind=None, page=1, page_size=PAGE_SIZE):
+    """One page of hits as dicts, best first (newest first for short-term scans)."""
+    where, params, ranked = build_query(text, kind)
+    if not where:
+        return []
+    order = RANK_SQL if ranked else "search_fts.ts_ms DESC, search_fts.rowid DESC"
+    body_snippet = (
+        f"snippet(search_fts, 1, '[', ']', '…', {SNIPPET_TOKENS})" if ranked else "body"
+    )
+    query = f"""
+        SELECT search_fts.rowid, kind, contact, c.nickname, ts_ms, ts_text,
+               title, {body_snippet}, {RANK_SQL if ranked else 'NULL'}
+        FROM search_fts
+        LEFT JOIN wechat_raw_contacts c
+            ON c.username = search_fts.contact AND search_fts.kind IN ('message', 'moment')
+        WHERE {where}
+        ORDER BY {order}
+        LIMIT ? OFFSET ?
+    """
+    rows = conn.execute(query, params + [page_size, (page - 1) * page_size]).fetchall()
+    hits = []
+    for rowid, hit_kind, contact, nickname, ts_ms, ts_text, title, snippet, rank in rows:
+        hits.append({
+            "kind": hit_kind,
+            "source_id": rowid // 4,
+            "contact": contact,
+            "nickname": nickname,
+            "timestamp_ms": to_ms(ts_ms, ts_text),
+            "title": title,
+            "snippet": snippet,
+            "rank": rank,
+        })
+    return hits
+
+
+def rebuild_index(conn):
+    """Repopulates search_fts (migration file re-run) and, from it, search_bigram."""
+    with open(SEARCH_MIGRATION, "r") as f:
+        sql = f.read()
+    conn.executescript(
+        f"BEGIN;\n{sql}\nDELETE FROM search_bigram;\n"
+        "INSERT OR IGNORE INTO search_bigram_queue (doc_id) SELECT rowid FROM search_fts;\n"
+        "COMMIT;"
+    )
+    sync_bigrams(conn)
+    return conn.execute("SELECT COUNT(*) FROM search_fts").fetchone()[0]
+
+
+def format_hit(hit):
+    ts = hit["timestamp_ms"]
+    when = datetime.fromtimestamp(ts / 1000).strftime("%Y-%m-%d %H:%M") if ts else "?"
+    who = hit["nickname"] or hit["contact"] or "?"
+    text = hit["snippet"] or ""
+    if hit["title"]:
+        text = f"{hit['title']} | {text}"
+    return f"[{hit['kind']}] {when}  {who}: {' '.join(text.split())}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-text search over messages, moments and emails.")
+    parser.add_argument("query", nargs="*", help="Search terms (all must match).")
+    parser.add_argument("--kind", choices=KINDS, help="Only search one source.")
+    parser.add_argument("--page", type=int, default=1, help="Page number (1-based).")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Hits per page.")
+    parser.add_argument("--json", action="store_true", help="Print hits as JSON lines.")
+    parser.add_argument("--rebuild", action="store_true", help="Repopulate the search index.")
+    parser.add_argument("--db", default=DB_PATH, help="Main database.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"Database not found: {args.db}")
+        sys.exit(1)
+
+    conn = sqlite3.connect(args.db)
+    migrate(conn)
+    if args.rebuild:
+        logging.info(f"Search index rebuilt: {rebuild_index(conn)} documents.")
+    text = " ".join(args.query)
+    if text:
+        synced = sync_bigrams(conn)
+        if synced:
+            logging.info(f"Bigram index: {synced} documents indexed.")
+        slow = unindexed_terms(text)
+        if slow:
+            scope = "every document" if len(slow) == len(text.split()) else "the other terms' hits"
+            logging.warning(
+                f"No index for {', '.join(slow)} (1 character, or punctuation in a "
+                f"2-character term): scanning {scope}."
+            )
+        hits = search(conn, text, kind=args.kind, page=max(args.page, 1), page_size=args.page_size)
+        if args.json:
+            for hit in hits:
+                print(json.dumps(hit, ensure_ascii=False))
+        elif not hits:
+            print(f"No matches for '{text}' (page {args.page}).")
+        else:
+            print(f"Page {args.page} ({len(hits)} hits):\n")
+            for hit in hits:
+                print(format_hit(hit))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Person Timeline
+---------------
+Materialized per-person timeline over the consolidated main database
+(migration 003_timeline.sql): WeChat messages, other chats, moments and
+emails in one table keyed by (person_id, create_time). Other chats include the
+QQ MHTML (groups 2/3) and WhatsApp exports, which merge_dbs.py folds into
+other_raw_chats.
+Features:
+1. Incremental sync from per-source id watermarks; set-based inserts, so a
+   merge of millions of rows is a handful of statements. Contacts added since
+   the last sync pull in their existing history, and so do emails whose
+   person_id was set after they were synced.
+2. Range scans and keyset pagination on the clustered primary key: a page
+   costs the same at the start and at the end of a long history.
+3. Per-year/month counts read from the `timeline_counts` rollup (maintained
+   by triggers), independent of how many rows the timeline holds.
+4. Pages are hydrated with content, contact and title from the source tables
+   by primary key.
+
+Usage:
+    python scripts/timeline.py --sync
+    python scripts/timeline.py --person 12 --year 2014
+    python scripts/timeline.py --person 12 --year 2014 --after 1400000000:0:5531
+    python scripts/timeline.py --person 12 --counts month
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from migrate_db import MIGRATIONS_DIR, migrate
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+DB_PATH = "data/db/database.sqlite"
+TIMELINE_MIGRATION = os.path.join(MIGRATIONS_DIR, "003_timeline.sql")
+PAGE_SIZE = 50
+
+KIND_MESSAGE, KIND_CHAT, KIND_MOMENT, KIND_EMAIL = range(4)
+KIND_NAMES = {KIND_MESSAGE: "message", KIND_CHAT: "chat", KIND_MOMENT: "moment", KIND_EMAIL: "email"}
+
+# Chat-like sources resolved through contacts.value = username:
+# kind -> (table, id column, SELECT list for hydration: id, contact, title, content)
+CHAT_SOURCES = {
+    KIND_MESSAGE: ("wechat_raw_messages", "rowid", "rowid, username, NULL, content"),
+    KIND_CHAT: ("other_raw_chats", "id", "id, username, platform, content"),
+    KIND_MOMENT: ("wechat_moments", "rowid", "rowid, username, nickname, content"),
+}
+EMAIL_HYDRATE_SQL = "SELECT id, sender, subject, body FROM emails WHERE id IN ({})"
+# New emails, plus synced ones without a timeline row (person_id set since)
+PENDING_EMAILS_SQL = """
+SELECT id, person_id, date FROM emails e
+WHERE id > ?
+   OR (person_id IS NOT NULL AND NOT EXISTS (
+       SELECT 1 FROM timeline t WHERE t.kind = 3 AND t.source_id = e.id
+   ))
+ORDER BY id
+"""
+
+
+def _watermarks(conn):
+    return dict(conn.execute("SELECT source, last_id FROM timeline_watermarks"))
+
+
+def _set_watermark(conn, source, last_id):
+    conn.execute(
+        "INSERT OR REPLACE INTO timeline_watermarks (source, last_id) VALUES (?, ?)",
+        (source, last_id),
+    )
+
+
+def email_time(date_header):
+    """Unix seconds from an email Date header, or None."""
+    if not date_header:
+        return None
+    try:
+        return int(parsedate_to_datetime(date_header).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def sync_timeline(conn):
+    """Folds new source rows (and new contacts' history) into the timeline. Returns rows added."""
+    added = 0
+    with conn:
+        marks = _watermarks(conn)
+        last_contact = marks.get("contacts", 0)
+        max_contact = conn.execute("SELECT COALESCE(MAX(id), 0) FROM contacts").fetchone()[0]
+
+        for kind, (table, id_col, _) in CHAT_SOURCES.items():
+            last_id = marks.get(table, 0)
+            max_id = conn.execute(f"SELECT COALESCE(MAX({id_col}), 0) FROM {table}").fetchone()[0]
+            # New rows, against every contact
+            added += conn.execute(f"""
+                INSERT OR IGNORE INTO timeline (person_id, create_time, kind, source_id)
+                SELECT c.person_id, s.create_time, {kind}, s.{id_col}
+                FROM {table} s JOIN contacts c ON c.value = s.username
+                WHERE s.{id_col} > ? AND s.{id_col} <= ? AND s.create_time IS NOT NULL
+            """, (last_id, max_id)).rowcount
+            # Already synced rows of contacts added since the last sync
+            if max_contact > last_contact:
+                added += conn.execute(f"""
+                    INSERT OR IGNORE INTO timeline (person_id, create_time, kind, source_id)
+                    SELECT c.person_id, s.create_time, {kind}, s.{id_col}
+                    FROM contacts c JOIN {table} s ON s.username = c.value
+                    WHERE c.id > ? AND s.{id_col} <= ? AND s.create_time IS NOT NULL
+                """, (last_contact, last_id)).rowcount
+            _set_watermark(conn, table, max_id)
+
+        # Emails carry person_id (often assigned after the email was synced);
+        # the Date header is parsed here
+        last_email = marks.get("emails", 0)
+        rows = conn.execute(PENDING_EMAILS_SQL, (last_email,)).fetchall()
+        added += conn.executemany(
+            "INSERT OR IGNORE INTO timeline (person_id, create_time, kind, source_id) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (person_id, ts, KIND_EMAIL, email_id)
+                for email_id, person_id, date in rows
+                if person_id is not None and (ts := email_time(date)) is not None
+            ],
+        ).rowcount
+        if rows and rows[-1][0] > last_email:
+            _set_watermark(conn, "emails", rows[-1][0])
+        _set_watermark(conn, "contacts", max_contact)
+    return added
+
+
+def rebuild_timeline(conn):
+    """Drops and repopulates the timeline and its rollup from scratch."""
+    with open(TIMELINE_MIGRATION, "r") as f:
+        sql = f.read()
+    conn.executescript(
+        "BEGIN;\nDROP TABLE IF EXISTS timeline;\nDROP TABLE IF EXISTS timeline_counts;\n"
+        f"DELETE FROM timeline_watermarks;\n{sql}\nCOMMIT;"
+    )
+    sync_timeline(conn)
+    return conn.execute("SELECT COUNT(*) FROM timeline").fetchone()[0]
+
+
+def year_bounds(year, month=None):
+    """[start, end) unix seconds of a local calendar year or month."""
+    if month:
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+    else:
+        start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def timeline_page(conn, person_id, start=None, end=None, after=None, kinds=None, limit=PAGE_SIZE):
+    """
+    One page of a person's timeline in time order, within [start, end).
+    `after` is the cursor returned with the previous page. Returns (rows, cursor),
+    rows as (create_time, kind, source_id); cursor is None on the last page.
+    """
+    clauses, params = ["person_id = ?"], [person_id]
+    if start is not None:
+        clauses.append("create_time >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("create_time < ?")
+        params.append(end)
+    if after:
+        clauses.append("(create_time, kind, source_id) > (?, ?, ?)")
+        params.extend(after)
+    if kinds:
+        clauses.append(f"kind IN ({', '.join('?' * len(kinds))})")
+        params.extend(kinds)
+    rows = conn.execute(f"""
+        SELECT create_time, kind, source_id FROM timeline
+        WHERE {' AND '.join(clauses)}
+        ORDER BY create_time, kind, source_id
+        LIMIT ?
+    """, params + [limit]).fetchall()
+    cursor = rows[-1] if len(rows) == limit else None
+    return rows, cursor
+
+
+def hydrate(conn, rows):
+    """Timeline rows as dicts with contact, title and content from their source tables."""
+    ids = {}
+    for _, kind, source_id in rows:
+        ids.setdefault(kind, []).append(source_id)
+    details = {}
+    for kind, source_ids in ids.items():
+        placeholders = ", ".join("?" * len(source_ids))
+        if kind == KIND_EMAIL:
+            query = EMAIL_HYDRATE_SQL.format(placeholders)
+        else:
+            table, id_col, columns = CHAT_SOURCES[kind]
+            query = f"SELECT {columns} FROM {table} WHERE {id_col} IN ({placeholders})"
+        for source_id, contact, title, content in conn.execute(query, source_ids):
+            details[(kind, source_id)] = (contact, title, content)
+
+    entries = []
+    for create_time, kind, source_id in rows:
+        contact, title, content = details.get((kind, source_id), (None, None, None))
+        entries.append({
+            "kind": KIND_NAMES[kind],
+            "source_id": source_id,
+            "timestamp_ms": create_time * 1000,
+            "contact": contact,
+            "title": title,
+            "content": content,
+        })
+    return entries
+
+
+def period_counts(conn, person_id, by="month", kinds=None):
+    """[(period, count)] from the rollup; period is YYYY for years, YYYYMM for months."""
+    period = "month / 100" if by == "year" else "month"
+    clauses, params = ["person_id = ?", "n > 0"], [person_id]
+    if kinds:
+        clauses.append(f"kind IN ({', '.join('?' * len(kinds))})")
+        params.extend(kinds)
+    return conn.execute(f"""
+        SELECT {period} AS period, SUM(n) FROM timeline_counts
+        WHERE {' AND '.join(clauses)}
+        GROUP BY period ORDER BY period
+    """, params).fetchall()
+
+
+def parse_cursor(text):
+    """'create_time:kind:source_id' -> tuple of ints."""
+    return tuple(int(part) for part in text.split(":"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the per-person message timeline.")
+    parser.add_argument("--person", type=int, help="Person id.")
+    parser.add_argument("--year", type=int, help="Only this (local) year.")
+    parser.add_argument("--month", type=int, help="Only this month of --year (1-12).")
+    parser.add_argument("--kind", choices=list(KIND_NAMES.values()), action="append",
+                        help="Only these sources (repeatable).")
+    parser.add_argument("--after", help="Cursor printed at the end of the previous page.")
+    parser.add_argument("--limit", type=int, default=PAGE_SIZE, help="Rows per page.")
+    parser.add_argument("--counts", choices=["year", "month"], help="Print counts per period instead.")
+    parser.add_argument("--sync", action="store_true", help="Fold new rows into the timeline.")
+    parser.add_argument("--rebuild", action="store_true", help="Repopulate the timeline from scratch.")
+    parser.add_argument("--db", default=DB_PATH, help="Main database.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"Database not found: {args.db}")
+        sys.exit(1)
+
+    conn = sqlite3.connect(args.db)
+    migrate(conn)
+    if args.rebuild:
+        logging.info(f"Timeline rebuilt: {rebuild_timeline(conn)} rows.")
+    elif args.sync:
+        logging.info(f"Timeline synced: {sync_timeline(conn)} new rows.")
+
+    if args.person is not None:
+        name_to_kind = {name: kind for kind, name in KIND_NAMES.items()}
+        kinds = [name_to_kind[k] for k in args.kind] if args.kind else None
+        if args.counts:
+            for period, count in period_counts(conn, args.person, by=args.counts, kinds=kinds):
+                print(f"{period}: {count}")
+        else:
+            start = end = None
+            if args.year:
+                start, end = year_bounds(args.year, args.month)
+            after = parse_cursor(args.after) if args.after else None
+            rows, cursor = timeline_page(
+                conn, args.person, start, end, after=after, kinds=kinds, limit=args.limit
+            )
+            for entry in hydrate(conn, rows):
+                when = datetime.fromtimestamp(entry["timestamp_ms"] / 1000).strftime("%Y-%m-%d %H:%M")
+                text = " ".join((entry["content"] or "").split())
+                print(f"[{entry['kind']}] {when}  {entry['contact'] or '?'}: {text[:200]}")
+            if cursor:
+                print(f"\nNext page: --after {':'.join(str(v) for v in cursor)}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Speech-to-Text Worker
+---------------------
+Long-lived FunASR (SenseVoiceSmall) transcription process for
+process_wechat_media.py. The model is loaded once; audio paths are sent in
+batches and transcripts come back in batches.
+Features:
+1. `TranscriptionWorker` starts this file under the FunASR interpreter
+   (PYTHON_WITH_FUNASR) with --serve and talks JSON lines over its
+   stdin/stdout pipe: {"id", "paths"} -> {"id", "texts"}.
+2. Each batch is one `model.generate` call; if it fails, the clips are retried
+   one by one so a single bad file only loses its own transcript.
+3. Library output (FunASR banners, progress bars) is redirected to stderr so
+   it can't corrupt the protocol stream.
+4. A worker that dies is restarted once on the next batch; if it can't start,
+   transcripts are None (the caller keeps its placeholder).
+
+This module only uses the standard library (and funasr in --serve mode), so
+it runs in the FunASR virtualenv as is.
+
+Usage:
+    with TranscriptionWorker() as worker:
+        texts = worker.transcribe(["a.mp3", "b.mp3"])    # [str or None, ...]
+
+    python scripts/transcribe_worker.py clip1.mp3 clip2.mp3
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+
+MODEL_PATH = os.path.expanduser("~/llm_models/modelscope/models/iic/SenseVoiceSmall")
+PYTHON_WITH_FUNASR = "../sermon-voices/venv/bin/python"
+WORKER_SCRIPT = os.path.abspath(__file__)
+AUDIO_BATCH_SIZE = 16
+STOP_TIMEOUT = 30
+
+SPECIAL_TOKEN_RE = re.compile(r"<\|.*?\|>")
+FUNASR_VERSION_RE = re.compile(r"funasr version: .*")
+
+
+def clean_text(text):
+    """Transcript without SenseVoice tags (<|zh|>, <|NEUTRAL|>, ...) and FunASR banners."""
+    text = SPECIAL_TOKEN_RE.sub("", text or "")
+    return FUNASR_VERSION_RE.sub("", text).strip()
+
+
+# --- worker side (FunASR interpreter) ---
+
+def _generate(model, paths):
+    results = model.generate(
+        input=paths, cache={}, language="zh", use_itn=True, batch_size=len(paths)
+    )
+    if len(results) != len(paths):
+        raise ValueError(f"{len(results)} results for {len(paths)} clips")
+    return [clean_text(r.get("text")) for r in results]
+
+
+def transcribe_batch(model, paths):
+    """Transcripts for existing paths in one call, falling back to one call per clip."""
+    texts = [None] * len(paths)
+    present = [i for i, p in enumerate(paths) if os.path.exists(p)]
+    if not present:
+        return texts
+    try:
+        for i, text in zip(present, _generate(model, [paths[i] for i in present])):
+            texts[i] = text
+        return texts
+    except Exception as e:
+        print(f"Batch failed ({e}), transcribing clips one by one", file=sys.stderr)
+    for i in present:
+        try:
+            texts[i] = _generate(model, [paths[i]])[0]
+        except Exception as e:
+            print(f"Error transcribing {paths[i]}: {e}", file=sys.stderr)
+    return texts
+
+
+def serve(model_path, device):
+    # The protocol keeps the original stdout; anything else printed goes to stderr
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), "w", buffering=1, encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    from funasr import AutoModel
+
+    model = AutoModel(model=model_path, device=device, disable_update=True)
+    channel.write(json.dumps({"ready": True}) + "\n")
+    for line in sys.stdin:
+        request = json.loads(line)
+        texts = transcribe_batch(model, request["paths"])
+        channel.write(json.dumps({"id": request["id"], "texts": texts}, ensure_ascii=False) + "\n")
+
+
+# --- client side ---
+
+class TranscriptionWorker:
+    def __init__(self, python=PYTHON_WITH_FUNASR, model_path=MODEL_PATH, device="cpu"):
+        self.command = [python, WORKER_SCRIPT, "--serve", "--model", model_path, "--device", device]
+        self.process = None
+        self.next_id = 0
+
+    def start(self):
+        """Spawns the worker and waits until its model is loaded."""
+        self.process = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            text=True, encoding="utf-8", bufsize=1,
+        )
+        ready = self.process.stdout.readline()
+        if not ready:
+            code = self.process.wait()
+            self.process = None
+            raise RuntimeError(f"transcription worker exited during startup (code {code})")
+        logging.info("Transcription worker ready.")
+
+    def _request(self, paths):
+        self.next_id += 1
+        self.process.stdin.write(json.dumps({"id": self.next_id, "paths": paths}) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"transcription worker exited (code {self.process.wait()})")
+        response = json.loads(line)
+        if response.get("id") != self.next_id:
+            raise RuntimeError("transcription worker answered out of order")
+        return response["texts"]
+
+    def transcribe(self, paths):
+        """Transcripts for a batch of audio files, in order; None where transcription failed."""
+        paths = [os.path.abspath(p) for p in paths]
+        for attempt in range(2):
+            try:
+                if self.process is None or self.process.poll() is not None:
+                    self.start()
+                return self._request(paths)
+            except (OSError, RuntimeError, ValueError) as e:
+                logging.error(f"Transcription worker error (attempt {attempt + 1}): {e}")
+                self.close()
+        return [None] * len(paths)
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=STOP_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe audio clips with a resident FunASR worker.")
+    parser.add_argument("paths", nargs="*", help="Audio files to transcribe.")
+    parser.add_argument("--serve", action="store_true", help="Run as the worker (used internally).")
+    parser.add_argument("--model", default=MODEL_PATH, help="FunASR model directory.")
+    parser.add_argument("--device", default="cpu", help="FunASR device (cpu, cuda:0, ...).")
+    parser.add_argument("--python", default=PYTHON_WITH_FUNASR, help="Interpreter with funasr installed.")
+    parser.add_argument("--batch-size", type=int, default=AUDIO_BATCH_SIZE, help="Clips per request.")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.model, args.device)
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    with TranscriptionWorker(args.python, args.model, args.device) as worker:
+        for i in range(0, len(args.paths), args.batch_size):
+            batch = args.paths[i:i + args.batch_size]
+            for path, text in zip(batch, worker.transcribe(batch)):
+                print(f"{path}\t{text if text is not None else '[failed]'}")
+
+
+if __name__ == "__main__":
+    main()